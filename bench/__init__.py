@@ -0,0 +1,3 @@
+"""
+Benchmarks for driving Tuya bulbs, against simulated or real devices.
+"""
@@ -0,0 +1,168 @@
+"""
+Shared helpers for the benchmarks: device setup, statistics and results.
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+# Add parent directory to path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator.fake_bulb import make_bulbs
+from utils.device_manager import setup_devices
+
+
+# Result fields that describe a run rather than measure it
+NOT_COMPARED = ("count", "bulbs", "seconds", "failures")
+
+
+def add_device_arguments(parser):
+    """Add the options that choose simulated or real devices"""
+    parser.add_argument(
+        "--simulate",
+        type=int,
+        default=0,
+        metavar="N",
+        help="run against N simulated bulbs instead of devices.json",
+    )
+    parser.add_argument("--sim-version", default="3.5", choices=("3.3", "3.4", "3.5"))
+    parser.add_argument("--sim-latency", type=float, default=0.02)
+    parser.add_argument("--sim-jitter", type=float, default=0.0)
+    parser.add_argument("--sim-drop-rate", type=float, default=0.0)
+    parser.add_argument("--sim-rate-limit", type=float, default=None)
+
+
+def device_configs_from_args(args):
+    """Return (device_configs, simulated_bulbs) for the chosen devices
+
+    Simulated bulbs are started on free ports and must be stopped by the
+    caller.
+    """
+    if not args.simulate:
+        return setup_devices(), []
+
+    bulbs = make_bulbs(
+        args.simulate,
+        version=args.sim_version,
+        base_port=0,
+        latency=args.sim_latency,
+        jitter=args.sim_jitter,
+        drop_rate=args.sim_drop_rate,
+        rate_limit=args.sim_rate_limit,
+    )
+    configs = {}
+    for bulb in bulbs:
+        bulb.start()
+        entry = bulb.device_entry()
+        configs[bulb.name] = {
+            "device_id": entry["id"],
+            "ip_address": entry["ip"],
+            "local_key": entry["key"],
+            "version": entry["version"],
+            "port": entry["port"],
+        }
+    return configs, bulbs
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence the print output of commands while they are timed"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = int(round(pct / 100 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, rank))]
+
+
+def summarize(samples):
+    """Latency summary (seconds) of a list of samples"""
+    values = sorted(samples)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "min": values[0],
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": values[-1],
+    }
+
+
+def time_call(func, *args):
+    """Run func(*args) and return (elapsed seconds, result)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def environment(args, simulated):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "simulated": bool(simulated),
+        "simulator": (
+            {
+                "count": args.simulate,
+                "version": args.sim_version,
+                "latency": args.sim_latency,
+                "jitter": args.sim_jitter,
+                "drop_rate": args.sim_drop_rate,
+                "rate_limit": args.sim_rate_limit,
+            }
+            if simulated
+            else None
+        ),
+    }
+
+
+def write_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def flatten(results, prefix=""):
+    """Flatten nested result dicts into {"a.b.c": number}"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, higher_is_better, threshold=0.10):
+    """List metrics that regressed by more than threshold against a baseline
+
+    Args:
+        current, baseline: Result dicts as written by write_results
+        higher_is_better: Callable taking a metric name, True when a larger
+            value is an improvement (rates) rather than a regression (times)
+        threshold: Relative change treated as a regression
+    """
+    now = flatten(current.get("results", {}))
+    before = flatten(baseline.get("results", {}))
+    regressions = []
+    for name, value in sorted(now.items()):
+        old = before.get(name)
+        if not old or name.rsplit(".", 1)[-1] in NOT_COMPARED:
+            continue
+        change = (value - old) / abs(old)
+        worse = -change if higher_is_better(name) else change
+        if worse > threshold:
+            regressions.append((name, old, value, change))
+    return regressions
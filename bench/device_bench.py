@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Device Command Benchmarks
+
+Measures how fast this stack drives bulbs and writes the results as JSON
+so runs can be compared:
+- latency percentiles of every bulb_commands function
+- the effect of tinytuya's persistent sockets (set_socketPersistent)
+- all_bulbs fan-out time, sequential and through the command queues
+- the maximum sustained frame rate of each program
+
+Usage:
+    python -m bench.device_bench [--simulate N] [--output results.json] [--compare baseline.json]
+
+Examples:
+    python -m bench.device_bench --simulate 4 --output bench_results.json
+    python -m bench.device_bench --iterations 50 --compare bench_results.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from bench.common import (
+    add_device_arguments,
+    compare,
+    device_configs_from_args,
+    environment,
+    quiet,
+    summarize,
+    time_call,
+    write_results,
+)
+from commands.bulb_commands import (
+    turn_on_bulb,
+    turn_off_bulb,
+    set_brightness,
+    set_temperature,
+    set_color,
+    get_status,
+)
+from utils.command_queue import CommandQueues, AUTOMATION
+from utils.device_manager import connect_device
+from utils.program_registry import ProgramRegistry
+
+# Each bulb_commands function with the arguments it is benchmarked with
+COMMANDS = {
+    "turn_on_bulb": (turn_on_bulb, ()),
+    "turn_off_bulb": (turn_off_bulb, ()),
+    "set_brightness": (set_brightness, (500,)),
+    "set_temperature": (set_temperature, (500,)),
+    "set_color": (set_color, (255, 64, 0)),
+    "get_status": (get_status, ()),
+}
+
+# Metrics where a larger number is an improvement
+RATE_METRICS = ("fps", "frames")
+
+
+def bench_commands(devices, iterations):
+    """Latency of each command, pooled over every device"""
+    results = {}
+    for name, (func, args) in COMMANDS.items():
+        samples = []
+        failures = 0
+        for _ in range(iterations):
+            for device in devices.values():
+                with quiet():
+                    elapsed, ok = time_call(func, device, *args)
+                samples.append(elapsed)
+                failures += 0 if ok else 1
+        results[name] = summarize(samples)
+        results[name]["failures"] = failures
+    return results
+
+
+def bench_persistence(configs, iterations):
+    """set_color latency with and without a persistent socket"""
+    results = {}
+    for persistent in (True, False):
+        samples = []
+        for config in configs.values():
+            device = connect_device(config)
+            device.set_socketPersistent(persistent)
+            for i in range(iterations):
+                with quiet():
+                    elapsed, _ = time_call(set_color, device, i % 256, 0, 255)
+                samples.append(elapsed)
+            device.close()
+        results["persistent" if persistent else "reconnect"] = summarize(samples)
+    return results
+
+
+def bench_fan_out(devices, iterations):
+    """Time to send one command to every bulb"""
+    sequential = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        with quiet():
+            for device in devices.values():
+                set_brightness(device, 100 + i % 900)
+        sequential.append(time.perf_counter() - start)
+
+    queues = CommandQueues()
+    for name, device in devices.items():
+        queues.register(name, device)
+    queued = []
+    try:
+        for i in range(iterations):
+            start = time.perf_counter()
+            with quiet():
+                futures = [
+                    queues.get(name).submit(
+                        set_brightness, device, 100 + i % 900, lane=AUTOMATION
+                    )
+                    for name, device in devices.items()
+                ]
+                for future in futures:
+                    future.result()
+            queued.append(time.perf_counter() - start)
+    finally:
+        queues.close()
+
+    return {
+        "bulbs": len(devices),
+        "sequential": summarize(sequential),
+        "queued": summarize(queued),
+    }
+
+
+class _FrameCounter:
+    """Device proxy counting color frames a program sends"""
+
+    def __init__(self, device):
+        self._device = device
+        self.frames = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._device, name)
+        if name in ("set_colour", "set_value", "set_multiple_values"):
+
+            def counted(*args, **kwargs):
+                self.frames += 1
+                return attr(*args, **kwargs)
+
+            return counted
+        return attr
+
+
+def bench_programs(devices, seconds):
+    """Maximum sustained frame rate of each program
+
+    Programs that take a min_interval are run with it set to zero, so the
+    only limit left is what the devices can deliver.
+    """
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    registry = ProgramRegistry(os.path.join(root_dir, "programs"))
+    results = {}
+    for name in registry.names():
+        info = registry.get(name)
+        if not info.supports_run_program:
+            continue
+
+        counters = [_FrameCounter(device) for device in devices.values()]
+        # Programs round their duration to whole cycles, so run them long
+        # and stop them with the event after the measuring window
+        kwargs = {"duration": 3600, "stop_event": threading.Event()}
+        if "min_interval" in info.parameters:
+            kwargs["min_interval"] = 1e-6
+        if "interval" in info.parameters and "min_interval" not in info.parameters:
+            kwargs["interval"] = 0
+
+        timer = threading.Timer(seconds, kwargs["stop_event"].set)
+        timer.start()
+        start = time.perf_counter()
+        with quiet():
+            info.module.run_program(counters, **kwargs)
+        elapsed = time.perf_counter() - start
+        timer.cancel()
+
+        frames = sum(counter.frames for counter in counters)
+        results[name] = {
+            "seconds": elapsed,
+            "frames": frames,
+            "fps": frames / len(counters) / elapsed if elapsed else 0,
+        }
+    return results
+
+
+def is_rate(metric):
+    return metric.rsplit(".", 1)[-1] in RATE_METRICS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulb command throughput")
+    add_device_arguments(parser)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--program-seconds", type=float, default=5, help="run time per program"
+    )
+    parser.add_argument(
+        "--skip",
+        action="append",
+        default=[],
+        choices=("commands", "persistence", "fan_out", "programs"),
+    )
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="report regressions")
+    args = parser.parse_args()
+
+    configs, simulated = device_configs_from_args(args)
+    try:
+        devices = {name: connect_device(config) for name, config in configs.items()}
+        results = {}
+        if "commands" not in args.skip:
+            print("Benchmarking single commands...")
+            results["commands"] = bench_commands(devices, args.iterations)
+        if "persistence" not in args.skip:
+            print("Benchmarking persistent sockets...")
+            results["persistence"] = bench_persistence(configs, args.iterations)
+        if "fan_out" not in args.skip:
+            print("Benchmarking all_bulbs fan-out...")
+            results["fan_out"] = bench_fan_out(devices, args.iterations)
+        if "programs" not in args.skip:
+            print("Benchmarking program frame rates...")
+            results["programs"] = bench_programs(devices, args.program_seconds)
+    finally:
+        for bulb in simulated:
+            bulb.stop()
+
+    output = {"environment": environment(args, simulated), "results": results}
+    write_results(output, args.output)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline, is_rate)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.6g} -> {new:.6g} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
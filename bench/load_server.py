@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Server Load Test
+
+Drives concurrent REST clients and Socket.IO subscribers against server.py
+and reports requests per second, latency percentiles and how long
+bulb_update events take to reach every subscriber. By default it starts
+simulated bulbs and its own server on a free port, so it runs offline.
+
+Scenarios:
+    dashboard_refresh  - clients poll /api/bulbs and /api/programs
+    slider_storm       - clients send brightness, temperature and color changes
+    program_churn      - clients start and stop programs on random bulbs
+
+Usage:
+    python -m bench.load_server [--scenario NAME] [--clients N] [--subscribers N]
+
+Examples:
+    python -m bench.load_server --scenario slider_storm --clients 20 --subscribers 10
+    python -m bench.load_server --url http://localhost:3456 --scenario dashboard_refresh
+
+Socket.IO subscribers need the client extras: pip install "python-socketio[client]"
+"""
+
+import argparse
+import collections
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from bench.common import (
+    add_device_arguments,
+    compare,
+    device_configs_from_args,
+    environment,
+    summarize,
+    write_results,
+)
+from simulator.fake_bulb import write_devices
+
+try:
+    import socketio as socketio_client
+except ImportError:
+    socketio_client = None
+
+SCENARIOS = ("dashboard_refresh", "slider_storm", "program_churn")
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Client:
+    """Keep-alive HTTP client for one load-generating thread"""
+
+    def __init__(self, base_url, timeout=30):
+        parsed = urllib.parse.urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        """Send a request and return (status, parsed JSON or None)"""
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout
+                )
+            try:
+                self.conn.request(method, path, body=data, headers=headers)
+                response = self.conn.getresponse()
+                raw = response.read()
+                try:
+                    payload = json.loads(raw) if raw else None
+                except ValueError:
+                    payload = None
+                return response.status, payload
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+class Recorder:
+    """Collects request results from every client thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.Counter()
+        self.errors = 0
+        self.sent_updates = {}  # (bulb, brightness) -> send time
+
+    def record(self, name, elapsed, status):
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            self.statuses[str(status)] += 1
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+            self.statuses["exception"] += 1
+
+
+class Subscriber:
+    """Socket.IO client that timestamps bulb_update events"""
+
+    def __init__(self, base_url, recorder):
+        self.recorder = recorder
+        self.delays = []
+        self.events = 0
+        self.client = socketio_client.Client(reconnection=False)
+        self.client.on("bulb_update", self._on_update)
+        self.client.on("bulb_updates", self._on_batch)
+        # Polling first, upgraded to a websocket when websocket-client is installed
+        self.client.connect(base_url)
+
+    def _seen(self, bulb, status):
+        now = time.perf_counter()
+        self.events += 1
+        brightness = (status or {}).get("brightness")
+        sent = self.recorder.sent_updates.get((bulb, brightness))
+        if sent is not None:
+            self.delays.append(now - sent)
+
+    def _on_update(self, data):
+        self._seen(data.get("bulb"), data.get("status"))
+
+    def _on_batch(self, data):
+        for bulb, status in (data.get("bulbs") or {}).items():
+            self._seen(bulb, status)
+
+    def close(self):
+        self.client.disconnect()
+
+
+def timed(client, recorder, name, method, path, body=None):
+    start = time.perf_counter()
+    try:
+        status, payload = client.request(method, path, body)
+    except Exception:
+        recorder.error()
+        return None
+    recorder.record(name, time.perf_counter() - start, status)
+    return payload
+
+
+def dashboard_refresh(client, recorder, bulbs, programs, rng):
+    timed(client, recorder, "get_bulbs", "GET", "/api/bulbs")
+    timed(client, recorder, "get_programs", "GET", "/api/programs")
+
+
+def slider_storm(client, recorder, bulbs, programs, rng):
+    bulb = rng.choice(bulbs)
+    choice = rng.random()
+    if choice < 0.5:
+        # Unique brightness values let subscribers match the event to the send
+        brightness = rng.randint(10, 1000)
+        recorder.sent_updates[(bulb, brightness)] = time.perf_counter()
+        timed(
+            client,
+            recorder,
+            "brightness",
+            "POST",
+            f"/api/bulbs/{bulb}/brightness",
+            {"brightness": brightness},
+        )
+    elif choice < 0.75:
+        timed(
+            client,
+            recorder,
+            "temperature",
+            "POST",
+            f"/api/bulbs/{bulb}/temperature",
+            {"temperature": rng.randint(0, 1000)},
+        )
+    else:
+        color = {key: rng.randint(0, 255) for key in "rgb"}
+        timed(client, recorder, "color", "POST", f"/api/bulbs/{bulb}/color", color)
+
+
+def program_churn(client, recorder, bulbs, programs, rng):
+    bulb = rng.choice(bulbs + ["all_bulbs"])
+    program = rng.choice(programs)
+    body = {"program": program, "bulb": bulb, "duration": 30}
+    timed(client, recorder, "program_run", "POST", "/api/programs/run", body)
+    time.sleep(rng.uniform(0.1, 0.5))
+    timed(client, recorder, "program_stop", "POST", "/api/programs/stop", body)
+
+
+SCENARIO_STEPS = {
+    "dashboard_refresh": dashboard_refresh,
+    "slider_storm": slider_storm,
+    "program_churn": program_churn,
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(simulated, workdir):
+    """Launch server.py against the simulated bulbs and wait until it is up"""
+    write_devices(simulated, os.path.join(workdir, "devices.json"))
+    port = free_port()
+    env = dict(os.environ, SMARTHOME_HOST="127.0.0.1", SMARTHOME_PORT=str(port))
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, "server.py")],
+        cwd=workdir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            log.close()
+            with open(log.name) as f:
+                raise RuntimeError(f"Server exited:\n{f.read()}")
+        try:
+            Client(base_url, timeout=2).request("GET", "/api/programs")
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not start in time")
+
+
+def run_scenario(base_url, scenario, clients, subscribers, duration, seed):
+    recorder = Recorder()
+    setup = Client(base_url)
+    bulbs = sorted((setup.request("GET", "/api/bulbs")[1] or {}).keys())
+    programs = (setup.request("GET", "/api/programs")[1] or {}).get("programs", [])
+    if not bulbs:
+        raise RuntimeError("Server reports no bulbs")
+
+    subs = []
+    if subscribers:
+        if socketio_client is None:
+            print("python-socketio client not installed, skipping subscribers")
+        else:
+            try:
+                for _ in range(subscribers):
+                    subs.append(Subscriber(base_url, recorder))
+            except socketio_client.exceptions.ConnectionError as e:
+                # The client needs requests or websocket-client for transports
+                print(f"Socket.IO subscribers could not connect ({e}), skipping")
+                for sub in subs:
+                    sub.close()
+                subs = []
+
+    step = SCENARIO_STEPS[scenario]
+    stop = threading.Event()
+
+    def worker(index):
+        client = Client(base_url)
+        rng = random.Random(seed + index)
+        while not stop.is_set():
+            step(client, recorder, bulbs, programs, rng)
+
+    threads = [
+        threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=30)
+    elapsed = time.perf_counter() - start
+
+    # Give the last events time to arrive before reading the delays
+    time.sleep(0.5)
+    for sub in subs:
+        sub.close()
+
+    total = sum(len(samples) for samples in recorder.latencies.values())
+    all_samples = [s for samples in recorder.latencies.values() for s in samples]
+    delays = [d for sub in subs for d in sub.delays]
+    return {
+        "clients": clients,
+        "subscribers": len(subs),
+        "seconds": elapsed,
+        "requests": total,
+        "errors": recorder.errors,
+        "requests_per_second": total / elapsed if elapsed else 0,
+        "statuses": dict(recorder.statuses),
+        "latency": summarize(all_samples),
+        "endpoints": {
+            name: summarize(samples) for name, samples in recorder.latencies.items()
+        },
+        "events": {
+            "received": sum(sub.events for sub in subs),
+            "fan_out_delay": summarize(delays),
+        },
+    }
+
+
+def is_rate(metric):
+    return metric.endswith("requests_per_second") or metric.endswith("received")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test server.py")
+    add_device_arguments(parser)
+    parser.set_defaults(simulate=4)
+    parser.add_argument(
+        "--url", help="test an already running server instead of starting one"
+    )
+    parser.add_argument(
+        "--scenario", action="append", choices=SCENARIOS, help="default: all"
+    )
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="load_results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="report regressions")
+    args = parser.parse_args()
+
+    simulated = []
+    process = None
+    base_url = args.url
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if base_url is None:
+                _, simulated = device_configs_from_args(args)
+                process, base_url = start_server(simulated, workdir)
+                print(f"Started server at {base_url} with {len(simulated)} bulbs")
+
+            results = {}
+            for scenario in args.scenario or SCENARIOS:
+                print(f"Running {scenario} for {args.duration} seconds...")
+                results[scenario] = run_scenario(
+                    base_url,
+                    scenario,
+                    args.clients,
+                    args.subscribers,
+                    args.duration,
+                    args.seed,
+                )
+                summary = results[scenario]
+                print(
+                    f"  {summary['requests_per_second']:.1f} req/s, "
+                    f"p99 {summary['latency'].get('p99') or 0:.3f}s, "
+                    f"{summary['errors']} errors"
+                )
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=10)
+            for bulb in simulated:
+                bulb.stop()
+
+    if args.url:
+        args.simulate = 0
+    output = {"environment": environment(args, simulated), "results": results}
+    write_results(output, args.output)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(output, baseline, is_rate)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.6g} -> {new:.6g} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Program Pool Check
+
+None of the bundled programs is main()-only, so nothing else exercises the
+worker pool's full-pool path. This runs a sleeping main()-only program in a
+pool of one worker and checks that:
+- a program waiting for a worker returns at once when it is stopped, and
+  is never started
+- a stopped program that makes no device calls is killed after STOP_GRACE
+  and its worker slot is freed
+- the next program gets a new worker and runs to completion
+
+Usage:
+    python -m bench.pool_check
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from utils.program_pool import STOP_GRACE, ProgramPool
+
+# A main()-only program: sleeps argv[1] seconds, leaving a marker per run
+SLEEPER = '''
+import sys
+import time
+
+
+def main():
+    open(f"started-{sys.argv[2]}", "w").close()
+    time.sleep(float(sys.argv[1]))
+'''
+
+
+def start_run(pool, seconds, tag, stop_event):
+    """Run the sleeper in a thread; returns (thread, {"elapsed": s})"""
+    result = {}
+
+    def run():
+        start = time.monotonic()
+        pool.run("pool_check_sleeper", ["sleeper", str(seconds), tag], {}, stop_event)
+        result["elapsed"] = time.monotonic() - start
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def main():
+    failures = []
+
+    def check(ok, message):
+        print(f"{'ok  ' if ok else 'FAIL'} {message}")
+        if not ok:
+            failures.append(message)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        programs_dir = os.path.join(root_dir, "programs")
+        os.makedirs(programs_dir)
+        with open(os.path.join(programs_dir, "pool_check_sleeper.py"), "w") as f:
+            f.write(SLEEPER)
+
+        def started(tag):
+            return os.path.exists(os.path.join(root_dir, f"started-{tag}"))
+
+        pool = ProgramPool(1, lambda name: None, root_dir=root_dir)
+        try:
+            # Saturate the pool, then queue a second program behind it
+            stop_a, stop_b = threading.Event(), threading.Event()
+            thread_a, result_a = start_run(pool, 60, "a", stop_a)
+            deadline = time.monotonic() + 10
+            while not started("a") and time.monotonic() < deadline:
+                time.sleep(0.1)
+            check(started("a"), "first program runs in the only worker")
+            thread_b, result_b = start_run(pool, 60, "b", stop_b)
+            time.sleep(0.5)
+            check(thread_b.is_alive(), "second program waits for a worker")
+
+            # Stop both: the waiting one returns at once, the other is killed
+            stop_b.set()
+            stop_a.set()
+            thread_b.join(2)
+            check(
+                not thread_b.is_alive() and result_b["elapsed"] < 2,
+                "stopped waiting program returns without a worker",
+            )
+            thread_a.join(STOP_GRACE + 5)
+            check(not thread_a.is_alive(), "stopped program is killed after STOP_GRACE")
+            time.sleep(0.5)
+            check(not started("b"), "stopped waiting program never starts")
+
+            # The discarded worker's slot is free for the next program
+            thread_c, result_c = start_run(pool, 0.2, "c", threading.Event())
+            thread_c.join(15)
+            check(
+                not thread_c.is_alive() and started("c"),
+                "next program gets a new worker and completes",
+            )
+        finally:
+            pool.close()
+
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print("Program pool checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,30 @@ This module provides functions to control Tuya bulbs with commands
 like turning them on/off, setting brightness, color, etc.
 """
 
-import json
+import logging
+
+from utils.bulb_state import decode_hsv
+from utils.color_encoding import encode_hex, encode_json
+
+log = logging.getLogger(__name__)
+
+
+def _failed(result):
+    """Whether a tinytuya call returned an error instead of a reply"""
+    return isinstance(result, dict) and "Error" in result
 
 
 def turn_on_bulb(device):
     """Turn on a Tuya bulb"""
     try:
         result = device.turn_on()
-        print(f"Bulb turned ON")
+        if _failed(result):
+            log.warning("Failed to turn bulb ON: %s", result["Error"])
+            return False
+        log.debug("Bulb turned ON")
         return True
     except Exception as e:
-        print(f"Error turning bulb ON: {e}")
+        log.error("Error turning bulb ON: %s", e)
         return False
 
 
@@ -23,10 +36,13 @@ def turn_off_bulb(device):
     """Turn off a Tuya bulb"""
     try:
         result = device.turn_off()
-        print(f"Bulb turned OFF")
+        if _failed(result):
+            log.warning("Failed to turn bulb OFF: %s", result["Error"])
+            return False
+        log.debug("Bulb turned OFF")
         return True
     except Exception as e:
-        print(f"Error turning bulb OFF: {e}")
+        log.error("Error turning bulb OFF: %s", e)
         return False
 
 
@@ -43,10 +59,13 @@ def set_brightness(device, brightness):
 
         # Use the built-in method to set brightness
         result = device.set_brightness(brightness)
-        print(f"Brightness set to {brightness}")
+        if _failed(result):
+            log.warning("Failed to set brightness: %s", result["Error"])
+            return False
+        log.debug("Brightness set to %s", brightness)
         return True
     except Exception as e:
-        print(f"Error setting brightness: {e}")
+        log.error("Error setting brightness: %s", e)
         return False
 
 
@@ -64,10 +83,13 @@ def set_temperature(device, temperature):
         # Use the built-in method to set white temperature
         # First parameter is brightness (using max), second is temperature
         result = device.set_white(1000, temperature)
-        print(f"Color temperature set to {temperature}")
+        if _failed(result):
+            log.warning("Failed to set color temperature: %s", result["Error"])
+            return False
+        log.debug("Color temperature set to %s", temperature)
         return True
     except Exception as e:
-        print(f"Error setting color temperature: {e}")
+        log.error("Error setting color temperature: %s", e)
         return False
 
 
@@ -91,59 +113,104 @@ def set_color(device, r, g, b):
 
         # Check if set_colour succeeded
         if isinstance(result, dict) and "Error" in result:
-            print(f"Failed to set color: {result['Error']}")
+            log.warning("Failed to set color: %s", result["Error"])
 
             # Try alternative approach if built-in method fails
-            print("Trying alternative color setting method...")
+            log.info("Trying alternative color setting method...")
 
             # First set mode to 'colour'
             device.set_value(21, "colour")
 
-            # Convert RGB to HSV
-            from colorsys import rgb_to_hsv
-
-            h, s, v = rgb_to_hsv(r / 255, g / 255, b / 255)
-
-            # Format according to Tuya expectations
-            hsv = {"h": int(h * 360), "s": int(s * 1000), "v": int(v * 1000)}
-
             # Try setting color_data_v2 (DPS 24) with JSON
-            hsv_json = json.dumps(hsv)
-            result = device.set_value(24, hsv_json)
+            result = device.set_value(24, encode_json(r, g, b))
 
             if result and "Error" not in result:
-                print(f"Color set to RGB({r}, {g}, {b}) using HSV JSON format")
+                log.debug(
+                    "Color set to RGB(%s, %s, %s) using HSV JSON format", r, g, b
+                )
                 return True
             else:
                 # One last attempt using HSV hex format
-                h_value = int(h * 360)
-                s_value = int(s * 1000)
-                v_value = int(v * 1000)
-                hsv_hex = f"{h_value:04x}{s_value:04x}{v_value:04x}"
+                hsv_hex = encode_hex(r, g, b)
                 result = device.set_value(24, hsv_hex)
 
                 if result and "Error" not in result:
-                    print(f"Color set to RGB({r}, {g}, {b}) using HSV hex format")
+                    log.debug(
+                        "Color set to RGB(%s, %s, %s) using HSV hex format", r, g, b
+                    )
                     return True
                 else:
-                    print(f"All color setting methods failed: {result}")
+                    log.error("All color setting methods failed: %s", result)
                     return False
         else:
-            print(f"Color set to RGB({r}, {g}, {b})")
+            log.debug("Color set to RGB(%s, %s, %s)", r, g, b)
             return True
 
     except Exception as e:
-        print(f"Error setting color: {e}")
+        log.error("Error setting color: %s", e)
+        return False
+
+
+def set_dps(device, dps):
+    """Write several data points of a Tuya bulb in one message
+
+    Args:
+        device: The connected bulb device
+        dps: {dp: value}, e.g. {"20": True, "22": 500}
+    """
+    try:
+        result = device.set_multiple_values(dps)
+        if _failed(result):
+            log.warning("Failed to set %s: %s", sorted(dps), result["Error"])
+            return False
+        log.debug("Data points set: %s", dps)
+        return True
+    except Exception as e:
+        log.error("Error setting data points: %s", e)
+        return False
+
+
+def set_frame(device, frame):
+    """Set the color of every segment of a light strip in one message
+
+    Args:
+        device: The connected strip device
+        frame: FrameBuffer, packed r, g, b bytes or an encoded payload
+    """
+    try:
+        result = device.set_frame(frame)
+        if _failed(result):
+            log.warning("Failed to set strip frame: %s", result["Error"])
+            return False
+        log.debug("Strip frame set")
+        return True
+    except Exception as e:
+        log.error("Error setting strip frame: %s", e)
         return False
 
 
+def set_power(device, on):
+    """Turn a Tuya bulb on (True) or off (False)"""
+    return turn_on_bulb(device) if on else turn_off_bulb(device)
+
+
+def set_color_value(device, color):
+    """Set the color of a Tuya bulb from a {"r", "g", "b"} dict"""
+    return set_color(device, color["r"], color["g"], color["b"])
+
+
+def read_status(device):
+    """Read a Tuya bulb's raw status reply, e.g. {"dps": {...}}"""
+    return device.status()
+
+
 def get_status(device):
     """Get the current status of a Tuya bulb"""
     try:
         # Request status update
         data = device.status()
         if "dps" not in data:
-            print("Error: No status data returned")
+            log.error("No status data returned")
             return False
 
         dps = data["dps"]
@@ -155,47 +222,15 @@ def get_status(device):
         print(f"Brightness: {dps.get('22', 'unknown')}")
         print(f"Color Temperature: {dps.get('23', 'unknown')}")
 
-        # Try to parse color data if available
+        # Color data is decoded by the same decoder the server uses
         if "24" in dps:
-            try:
-                color_data = dps["24"]
-                print(f"Color data (raw): {color_data}")
-
-                # Try to parse as JSON
-                if isinstance(color_data, str) and "{" in color_data:
-                    try:
-                        color_json = json.loads(color_data)
-                        if (
-                            "h" in color_json
-                            and "s" in color_json
-                            and "v" in color_json
-                        ):
-                            print(
-                                f"Color (HSV): H:{color_json['h']} S:{color_json['s']} V:{color_json['v']}"
-                            )
-                    except:
-                        pass
-
-                # If it's a hex string, try to decode
-                if isinstance(color_data, str) and len(color_data) >= 12:
-                    try:
-                        # Attempt to decode as HSV hex
-                        if len(color_data) == 12:  # HSV format
-                            h_hex = color_data[0:4]
-                            s_hex = color_data[4:8]
-                            v_hex = color_data[8:12]
-
-                            h = int(h_hex, 16)
-                            s = int(s_hex, 16)
-                            v = int(v_hex, 16)
-
-                            print(f"Color (HSV hex): H:{h} S:{s} V:{v}")
-                    except Exception as e:
-                        print(f"Error parsing hex color: {e}")
-            except Exception as e:
-                print(f"Error parsing color data: {e}")
+            color_data = dps["24"]
+            print(f"Color data (raw): {color_data}")
+            hsv = decode_hsv(color_data)
+            if hsv is not None:
+                print(f"Color (HSV): H:{hsv[0]} S:{hsv[1]} V:{hsv[2]}")
 
         return True
     except Exception as e:
-        print(f"Error getting status: {e}")
+        log.error("Error getting status: %s", e)
         return False
@@ -14,6 +14,7 @@ Examples:
     python programs/color_fade.py all_bulbs 30  # Color fade on all bulbs for 30 minutes
 """
 
+import logging
 import sys
 import time
 import random
@@ -27,6 +28,10 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.device_manager import setup_devices, connect_device
 from commands.bulb_commands import set_color, turn_on_bulb
+from utils.frame_pacing import FramePacer
+from utils.log_config import configure_logging
+
+log = logging.getLogger("programs.color_fade")
 
 # Global variable to track if the program should keep running
 running = True
@@ -35,7 +40,7 @@ running = True
 def signal_handler(sig, frame):
     """Handle Ctrl+C to gracefully exit"""
     global running
-    print("\nStopping color fade. Exiting...")
+    log.info("Stopping color fade. Exiting...")
     running = False
 
 
@@ -60,8 +65,14 @@ def interpolate_color(color1, color2, step, total_steps):
     return r, g, b
 
 
+# Frame pacing limits in seconds between color updates
+FRAME_LIMITS = {"min_interval": 0.05, "max_interval": 0.5}
+
+
 # New function that can be called directly from the server
-def run_program(device, duration=600, stop_event=None):
+def run_program(
+    device, duration=600, stop_event=None, min_interval=None, max_interval=None
+):
     """
     Run the color fade program on a device or list of devices
 
@@ -69,14 +80,22 @@ def run_program(device, duration=600, stop_event=None):
         device: A single bulb device or list of devices
         duration: Duration in seconds (default 10 minutes)
         stop_event: Optional threading.Event to signal when to stop
+        min_interval: Shortest time between color updates (default FRAME_LIMITS)
+        max_interval: Longest time between color updates (default FRAME_LIMITS)
     """
     # Handle either single device or list of devices
     devices = [device] if not isinstance(device, list) else device
 
     # Settings
     transition_time = 4  # Seconds per transition
-    total_steps = 40  # Steps per transition
-    step_time = transition_time / total_steps
+
+    # The number of steps per transition follows what the bulbs can sustain
+    pacer = FramePacer(
+        devices,
+        min_interval=min_interval or FRAME_LIMITS["min_interval"],
+        max_interval=max_interval or FRAME_LIMITS["max_interval"],
+        name="color_fade",
+    )
 
     # Convert duration to transitions
     max_transitions = int(duration / transition_time)
@@ -89,7 +108,7 @@ def run_program(device, duration=600, stop_event=None):
     for device in devices:
         turn_on_bulb(device)
 
-    print(f"Starting color fade for {duration} seconds...")
+    log.info("Starting color fade for %s seconds...", duration)
     try:
         # Keep running until max transitions or until stopped
         while transitions_count < max_transitions and (
@@ -99,24 +118,33 @@ def run_program(device, duration=600, stop_event=None):
             # Generate target color for this transition
             target_color = generate_soft_color()
 
-            # Perform the transition in steps
-            for step in range(total_steps + 1):
+            # Perform the transition, interpolating by elapsed time
+            transition_start = time.monotonic()
+            steps = 0
+            while True:
                 # Check for stop event
                 if stop_event and stop_event.is_set():
-                    print("Received stop signal")
+                    log.info("Received stop signal")
                     return
 
                 # Calculate the interpolated color for this step
+                elapsed = min(time.monotonic() - transition_start, transition_time)
                 interpolated_color = interpolate_color(
-                    current_color, target_color, step, total_steps
+                    current_color, target_color, elapsed, transition_time
                 )
 
                 # Apply the color to all devices
                 for device in devices:
-                    set_color(device, *interpolated_color)
+                    pacer.send(set_color, device, *interpolated_color)
+                steps += 1
 
-                # Sleep for the step duration
-                time.sleep(step_time)
+                if elapsed >= transition_time:
+                    break
+
+                # Sleep until the next frame is due
+                if pacer.wait(stop_event):
+                    log.info("Received stop signal")
+                    return
 
             # The target color becomes our new current color
             current_color = target_color
@@ -124,16 +152,22 @@ def run_program(device, duration=600, stop_event=None):
             # Increment transition counter
             transitions_count += 1
 
-            # Print progress
-            print(f"Completed transition {transitions_count}/{max_transitions}")
+            log.debug(
+                "Completed transition %d/%d in %d steps",
+                transitions_count,
+                max_transitions,
+                steps,
+            )
 
-    except Exception as e:
-        print(f"Error in color fade: {e}")
+    finally:
+        pacer.close()
 
-    print("Color fade program completed")
+    log.info("Color fade program completed")
 
 
 def main():
+    configure_logging()
+
     # Register signal handler for clean exit with Ctrl+C
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -162,7 +196,7 @@ def main():
     if bulb_name == "all_bulbs":
         devices = []
         for name, config in device_configs.items():
-            print(f"Adding bulb: {name}")
+            log.info("Adding bulb: %s", name)
             device = connect_device(config)
             devices.append(device)
 
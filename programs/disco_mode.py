@@ -13,19 +13,24 @@ Examples:
     python programs/disco_mode.py all_bulbs 60  # Disco mode on all bulbs for 60 seconds
 """
 
+import logging
 import sys
 import time
 import random
 import os
 import signal
 import threading
-import traceback
 
 # Add parent directory to path so we can import modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.device_manager import setup_devices, connect_device
-from commands.bulb_commands import set_color, turn_on_bulb
+from commands.bulb_commands import set_color, set_frame, turn_on_bulb
+from utils.frame_pacing import FramePacer
+from utils.light_strip import strip_frame
+from utils.log_config import configure_logging
+
+log = logging.getLogger("programs.disco_mode")
 
 # Global variable to track if the program should keep running
 running = True
@@ -34,7 +39,7 @@ running = True
 def signal_handler(sig, frame):
     """Handle Ctrl+C to gracefully exit"""
     global running
-    print("\nStopping disco mode. Exiting...")
+    log.info("Stopping disco mode. Exiting...")
     running = False
 
 
@@ -51,7 +56,18 @@ def generate_vibrant_color():
     return r, g, b
 
 
-def run_program(device, duration=60, stop_event=None, interval=0.3):
+# Frame pacing limits in seconds between color changes
+FRAME_LIMITS = {"min_interval": 0.1, "max_interval": 1.0}
+
+
+def run_program(
+    device,
+    duration=60,
+    stop_event=None,
+    interval=None,
+    min_interval=None,
+    max_interval=None,
+):
     """
     Run the disco mode program on a device or list of devices
 
@@ -59,31 +75,44 @@ def run_program(device, duration=60, stop_event=None, interval=0.3):
         device: A single bulb device or list of devices
         duration: Duration in seconds (default 60 seconds)
         stop_event: Optional threading.Event to signal when to stop
-        interval: Time between color changes in seconds (default 0.3)
+        interval: Fixed time between color changes in seconds; when not set
+            the interval adapts to the measured device latency
+        min_interval: Shortest time between color changes (default FRAME_LIMITS)
+        max_interval: Longest time between color changes (default FRAME_LIMITS)
     """
-    print(
-        f"Starting disco mode with parameters: duration={duration}, stop_event={stop_event is not None}"
+    log.debug(
+        "Starting disco mode with parameters: duration=%s, stop_event=%s",
+        duration,
+        stop_event is not None,
     )
 
+    pacer = None
     try:
         # Handle either single device or list of devices
         devices = [device] if not isinstance(device, list) else device
 
-        # Print device info
-        print(f"Running disco mode on {len(devices)} device(s)")
+        log.debug("Running disco mode on %d device(s)", len(devices))
 
         # Settings
-        color_change_interval = interval  # seconds between color changes
+        pacer = FramePacer(
+            devices,
+            min_interval=min_interval or FRAME_LIMITS["min_interval"],
+            max_interval=max_interval or FRAME_LIMITS["max_interval"],
+            fixed_interval=interval,
+            name="disco_mode",
+        )
+
+        # Light strips get a different color on every segment
+        frames = [strip_frame(device) for device in devices]
 
         # Turn on all bulbs
         for device in devices:
             try:
                 turn_on_bulb(device)
             except Exception as e:
-                print(f"Error turning on device: {e}")
-                traceback.print_exc()
+                log.exception("Error turning on device")
 
-        print(f"Starting disco mode for {duration} seconds...")
+        log.info("Starting disco mode for %s seconds...", duration)
 
         # Calculate end time
         start_time = time.time()
@@ -95,33 +124,40 @@ def run_program(device, duration=60, stop_event=None, interval=0.3):
         ):
             # Generate a vibrant color
             r, g, b = generate_vibrant_color()
-            print(f"Disco color: RGB({r}, {g}, {b})")
+            log.debug("Disco color: RGB(%d, %d, %d)", r, g, b)
 
             # Apply to all devices
-            for device in devices:
+            for device, frame in zip(devices, frames):
                 try:
+                    if frame is not None:
+                        for i in range(len(frame)):
+                            frame[i] = generate_vibrant_color()
+                        pacer.send(set_frame, device, frame)
+                        continue
                     # Make sure we're passing proper integer values
-                    set_color(device, int(r), int(g), int(b))
+                    pacer.send(set_color, device, int(r), int(g), int(b))
                 except Exception as e:
-                    print(f"Error setting color: {e}")
-                    traceback.print_exc()
+                    log.warning("Error setting color: %s", e)
 
-            # Sleep for the interval
-            time.sleep(color_change_interval)
+            # Sleep until the next frame is due
+            if pacer.wait(stop_event):
+                break
 
             # Display remaining time every few color changes
             if random.randint(1, 10) == 1:
                 remaining = end_time - time.time()
-                print(f"Disco mode: {int(remaining)} seconds remaining")
+                log.debug("Disco mode: %d seconds remaining", remaining)
 
-    except Exception as e:
-        print(f"Error in disco mode: {e}")
-        traceback.print_exc()
+    finally:
+        if pacer is not None:
+            pacer.close()
 
-    print("Disco mode program completed")
+    log.info("Disco mode program completed")
 
 
 def main():
+    configure_logging()
+
     # Register signal handler for clean exit with Ctrl+C
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -147,7 +183,7 @@ def main():
     if bulb_name == "all_bulbs":
         devices = []
         for name, config in device_configs.items():
-            print(f"Adding bulb: {name}")
+            log.info("Adding bulb: %s", name)
             device = connect_device(config)
             devices.append(device)
 
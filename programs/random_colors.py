@@ -13,6 +13,7 @@ Examples:
     python programs/random_colors.py all_bulbs 5   # Change all bulbs every 5 seconds
 """
 
+import logging
 import sys
 import time
 import random
@@ -25,6 +26,9 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.device_manager import setup_devices, connect_device
 from commands.bulb_commands import set_color, turn_on_bulb
+from utils.log_config import configure_logging
+
+log = logging.getLogger("programs.random_colors")
 
 # Global variable to track if the program should keep running
 running = True
@@ -33,7 +37,7 @@ running = True
 def signal_handler(sig, frame):
     """Handle Ctrl+C to gracefully exit"""
     global running
-    print("\nStopping random colors. Exiting...")
+    log.info("Stopping random colors. Exiting...")
     running = False
 
 
@@ -62,61 +66,62 @@ def run_program(device, duration=300, interval=3, stop_event=None):
     for device in devices:
         turn_on_bulb(device)
 
-    print(
-        f"Starting random colors for {duration} seconds, changing every {interval} seconds..."
+    log.info(
+        "Starting random colors for %s seconds, changing every %s seconds...",
+        duration,
+        interval,
     )
 
     # Calculate end time
     start_time = time.time()
     end_time = start_time + duration
 
-    try:
-        # Count color changes
-        change_count = 0
-
-        # Keep running until duration ends or stopped
-        while time.time() < end_time and (
-            stop_event is None or not stop_event.is_set()
-        ):
+    # Count color changes
+    change_count = 0
 
-            # Generate a random color
-            r, g, b = generate_random_color()
+    # Keep running until duration ends or stopped
+    while time.time() < end_time and (stop_event is None or not stop_event.is_set()):
 
-            # Apply to all devices
-            for device in devices:
-                set_color(device, r, g, b)
+        # Generate a random color
+        r, g, b = generate_random_color()
 
-            # Increment counter
-            change_count += 1
+        # Apply to all devices
+        for device in devices:
+            set_color(device, r, g, b)
 
-            # Display status
-            time_left = int(end_time - time.time())
-            print(
-                f"Color change #{change_count}: RGB({r},{g},{b}), {time_left} seconds remaining"
-            )
+        # Increment counter
+        change_count += 1
 
-            # Calculate time to wait
-            wait_time = interval
-            if time.time() + wait_time > end_time:
-                wait_time = max(0, end_time - time.time())
+        log.debug(
+            "Color change #%d: RGB(%d,%d,%d), %d seconds remaining",
+            change_count,
+            r,
+            g,
+            b,
+            end_time - time.time(),
+        )
 
-            # Wait for the interval or until stopped
-            if stop_event:
-                # Check stop_event every 0.5 seconds instead of blocking for the full interval
-                for _ in range(int(wait_time * 2)):
-                    if stop_event.is_set():
-                        break
-                    time.sleep(0.5)
-            else:
-                time.sleep(wait_time)
+        # Calculate time to wait
+        wait_time = interval
+        if time.time() + wait_time > end_time:
+            wait_time = max(0, end_time - time.time())
 
-    except Exception as e:
-        print(f"Error in random colors: {e}")
+        # Wait for the interval or until stopped
+        if stop_event:
+            # Check stop_event every 0.5 seconds instead of blocking for the full interval
+            for _ in range(int(wait_time * 2)):
+                if stop_event.is_set():
+                    break
+                time.sleep(0.5)
+        else:
+            time.sleep(wait_time)
 
-    print("Random colors program completed")
+    log.info("Random colors program completed")
 
 
 def main():
+    configure_logging()
+
     # Register signal handler for clean exit with Ctrl+C
     signal.signal(signal.SIGINT, signal_handler)
 
@@ -147,7 +152,7 @@ def main():
     if bulb_name == "all_bulbs":
         devices = []
         for name, config in device_configs.items():
-            print(f"Adding bulb: {name}")
+            log.info("Adding bulb: %s", name)
             device = connect_device(config)
             devices.append(device)
 
@@ -6,121 +6,470 @@ This server provides a web interface to manage Tuya smart bulbs, allowing users
 - View all bulbs and their status
 - Change bulb colors and brightness
 - Run lighting programs for specified durations
+
+Usage:
+    python server.py [--production] [--host HOST] [--port PORT] [--workers N]
+
+The worker model is chosen with SMARTHOME_ASYNC_MODE (threading, eventlet
+or gevent) because green-thread servers must patch the standard library
+before anything else is imported.
 """
 
 import os
+
+ASYNC_MODE = os.environ.get("SMARTHOME_ASYNC_MODE", "threading")
+if ASYNC_MODE == "eventlet":
+    import eventlet
+
+    eventlet.monkey_patch()
+elif ASYNC_MODE == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import argparse
+import collections
 import time
 import json
+import logging
 import threading
-import importlib
 import signal
 import sys
-from flask import Flask, render_template, request, jsonify
+import urllib.error
+import urllib.request
+from concurrent.futures import TimeoutError as CommandTimeout, wait
+from flask import Flask, Response, render_template, request, jsonify
 from flask_socketio import SocketIO
 
 # Import our custom modules
-from utils.device_manager import setup_devices, connect_device
+from utils import discovery, metrics, profiler, tracing
+from utils.log_config import configure_logging
+from utils.bulb_state import EPOCH, BulbState
+from utils.device_manager import setup_devices
+from utils.program_pool import ProgramPool
+from utils.program_registry import ProgramRegistry
+from utils.device_ownership import OwnershipTable, OwnedDevice
+from utils.command_queue import AUTOMATION, EFFECT
+from utils.device_shards import create_queues
+from utils.device_leases import LEASE_DB, LeaseManager, LeaseStore, instance_identity
+from utils.event_batcher import EventBatcher
+from utils.live_control import LiveControl
+from utils.command_journal import CommandJournal, journal_dps
+from utils.connection_supervisor import ConnectionSupervisor
+from utils.scheduler import Scheduler
 from commands.bulb_commands import (
     turn_on_bulb,
     turn_off_bulb,
     set_brightness,
     set_temperature,
     set_color,
-    get_status,
+    set_dps,
+    set_power,
+    set_color_value,
+    read_status,
 )
 
 # Create Flask app and SocketIO instance
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "smarthome-secret-key!"
-socketio = SocketIO(app)
+socketio = SocketIO(app, async_mode=ASYNC_MODE)
+
+log = logging.getLogger("server")
 
 # Global variables
 bulbs = {}  # Store our bulb devices
 program_threads = {}  # Track running program threads
 stop_events = {}  # Events to signal programs to stop
+program_pool = None  # Worker processes for programs without run_program
+device_owners = OwnershipTable()  # Which program owns each bulb
+# Prioritised per-bulb command queues, in worker processes when
+# SMARTHOME_DEVICE_SHARDS is set
+command_queues = create_queues()
+journal = CommandJournal()  # Desired state of bulbs that cannot be reached
+leases = None  # Bulb ownership shared with other instances (SMARTHOME_LEASE_DB)
+program_registry = ProgramRegistry(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+)  # Cached program modules and metadata
+
+# Number of worker processes for main()-only programs
+PROGRAM_POOL_SIZE = int(os.environ.get("SMARTHOME_PROGRAM_WORKERS", "2"))
+
+# Concurrent connections served by the eventlet or gevent worker pool
+HTTP_WORKERS = int(os.environ.get("SMARTHOME_HTTP_WORKERS", "256"))
+
+# Seconds a request waits for a bulb before giving up on it
+COMMAND_TIMEOUT = float(os.environ.get("SMARTHOME_COMMAND_TIMEOUT", "10"))
+
+# Seconds allowed on shutdown for queued commands to reach the bulbs
+SHUTDOWN_TIMEOUT = float(os.environ.get("SMARTHOME_SHUTDOWN_TIMEOUT", "5"))
+
+# Token for the /debug admin endpoints; without one they only answer
+# requests from this machine
+ADMIN_TOKEN = os.environ.get("SMARTHOME_ADMIN_TOKEN")
+
+# Seconds between batched bulb_updates events, and the most events per
+# second a Socket.IO client is sent
+EVENT_INTERVAL = float(os.environ.get("SMARTHOME_EVENT_INTERVAL", "0.1"))
+CLIENT_EVENT_RATE = float(os.environ.get("SMARTHOME_CLIENT_EVENT_RATE", "10"))
+
+shutting_down = threading.Event()  # Set once shutdown starts
+
+# Header marking a request forwarded by another instance, so it is never
+# forwarded again while the instances disagree about an owner
+FORWARDED_HEADER = "X-SmartHome-Forwarded-By"
+
+# Coalesces bulb state changes into one bulb_updates event per tick
+bulb_events = EventBatcher(socketio, EVENT_INTERVAL, CLIENT_EVENT_RATE)
+
+REQUEST_TIMEOUTS = metrics.REGISTRY.counter(
+    "smarthome_request_timeouts_total",
+    "API requests that gave up waiting for a bulb",
+    ("bulb",),
+)
+metrics.REGISTRY.gauge(
+    "smarthome_queue_depth",
+    "Commands waiting in each bulb's queue lanes",
+    ("bulb", "lane"),
+    lambda: {
+        (name, lane): depth
+        for name, lanes in command_queues.depths().items()
+        for lane, depth in lanes.items()
+    },
+)
+metrics.REGISTRY.gauge(
+    "smarthome_effect_frames_total",
+    "Effect frames replaced by a newer frame (coalesced), dropped as stale or shed",
+    ("bulb", "result"),
+    lambda: {
+        (name, result): count
+        for name, counts in command_queues.frame_counts().items()
+        for result, count in counts.items()
+    },
+    kind="counter",
+)
 
 
 # Setup Tuya devices
 def initialize_devices():
-    """Initialize and connect to all bulb devices"""
-    global bulbs
+    """Initialize and connect to all bulb devices
+
+    With leases, only the bulbs this instance is given are connected; the
+    others are marked as owned elsewhere.
+    """
+    # Keep bulb addresses current from their UDP broadcasts
+    discovery.start()
+    # Reconnect bulbs that are unreachable, now or later
+    supervisor.start()
     device_configs = setup_devices()
 
+    if leases is None:
+        for name, config in device_configs.items():
+            connect_bulb(name, config)
+        return bulbs
+
     for name, config in device_configs.items():
+        bulbs[name] = {
+            "config": config,
+            "name": name,
+            "state": BulbState.offline("Owned by another instance"),
+        }
+    leases.start({name: config["device_id"] for name, config in device_configs.items()})
+    return bulbs
+
+
+def connect_bulb(name, config):
+    """Connect a bulb and read its status, or leave it to the supervisor"""
+    try:
+        # Connect to the device; commands to it are limited to the rate it
+        # can take
+        device = command_queues.connect(name, config)
+        # Store in our global bulbs dictionary
+        state = BulbState()
+        bulbs[name] = {
+            "device": device,
+            "config": config,
+            "name": name,
+            "state": state,
+        }
+        # Update status
         try:
-            # Connect to the device
-            device = connect_device(config)
-            # Store in our global bulbs dictionary
-            bulbs[name] = {
-                "device": device,
-                "config": config,
-                "name": name,
-                "status": {"online": True},
-            }
-            # Update status
-            try:
-                status_data = device.status()
-                if "dps" in status_data:
-                    bulbs[name]["status"] = {
-                        "online": True,
-                        "power": status_data["dps"].get("20", False),
-                        "mode": status_data["dps"].get("21", "unknown"),
-                        "brightness": status_data["dps"].get("22", 0),
-                        "temperature": status_data["dps"].get("23", 0),
-                        "color_data": status_data["dps"].get("24", None),
-                    }
-            except Exception as e:
-                print(f"Error getting status for {name}: {e}")
-                bulbs[name]["status"] = {"online": False, "error": str(e)}
+            status_data = device.status()
+            if "dps" not in status_data:
+                raise ConnectionError(status_data.get("Error", "No status"))
+            state.apply_dps(status_data["dps"])
         except Exception as e:
-            print(f"Error connecting to {name}: {e}")
-            bulbs[name] = {
-                "config": config,
-                "name": name,
-                "status": {"online": False, "error": str(e)},
-            }
+            log.warning("Error getting status for %s: %s", name, e)
+            mark_unreachable(name, e)
+            return
+        if name in journal:
+            replay_journal(name)
+    except Exception as e:
+        log.error("Error connecting to %s: %s", name, e)
+        bulbs[name] = {
+            "config": config,
+            "name": name,
+            "state": BulbState.offline(str(e)),
+        }
+        supervisor.watch(name)
+
+
+def acquire_bulb(name):
+    """Connect a bulb this instance just took the lease on"""
+    connect_bulb(name, bulbs[name]["config"])
+    publish(name, bulbs[name]["state"].as_dict())
+
+
+def release_bulb(name):
+    """Stop using a bulb another instance now owns and close its socket"""
+    for key in list(program_threads):
+        if key.startswith(f"{name}_"):
+            stop_program_run(name, key[len(name) + 1 :])
+    supervisor.forget(name)
+    command_queues.remove(name, timeout=SHUTDOWN_TIMEOUT)
+    bulb = bulbs[name]
+    bulb.pop("device", None)
+    bulb["state"] = BulbState.offline("Owned by another instance")
+
+
+def setup_leases(host, port):
+    """Share bulb ownership with other instances when SMARTHOME_LEASE_DB is set"""
+    global leases
+    if LEASE_DB:
+        instance_id, url = instance_identity(host, port)
+        leases = LeaseManager(
+            LeaseStore(LEASE_DB), instance_id, url, acquire_bulb, release_bulb
+        )
+        log.info("Sharing bulbs through %s as %s (%s)", LEASE_DB, instance_id, url)
+    return leases
+
+
+def is_remote(bulb_name):
+    """Whether another instance holds the lease on a bulb"""
+    return leases is not None and not leases.owns(bulb_name)
+
+
+def forward(url, path, method="GET", body=None, content_type=None):
+    """Send a request to another instance and return its Flask response"""
+    headers = {FORWARDED_HEADER: leases.instance_id}
+    if content_type:
+        headers["Content-Type"] = content_type
+    outgoing = urllib.request.Request(
+        url + path, data=body or None, headers=headers, method=method
+    )
+    try:
+        with tracing.span("forward", to=url):
+            with urllib.request.urlopen(outgoing, timeout=COMMAND_TIMEOUT + 1) as reply:
+                status, data = reply.status, reply.read()
+                content_type = reply.headers.get("Content-Type")
+    except urllib.error.HTTPError as e:
+        status, data = e.code, e.read()
+        content_type = e.headers.get("Content-Type")
+    except OSError as e:
+        log.warning("Forwarding %s %s to %s failed: %s", method, path, url, e)
+        return jsonify({"error": f"Owner at {url} is unreachable"}), 502
+    return Response(data, status=status, content_type=content_type)
+
+
+def forward_later(bulb_name, path, payload):
+    """POST a JSON payload to a bulb's owner from a background thread
+
+    Returns:
+        False if no instance owns the bulb right now
+    """
+    owner = leases.owner(bulb_name)
+    if owner is None:
+        return False
+
+    def send():
+        with app.app_context():
+            reply = forward(
+                owner[1], path, "POST", json.dumps(payload).encode(), "application/json"
+            )
+        if reply.status_code >= 400:
+            log.warning(
+                "Owner %s refused %s: %s", owner[0], path, reply.get_data(as_text=True)
+            )
+
+    # The caller (a Socket.IO handler or the scheduler) does not wait
+    threading.Thread(target=send, name="forward", daemon=True).start()
+    return True
+
+
+def get_program_pool():
+    """Return the program worker pool, starting it on first use"""
+    global program_pool
+    if program_pool is None:
+        program_pool = ProgramPool(
+            PROGRAM_POOL_SIZE, lambda name: command_queues.device(name, lane=EFFECT)
+        )
+    return program_pool
+
+
+def owned_device(bulb_name, owner):
+    """Wrap a bulb's device so only its current owner's writes go through"""
+    device = command_queues.device(bulb_name, lane=EFFECT)
+    return OwnedDevice(device, bulb_name, owner, device_owners)
+
+
+def stop_program_run(bulb_name, program, status="stopped"):
+    """Signal a running program to stop, wait for it and report it"""
+    thread_key = f"{bulb_name}_{program}"
+    thread = program_threads.get(thread_key)
+    if thread_key in stop_events:
+        stop_events[thread_key].set()  # Signal the thread to stop
+    if thread is not None and thread is not threading.current_thread():
+        thread.join(timeout=2)  # Wait for it to stop
+
+    # Clean up
+    program_threads.pop(thread_key, None)
+    stop_events.pop(thread_key, None)
+    device_owners.release((bulb_name, program))
+
+    emit(
+        "program_status",
+        {"bulb": bulb_name, "program": program, "status": status},
+    )
+
+
+def emit(event, data, **kwargs):
+    """Emit a Socket.IO event, timed as a span of the current trace"""
+    with tracing.span("emit", event=event):
+        socketio.emit(event, data, **kwargs)
+
+
+def publish(bulb_name, fields):
+    """Queue changed status fields for the next batched bulb_updates event
+
+    The fields carry the bulb's state version and epoch, so the dashboard
+    can tell which cards changed since it rendered them.
+    """
+    fields = dict(fields, version=bulbs[bulb_name]["state"].version, epoch=EPOCH)
+    with tracing.span("publish"):
+        bulb_events.update(bulb_name, fields)
+
+
+def request_data():
+    """The request's JSON body, timed as the trace's parse span"""
+    with tracing.span("parse"):
+        return request.json
+
+
+def device_call(bulb_name, func, *args):
+    """Run a command on a bulb's queue, waiting at most COMMAND_TIMEOUT
+
+    The request only waits on a future; the device I/O itself happens on
+    the bulb's queue worker, so a slow bulb never holds up other bulbs.
+    """
+    future = command_queues.submit(bulb_name, func, *args)
+    try:
+        return future.result(COMMAND_TIMEOUT)
+    except CommandTimeout:
+        REQUEST_TIMEOUTS.inc((bulb_name,))
+        raise
+
+
+def is_reachable(bulb_name):
+    """Whether a bulb is connected and not waiting to be reconnected"""
+    return "device" in bulbs[bulb_name] and bulb_name not in supervisor
+
+
+def mark_unreachable(bulb_name, error):
+    """Mark a bulb offline and hand it to the connection supervisor"""
+    bulbs[bulb_name]["state"].mark_offline(str(error))
+    publish(bulb_name, {"online": False})
+    supervisor.watch(bulb_name)
 
-    return bulbs
+
+def send_or_journal(bulb_name, attr, value, func, *args):
+    """Run a command, or journal its target if the bulb cannot be reached
+
+    Args:
+        bulb_name: Bulb to send to
+        attr, value: The attribute the command sets and its target, as
+            recorded in the journal
+        func, args: The command, run as func(device, *args)
+
+    Returns:
+        True if the bulb took the command, False if it was journaled and
+        will be written once the bulb is reachable again
+    """
+    error = bulbs[bulb_name]["state"].error or "Bulb is offline"
+    if is_reachable(bulb_name):
+        try:
+            if device_call(bulb_name, func, *args):
+                return True
+            error = f"{getattr(func, '__name__', 'command')} failed"
+        except CommandTimeout:
+            error = "Bulb did not respond in time"
+    journal.record(bulb_name, attr, value)
+    mark_unreachable(bulb_name, error)
+    log.info("%s unreachable, journaled %s=%s", bulb_name, attr, value)
+    return False
+
+
+def probe_bulb(bulb_name):
+    """Try to reach an offline bulb, connecting it first if it never was
+
+    Returns:
+        True if the bulb answered a status request
+    """
+    bulb = bulbs[bulb_name]
+    if "device" not in bulb:
+        bulb["device"] = command_queues.connect(bulb_name, bulb["config"])
+    status = command_queues.submit(bulb_name, read_status).result(COMMAND_TIMEOUT)
+    if "dps" not in status:
+        return False
+    bulb["state"].apply_dps(status["dps"])
+    return True
+
+
+def replay_journal(bulb_name):
+    """Bring a bulb that is reachable again to its journaled state
+
+    Every journaled intent goes out in one set_multiple_values; if that
+    fails they are put back and the bulb is probed again later.
+    """
+    state = bulbs[bulb_name]["state"]
+    intents = journal.take(bulb_name)
+    if intents:
+        dps = journal_dps(intents, state.mode, state.hsv)
+        try:
+            written = device_call(bulb_name, set_dps, dps)
+        except CommandTimeout:
+            written = False
+        if not written:
+            journal.restore(bulb_name, intents)
+            mark_unreachable(bulb_name, "Journal replay failed")
+            return False
+        state.apply_dps(dps)
+        log.info("Replayed %s to %s in one write", list(intents), bulb_name)
+    publish(bulb_name, state.as_dict())
+    return True
+
+
+supervisor = ConnectionSupervisor(probe_bulb, replay_journal)
 
 
 # Function to run a program
-def run_program(program_name, bulb_name, duration, socket_io):
+def run_program(program_name, bulb_name, duration):
     """Run a lighting program for a specific duration"""
     # Import the program module
     try:
-        print(
-            f"Attempting to run program: {program_name} on bulb: {bulb_name} for {duration} seconds"
+        log.info(
+            "Running program %s on %s for %s seconds", program_name, bulb_name, duration
         )
 
         # Get the stop event
+        owner = (bulb_name, program_name)
         stop_event = stop_events.get(f"{bulb_name}_{program_name}", threading.Event())
         stop_events[f"{bulb_name}_{program_name}"] = stop_event
 
-        # Add programs directory to path if needed
-        programs_dir = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), "programs"
-        )
-        if programs_dir not in sys.path:
-            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-            print(f"Added {os.path.dirname(os.path.abspath(__file__))} to sys.path")
-
-        # Import the module
-        module_path = f"programs.{program_name}"
-        print(f"Importing module: {module_path}")
-        print(f"Python path: {sys.path}")
-        try:
-            program_module = importlib.import_module(module_path)
-            print(f"Successfully imported module: {module_path}")
-            print(f"Module methods: {dir(program_module)}")
-        except Exception as e:
-            print(f"Error importing module {module_path}: {e}")
-            import traceback
-
-            traceback.print_exc()
-            raise
+        # Look up the cached module, reloaded only if its file changed;
+        # a failure is logged once, below
+        program_module = program_registry.get(program_name).module
 
-        # Run the program
-        device = bulbs[bulb_name]["device"] if bulb_name in bulbs else None
+        # Run the program, writing only to the bulbs this run owns
+        device = owned_device(bulb_name, owner) if bulb_name in bulbs else None
 
         if not device and bulb_name != "all_bulbs":
             raise ValueError(f"No device found for bulb: {bulb_name}")
@@ -130,16 +479,18 @@ def run_program(program_name, bulb_name, duration, socket_io):
             devices_list = None
             if bulb_name == "all_bulbs":
                 devices_list = [
-                    info["device"] for name, info in bulbs.items() if "device" in info
+                    owned_device(name, owner)
+                    for name, info in bulbs.items()
+                    if "device" in info
                 ]
-                print(f"Running on all_bulbs: {len(devices_list)} devices")
+                log.debug("Running on all_bulbs: %d devices", len(devices_list))
             else:
-                print(f"Running on single bulb: {bulb_name}")
+                log.debug("Running on single bulb: %s", bulb_name)
 
             # Check if run_program function exists in the module
             if hasattr(program_module, "run_program"):
-                print(f"Found run_program function in {program_name}")
-                socket_io.emit(
+                log.debug("Found run_program function in %s", program_name)
+                emit(
                     "program_status",
                     {
                         "bulb": bulb_name,
@@ -152,24 +503,22 @@ def run_program(program_name, bulb_name, duration, socket_io):
                 # Run the program with the stop event
                 try:
                     if bulb_name == "all_bulbs" and devices_list:
-                        print(
-                            f"Calling run_program for all_bulbs with {len(devices_list)} devices"
+                        log.debug(
+                            "Calling run_program for all_bulbs with %d devices",
+                            len(devices_list),
                         )
                         program_module.run_program(
                             devices_list, duration=duration, stop_event=stop_event
                         )
                     else:
-                        print(f"Calling run_program for {bulb_name}")
+                        log.debug("Calling run_program for %s", bulb_name)
                         program_module.run_program(
                             device, duration=duration, stop_event=stop_event
                         )
-                    print(f"Program {program_name} completed successfully")
+                    log.info("Program %s completed", program_name)
                 except Exception as e:
-                    print(f"Error in program execution: {e}")
-                    import traceback
-
-                    traceback.print_exc()
-                    socket_io.emit(
+                    log.exception("Error in program %s", program_name)
+                    emit(
                         "program_status",
                         {
                             "bulb": bulb_name,
@@ -180,24 +529,24 @@ def run_program(program_name, bulb_name, duration, socket_io):
                     )
                     return
 
-                socket_io.emit(
+                emit(
                     "program_status",
                     {"bulb": bulb_name, "program": program_name, "status": "completed"},
                 )
             else:
-                # Fall back to main function
-                print(
-                    f"No run_program function found in {program_name}, falling back to main()"
+                # Fall back to main function in a worker process
+                log.debug(
+                    "No run_program function in %s, running main() in a worker process",
+                    program_name,
                 )
-                # Create sys.argv-like arguments for the program
-                old_argv = sys.argv.copy()
+                # Arguments are passed to the worker explicitly instead of
+                # swapping this process's sys.argv
                 if duration:
-                    sys.argv = [program_name, bulb_name, str(duration)]
+                    argv = [program_name, bulb_name, str(duration)]
                 else:
-                    sys.argv = [program_name, bulb_name]
+                    argv = [program_name, bulb_name]
 
-                # Redirect program output
-                socket_io.emit(
+                emit(
                     "program_status",
                     {
                         "bulb": bulb_name,
@@ -210,14 +559,21 @@ def run_program(program_name, bulb_name, duration, socket_io):
                 # Run the program
                 if hasattr(program_module, "main"):
                     try:
-                        program_module.main()
-                        print(f"Program {program_name} main() completed successfully")
+                        device_configs = {
+                            name: info["config"]
+                            for name, info in bulbs.items()
+                            if "device" in info
+                        }
+                        get_program_pool().run(
+                            program_name,
+                            argv,
+                            device_configs,
+                            stop_event=stop_event,
+                            device_lookup=lambda name: owned_device(name, owner),
+                        )
                     except Exception as e:
-                        print(f"Error in program main(): {e}")
-                        import traceback
-
-                        traceback.print_exc()
-                        socket_io.emit(
+                        log.exception("Error in program %s main()", program_name)
+                        emit(
                             "program_status",
                             {
                                 "bulb": bulb_name,
@@ -228,20 +584,28 @@ def run_program(program_name, bulb_name, duration, socket_io):
                         )
                         return
 
-                # Restore sys.argv
-                sys.argv = old_argv
+                    if stop_event.is_set():
+                        # Stopped while it ran or before it got a worker
+                        log.info("Program %s main() stopped", program_name)
+                        emit(
+                            "program_status",
+                            {
+                                "bulb": bulb_name,
+                                "program": program_name,
+                                "status": "stopped",
+                            },
+                        )
+                        return
+                    log.info("Program %s main() completed", program_name)
 
-                socket_io.emit(
+                emit(
                     "program_status",
                     {"bulb": bulb_name, "program": program_name, "status": "completed"},
                 )
 
     except Exception as e:
-        print(f"Error running program {program_name} on {bulb_name}: {e}")
-        import traceback
-
-        traceback.print_exc()
-        socketio.emit(
+        log.exception("Error running program %s on %s", program_name, bulb_name)
+        emit(
             "program_status",
             {
                 "bulb": bulb_name,
@@ -251,11 +615,69 @@ def run_program(program_name, bulb_name, duration, socket_io):
             },
         )
 
-    # Clean up
-    if f"{bulb_name}_{program_name}" in program_threads:
-        del program_threads[f"{bulb_name}_{program_name}"]
-    if f"{bulb_name}_{program_name}" in stop_events:
-        del stop_events[f"{bulb_name}_{program_name}"]
+    finally:
+        # Clean up, unless a newer run of the same program already took over
+        key = f"{bulb_name}_{program_name}"
+        if program_threads.get(key) is threading.current_thread():
+            del program_threads[key]
+            stop_events.pop(key, None)
+            device_owners.release((bulb_name, program_name))
+
+
+@app.before_request
+def start_request_trace():
+    """Trace every API request"""
+    if request.path.startswith("/api/"):
+        tracing.start(f"{request.method} {request.path}")
+
+
+@app.after_request
+def finish_request_trace(response):
+    if tracing.current() is not None:
+        tracing.finish(status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def drop_request_trace(error=None):
+    # Requests that failed before after_request still end their trace
+    if tracing.current() is not None:
+        tracing.finish(error=str(error) if error else None)
+
+
+@app.before_request
+def reject_during_shutdown():
+    """Refuse new work once shutdown is draining the command queues"""
+    if shutting_down.is_set():
+        return jsonify({"error": "Server is shutting down"}), 503
+
+
+@app.before_request
+def forward_to_owner():
+    """Forward requests for a bulb another instance owns to that instance"""
+    if leases is None or FORWARDED_HEADER in request.headers:
+        return None
+    bulb_name = (request.view_args or {}).get("bulb_name")
+    if request.endpoint in ("run_program_api", "stop_program"):
+        bulb_name = (request.get_json(silent=True) or {}).get("bulb")
+    if bulb_name not in bulbs or not is_remote(bulb_name):
+        return None
+    owner = leases.owner(bulb_name)
+    if owner is None:
+        return jsonify({"error": f"No instance owns {bulb_name} right now"}), 503
+    return forward(
+        owner[1],
+        request.full_path.rstrip("?"),
+        request.method,
+        request.get_data(),
+        request.content_type,
+    )
+
+
+@app.errorhandler(CommandTimeout)
+def command_timeout(error):
+    """A bulb did not answer within COMMAND_TIMEOUT"""
+    return jsonify({"error": "Bulb did not respond in time"}), 504
 
 
 # Routes
@@ -265,215 +687,302 @@ def index():
     return render_template("index.html")
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def is_admin():
+    """Whether the request may use the /debug admin endpoints"""
+    if ADMIN_TOKEN:
+        return request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+
+@app.route("/debug/traces")
+def debug_traces():
+    """Recent request and frame traces, newest first"""
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    kind = request.args.get("kind")
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify({"traces": tracing.recent(kind, limit)})
+
+
+@app.route("/debug/profile", methods=["POST"])
+def debug_profile():
+    """Sample every thread's stack for ?seconds=N and return the hot spots"""
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    seconds = request.args.get("seconds", 10, type=float)
+    stats = profiler.profile(seconds)
+    if stats is None:
+        return jsonify({"error": "A profile is already running"}), 409
+    return jsonify(stats)
+
+
 @app.route("/api/bulbs", methods=["GET"])
 def get_bulbs():
     """Get all bulbs and their status"""
-    # Refresh status for each bulb
-    for name, bulb_info in bulbs.items():
-        if "device" in bulb_info:
-            try:
-                status_data = bulb_info["device"].status()
-                if "dps" in status_data:
-                    bulbs[name]["status"] = {
-                        "online": True,
-                        "power": status_data["dps"].get("20", False),
-                        "mode": status_data["dps"].get("21", "unknown"),
-                        "brightness": status_data["dps"].get("22", 0),
-                        "temperature": status_data["dps"].get("23", 0),
-                        "color_data": status_data["dps"].get("24", None),
-                    }
-            except Exception as e:
-                print(f"Error getting status for {name}: {e}")
-                bulbs[name]["status"] = {"online": False, "error": str(e)}
-
-    # Format the response
-    bulb_data = {}
-    for name, bulb_info in bulbs.items():
-        bulb_data[name] = {"name": name, "status": bulb_info["status"]}
-
-    return jsonify(bulb_data)
+    # Refresh every bulb at once; bulbs that do not answer in time keep
+    # their last known status instead of delaying the whole response.
+    # Offline bulbs are left to the connection supervisor.
+    futures = {
+        name: command_queues.submit(name, read_status)
+        for name in bulbs
+        if is_reachable(name)
+    }
+    wait(futures.values(), timeout=COMMAND_TIMEOUT)
+    for name, future in futures.items():
+        if not future.done():
+            REQUEST_TIMEOUTS.inc((name,))
+            log.warning("Status for %s timed out, using last known status", name)
+            bulbs[name]["state"].mark_stale()
+            continue
+        try:
+            status_data = future.result()
+            if "dps" not in status_data:
+                raise ConnectionError(status_data.get("Error", "No status"))
+            bulbs[name]["state"].apply_dps(status_data["dps"])
+        except Exception as e:
+            log.warning("Error getting status for %s: %s", name, e)
+            mark_unreachable(name, e)
+
+    # Assemble the response from each bulb's cached JSON, with the status
+    # of bulbs owned elsewhere as their owner reports it
+    remote = remote_statuses()
+    body = ", ".join(
+        f'{json.dumps(name)}: {{"name": {json.dumps(name)}, '
+        f'"status": {remote.get(name) or bulb_info["state"].to_json()}}}'
+        for name, bulb_info in bulbs.items()
+    )
+    return Response("{" + body + "}", mimetype="application/json")
+
+
+def remote_statuses():
+    """{bulb: status JSON} of the bulbs other instances own, asked of each owner"""
+    if leases is None or FORWARDED_HEADER in request.headers:
+        return {}
+    owned_by = collections.defaultdict(list)
+    for name in bulbs:
+        owner = leases.owner(name) if is_remote(name) else None
+        if owner is not None:
+            owned_by[owner[1]].append(name)
+    statuses = {}
+    for url, names in owned_by.items():
+        response = forward(url, "/api/bulbs")
+        if isinstance(response, tuple) or response.status_code != 200:
+            continue
+        reported = json.loads(response.get_data())
+        for name in names:
+            if name in reported:
+                statuses[name] = json.dumps(reported[name]["status"])
+    return statuses
+
+
+@app.route("/api/instances", methods=["GET"])
+def get_instances():
+    """The instances sharing the bulbs and the owner of each bulb"""
+    if leases is None:
+        return jsonify({"instances": {}, "owners": {}})
+    owners = {}
+    for name in bulbs:
+        owner = leases.owner(name)
+        owners[name] = owner[0] if owner else None
+    return jsonify(
+        {"self": leases.instance_id, "instances": leases.instances(), "owners": owners}
+    )
 
 
 @app.route("/api/bulbs/<bulb_name>/toggle", methods=["POST"])
 def toggle_bulb(bulb_name):
     """Toggle a bulb on or off"""
-    if bulb_name not in bulbs or "device" not in bulbs[bulb_name]:
-        return jsonify({"error": f"Bulb {bulb_name} not found or offline"}), 404
+    if bulb_name not in bulbs:
+        return jsonify({"error": f"Bulb {bulb_name} not found"}), 404
 
-    device = bulbs[bulb_name]["device"]
-    current_status = device.status()
+    state = bulbs[bulb_name]["state"]
+    is_on = None
+    if is_reachable(bulb_name):
+        try:
+            current_status = device_call(bulb_name, read_status)
+        except CommandTimeout:
+            current_status = {}
+        is_on = (current_status.get("dps") or {}).get("20")
+    if is_on is None:
+        # No answer: toggle the power the bulb is headed for
+        is_on = journal.pending(bulb_name).get("power", state.power)
 
-    if "dps" in current_status and "20" in current_status["dps"]:
-        is_on = current_status["dps"]["20"]
-        if is_on:
-            turn_off_bulb(device)
-            bulbs[bulb_name]["status"]["power"] = False
-        else:
-            turn_on_bulb(device)
-            bulbs[bulb_name]["status"]["power"] = True
+    power = not is_on
+    command = turn_on_bulb if power else turn_off_bulb
+    if not send_or_journal(bulb_name, "power", power, command):
+        return jsonify({"status": "queued", "power": power}), 202
 
-        # Emit status update via Socket.IO
-        socketio.emit(
-            "bulb_update", {"bulb": bulb_name, "status": bulbs[bulb_name]["status"]}
-        )
+    state.update(power=power)
+    # Send the change to Socket.IO clients with the next batch
+    publish(bulb_name, {"power": power})
 
-        return jsonify({"status": "success", "power": not is_on})
-
-    return jsonify({"error": "Failed to get current status"}), 500
+    return jsonify({"status": "success", "power": power})
 
 
 @app.route("/api/bulbs/<bulb_name>/brightness", methods=["POST"])
 def set_bulb_brightness(bulb_name):
     """Set bulb brightness"""
-    if bulb_name not in bulbs or "device" not in bulbs[bulb_name]:
-        return jsonify({"error": f"Bulb {bulb_name} not found or offline"}), 404
+    if bulb_name not in bulbs:
+        return jsonify({"error": f"Bulb {bulb_name} not found"}), 404
 
-    data = request.json
+    data = request_data()
     if "brightness" not in data:
         return jsonify({"error": "Brightness value not provided"}), 400
 
     brightness = int(data["brightness"])
-    device = bulbs[bulb_name]["device"]
-
-    result = set_brightness(device, brightness)
-    if result:
-        bulbs[bulb_name]["status"]["brightness"] = brightness
-        # Emit status update via Socket.IO
-        socketio.emit(
-            "bulb_update", {"bulb": bulb_name, "status": bulbs[bulb_name]["status"]}
-        )
-        return jsonify({"status": "success", "brightness": brightness})
 
-    return jsonify({"error": "Failed to set brightness"}), 500
+    if not send_or_journal(
+        bulb_name, "brightness", brightness, set_brightness, brightness
+    ):
+        # Written once the bulb is reachable again
+        return jsonify({"status": "queued", "brightness": brightness}), 202
+
+    bulbs[bulb_name]["state"].update(brightness=brightness)
+    # Send the change to Socket.IO clients with the next batch
+    publish(bulb_name, {"brightness": brightness})
+    return jsonify({"status": "success", "brightness": brightness})
 
 
 @app.route("/api/bulbs/<bulb_name>/temperature", methods=["POST"])
 def set_bulb_temperature(bulb_name):
     """Set bulb color temperature"""
-    if bulb_name not in bulbs or "device" not in bulbs[bulb_name]:
-        return jsonify({"error": f"Bulb {bulb_name} not found or offline"}), 404
+    if bulb_name not in bulbs:
+        return jsonify({"error": f"Bulb {bulb_name} not found"}), 404
 
-    data = request.json
+    data = request_data()
     if "temperature" not in data:
         return jsonify({"error": "Temperature value not provided"}), 400
 
     temperature = int(data["temperature"])
-    device = bulbs[bulb_name]["device"]
-
-    result = set_temperature(device, temperature)
-    if result:
-        bulbs[bulb_name]["status"]["temperature"] = temperature
-        # Emit status update via Socket.IO
-        socketio.emit(
-            "bulb_update", {"bulb": bulb_name, "status": bulbs[bulb_name]["status"]}
-        )
-        return jsonify({"status": "success", "temperature": temperature})
 
-    return jsonify({"error": "Failed to set temperature"}), 500
+    if not send_or_journal(
+        bulb_name, "temperature", temperature, set_temperature, temperature
+    ):
+        # Written once the bulb is reachable again
+        return jsonify({"status": "queued", "temperature": temperature}), 202
+
+    bulbs[bulb_name]["state"].update(temperature=temperature, mode="white")
+    # Send the change to Socket.IO clients with the next batch
+    publish(bulb_name, {"temperature": temperature})
+    return jsonify({"status": "success", "temperature": temperature})
 
 
 @app.route("/api/bulbs/<bulb_name>/color", methods=["POST"])
 def set_bulb_color(bulb_name):
     """Set bulb color using RGB values"""
-    if bulb_name not in bulbs or "device" not in bulbs[bulb_name]:
-        return jsonify({"error": f"Bulb {bulb_name} not found or offline"}), 404
+    if bulb_name not in bulbs:
+        return jsonify({"error": f"Bulb {bulb_name} not found"}), 404
 
-    data = request.json
+    data = request_data()
     if not all(key in data for key in ["r", "g", "b"]):
         return jsonify({"error": "RGB color values not provided"}), 400
 
     r = int(data["r"])
     g = int(data["g"])
     b = int(data["b"])
-    device = bulbs[bulb_name]["device"]
-
-    result = set_color(device, r, g, b)
-    if result:
-        # Emit status update via Socket.IO
-        socketio.emit(
-            "bulb_update",
-            {"bulb": bulb_name, "status": {"color": {"r": r, "g": g, "b": b}}},
-        )
-        return jsonify({"status": "success", "color": {"r": r, "g": g, "b": b}})
 
-    return jsonify({"error": "Failed to set color"}), 500
+    if not send_or_journal(bulb_name, "color", [r, g, b], set_color, r, g, b):
+        # Written once the bulb is reachable again
+        return jsonify({"status": "queued", "color": {"r": r, "g": g, "b": b}}), 202
+
+    bulbs[bulb_name]["state"].set_rgb(r, g, b)
+    # Send the change to Socket.IO clients with the next batch
+    publish(bulb_name, {"color": {"r": r, "g": g, "b": b}})
+    return jsonify({"status": "success", "color": {"r": r, "g": g, "b": b}})
 
 
 @app.route("/api/programs", methods=["GET"])
 def get_programs():
     """Get available lighting programs"""
-    programs = []
-    program_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
-
-    for filename in os.listdir(program_dir):
-        if filename.endswith(".py") and not filename.startswith("__"):
-            program_name = filename.replace(".py", "")
-            programs.append(program_name)
-
-    return jsonify({"programs": programs})
-
-
-@app.route("/api/programs/run", methods=["POST"])
-def run_program_api():
-    """Run a lighting program"""
-    data = request.json
-    print(f"Program run request: {data}")
+    return jsonify(
+        {
+            "programs": program_registry.names(),
+            "details": program_registry.metadata(),
+        }
+    )
 
-    if not all(key in data for key in ["program", "bulb"]):
-        error_msg = "Program and bulb name must be provided"
-        print(f"API error: {error_msg}")
-        return jsonify({"error": error_msg}), 400
 
-    program = data["program"]
-    bulb_name = data["bulb"]
-    duration = data.get("duration", 60)  # Default 60 seconds if not specified
+def start_program(program, bulb_name, duration=60, priority=None):
+    """Start a program on a bulb (or "all_bulbs") in a new thread
 
-    print(
-        f"Processing program run request: program={program}, bulb={bulb_name}, duration={duration}"
-    )
+    Without a priority the program preempts the bulbs' current owners;
+    with one the claim is layered and the highest priority owns each bulb.
 
+    Raises:
+        LookupError: The bulb is unknown or offline, or the program does
+            not exist
+    """
     # Check if bulb exists
     if bulb_name != "all_bulbs" and (
         bulb_name not in bulbs or "device" not in bulbs[bulb_name]
     ):
-        error_msg = f"Bulb {bulb_name} not found or offline"
-        print(f"API error: {error_msg}")
-        return jsonify({"error": error_msg}), 404
+        raise LookupError(f"Bulb {bulb_name} not found or offline")
 
     # Check if program exists
-    program_path = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "programs", f"{program}.py"
-    )
-    if not os.path.exists(program_path):
-        error_msg = f"Program {program} not found at {program_path}"
-        print(f"API error: {error_msg}")
-        return jsonify({"error": error_msg}), 404
+    if program not in program_registry:
+        raise LookupError(f"Program {program} not found")
 
-    print(f"Program file found: {program_path}")
-
-    # Stop any running program for this bulb
+    # Stop any earlier run of this program on this bulb
     thread_key = f"{bulb_name}_{program}"
     if thread_key in program_threads and program_threads[thread_key].is_alive():
-        print(f"Stopping existing program: {thread_key}")
-        if thread_key in stop_events:
-            stop_events[thread_key].set()  # Signal the thread to stop
-        program_threads[thread_key].join(timeout=2)  # Wait for it to stop
+        log.info("Stopping existing program: %s", thread_key)
+        stop_program_run(bulb_name, program)
+
+    # Claim the bulbs, preempting or layered under their current owners
+    if priority is not None:
+        priority = int(priority)
+    if bulb_name == "all_bulbs":
+        claimed = [name for name, info in bulbs.items() if "device" in info]
+    else:
+        claimed = [bulb_name]
+    for other_bulb, other_program in device_owners.claim(
+        (bulb_name, program), claimed, priority
+    ):
+        log.info("Preempting program: %s_%s", other_bulb, other_program)
+        stop_program_run(other_bulb, other_program, status="preempted")
 
     # Create a stop event
     stop_event = threading.Event()
     stop_events[thread_key] = stop_event
 
-    print(f"Created stop event: {thread_key}")
-
     # Start the program in a new thread
     thread = threading.Thread(
-        target=run_program, args=(program, bulb_name, duration, socketio), daemon=True
+        target=run_program, args=(program, bulb_name, duration), daemon=True
     )
     program_threads[thread_key] = thread
 
-    print(f"Starting thread for program: {thread_key}")
+    log.debug("Starting thread for program: %s", thread_key)
     thread.start()
 
+
+@app.route("/api/programs/run", methods=["POST"])
+def run_program_api():
+    """Run a lighting program"""
+    data = request_data()
+    log.debug("Program run request: %s", data)
+
+    if not all(key in data for key in ["program", "bulb"]):
+        error_msg = "Program and bulb name must be provided"
+        log.warning("API error: %s", error_msg)
+        return jsonify({"error": error_msg}), 400
+
+    program = data["program"]
+    bulb_name = data["bulb"]
+    duration = data.get("duration", 60)  # Default 60 seconds if not specified
+    priority = data.get("priority")
+    try:
+        start_program(program, bulb_name, duration, priority)
+    except LookupError as e:
+        error_msg = e.args[0]
+        log.warning("API error: %s", error_msg)
+        return jsonify({"error": error_msg}), 404
+
     return jsonify(
         {
             "status": "success",
@@ -485,7 +994,7 @@ def run_program_api():
 @app.route("/api/programs/stop", methods=["POST"])
 def stop_program():
     """Stop a running program"""
-    data = request.json
+    data = request_data()
     if not all(key in data for key in ["program", "bulb"]):
         return jsonify({"error": "Program and bulb name must be provided"}), 400
 
@@ -494,22 +1003,7 @@ def stop_program():
 
     thread_key = f"{bulb_name}_{program}"
     if thread_key in program_threads and program_threads[thread_key].is_alive():
-        if thread_key in stop_events:
-            stop_events[thread_key].set()  # Signal the thread to stop
-
-        # Wait for the thread to stop
-        program_threads[thread_key].join(timeout=2)
-
-        # Clean up
-        if thread_key in program_threads:
-            del program_threads[thread_key]
-        if thread_key in stop_events:
-            del stop_events[thread_key]
-
-        socketio.emit(
-            "program_status",
-            {"bulb": bulb_name, "program": program, "status": "stopped"},
-        )
+        stop_program_run(bulb_name, program)
 
         return jsonify({"status": "success", "message": f"Program {program} stopped"})
 
@@ -524,26 +1018,415 @@ def stop_program():
     )
 
 
+@socketio.on("connect")
+def on_connect():
+    """New clients watch every bulb at the default event rate"""
+    bulb_events.subscribe(request.sid)
+
+
+@socketio.on("disconnect")
+def on_disconnect(reason=None):
+    bulb_events.unsubscribe(request.sid)
+
+
+@socketio.on("subscribe")
+def on_subscribe(data):
+    """Choose the bulbs a client gets updates for and how often
+
+    Args:
+        data: {"bulbs": [names] or null for all, "max_rate": events per second}
+    """
+    data = data or {}
+    room = bulb_events.subscribe(request.sid, data.get("bulbs"), data.get("max_rate"))
+    return {"room": room}
+
+
+def parse_live_value(attr, value):
+    """Validate a streamed control value, raising ValueError if it is bad"""
+    if attr == "color":
+        return {key: max(0, min(255, int(value[key]))) for key in "rgb"}
+    if attr == "power":
+        return bool(value)
+    return int(value)
+
+
+def live_applied(bulb_name, attr, value, sid, result, error):
+    """Record a finished live command, or tell its sender that it failed"""
+    if error is None and result:
+        state = bulbs[bulb_name]["state"]
+        if attr == "color":
+            state.set_rgb(value["r"], value["g"], value["b"])
+        else:
+            state.update(**{attr: value})
+        publish(bulb_name, {attr: value})
+    else:
+        emit(
+            "control_error",
+            {"bulb": bulb_name, "attr": attr, "error": str(error or result)},
+            to=sid,
+        )
+
+
+# Streamed slider and color picker values, sent at the rate each bulb sustains
+live_control = LiveControl(
+    command_queues,
+    {
+        "brightness": set_brightness,
+        "temperature": set_temperature,
+        "color": set_color_value,
+        "power": set_power,
+    },
+    on_done=live_applied,
+)
+
+
+@socketio.on("control")
+def on_control(data):
+    """Stream a live value from a slider or color picker
+
+    Args:
+        data: {"bulb": name, "attr": brightness, temperature, color or
+            power, "value": the value}
+    """
+    data = data or {}
+    bulb_name = data.get("bulb")
+    attr = data.get("attr")
+    if bulb_name in bulbs and is_remote(bulb_name):
+        return forward_control(bulb_name, attr, data.get("value"))
+    if bulb_name not in bulbs or "device" not in bulbs[bulb_name]:
+        return {"error": f"Bulb {bulb_name} not found or offline"}
+    if attr not in live_control.commands:
+        return {"error": f"Unknown control {attr}"}
+    try:
+        value = parse_live_value(attr, data.get("value"))
+    except (TypeError, ValueError, KeyError):
+        return {"error": f"Invalid {attr} value"}
+    live_control.update(bulb_name, attr, value, request.sid)
+    return {"status": "queued"}
+
+
+def forward_control(bulb_name, attr, value):
+    """Pass a live value for a bulb owned elsewhere to its owner"""
+    payload = {"attr": attr, "value": value}
+    if not forward_later(bulb_name, f"/api/bulbs/{bulb_name}/control", payload):
+        return {"error": f"No instance owns {bulb_name} right now"}
+    return {"status": "queued"}
+
+
+@app.route("/api/bulbs/<bulb_name>/control", methods=["POST"])
+def control_bulb(bulb_name):
+    """Take a live value the way the control event does: {"attr", "value"}"""
+    if bulb_name not in bulbs or "device" not in bulbs[bulb_name]:
+        return jsonify({"error": f"Bulb {bulb_name} not found or offline"}), 404
+    data = request_data() or {}
+    attr = data.get("attr")
+    if attr not in live_control.commands:
+        return jsonify({"error": f"Unknown control {attr}"}), 400
+    try:
+        value = parse_live_value(attr, data.get("value"))
+    except (TypeError, ValueError, KeyError):
+        return jsonify({"error": f"Invalid {attr} value"}), 400
+    live_control.update(bulb_name, attr, value)
+    return jsonify({"status": "queued"}), 202
+
+
+@app.route("/api/bulbs/<bulb_name>/scene", methods=["POST"])
+def scene_bulb(bulb_name):
+    """Apply a scene the way schedules do: {"intents": [[attr, value], ...]}
+
+    Instances forward the scenes of their schedules to the bulb's owner here.
+    """
+    if bulb_name not in bulbs:
+        return jsonify({"error": f"Bulb {bulb_name} not found"}), 404
+    try:
+        intents = collections.OrderedDict(
+            (attr, journal_value(attr, value))
+            for attr, value in (request_data() or {}).get("intents", ())
+            if attr in live_control.commands
+        )
+    except (TypeError, ValueError, KeyError):
+        return jsonify({"error": "Invalid scene"}), 400
+    if not intents:
+        return jsonify({"error": "Scene sets nothing"}), 400
+    if apply_scene(bulb_name, intents) is None:
+        return jsonify({"status": "journaled"}), 202
+    return jsonify({"status": "queued"}), 202
+
+
+def journal_value(attr, value):
+    """A control value in the form the journal and scenes keep"""
+    value = parse_live_value(attr, value)
+    return [value["r"], value["g"], value["b"]] if attr == "color" else value
+
+
+def apply_scene(bulb_name, intents):
+    """Write a bulb's target state in one message, without waiting for it
+
+    Args:
+        bulb_name: Bulb to write to
+        intents: Ordered {attr: value} in journal form
+
+    Returns:
+        The Future of the write, or None if the bulb is unreachable and the
+        intents were journaled instead, or it is owned by another instance
+        and the scene was forwarded to the owner
+    """
+    if is_remote(bulb_name):
+        # Ordered pairs, so the owner applies them in the same order
+        payload = {"intents": list(intents.items())}
+        if not forward_later(bulb_name, f"/api/bulbs/{bulb_name}/scene", payload):
+            log.warning("No instance owns %s, scene not applied", bulb_name)
+        return None
+    if not is_reachable(bulb_name):
+        for attr, value in intents.items():
+            journal.record(bulb_name, attr, value)
+        return None
+    state = bulbs[bulb_name]["state"]
+    dps = journal_dps(intents, state.mode, state.hsv)
+    future = command_queues.submit(bulb_name, set_dps, dps, lane=AUTOMATION)
+    future.add_done_callback(lambda f: scene_applied(bulb_name, intents, dps, f))
+    return future
+
+
+def scene_applied(bulb_name, intents, dps, future):
+    """Record a finished scene write, journaling it if the bulb missed it"""
+    if not future.cancelled() and future.exception() is None and future.result():
+        state = bulbs[bulb_name]["state"]
+        state.apply_dps(dps)
+        publish(bulb_name, state.as_dict())
+        return
+    for attr, value in intents.items():
+        journal.record(bulb_name, attr, value)
+    mark_unreachable(bulb_name, "Scene write failed")
+
+
+def check_action(action):
+    """Raise ValueError unless the server can carry out a schedule action"""
+    kind = action.get("type")
+    if kind == "command":
+        if action.get("bulb") != "all_bulbs" and action.get("bulb") not in bulbs:
+            raise ValueError(f"Bulb {action.get('bulb')} not found")
+        if action.get("attr") not in live_control.commands:
+            raise ValueError(f"Unknown attribute {action.get('attr')}")
+        journal_value(action["attr"], action.get("value"))
+    elif kind == "scene":
+        targets = action.get("bulbs")
+        if not isinstance(targets, dict) or not targets:
+            raise ValueError("A scene needs {bulb: {attr: value}}")
+        for bulb_name, values in targets.items():
+            if bulb_name not in bulbs:
+                raise ValueError(f"Bulb {bulb_name} not found")
+            for attr, value in values.items():
+                if attr not in live_control.commands:
+                    raise ValueError(f"Unknown attribute {attr}")
+                journal_value(attr, value)
+    elif kind == "program":
+        if action.get("program") not in program_registry:
+            raise ValueError(f"Program {action.get('program')} not found")
+        if action.get("bulb") != "all_bulbs" and action.get("bulb") not in bulbs:
+            raise ValueError(f"Bulb {action.get('bulb')} not found")
+    else:
+        raise ValueError('Action type must be "command", "scene" or "program"')
+
+
+# Order the attributes of a scene are applied in
+SCENE_ORDER = ("color", "temperature", "brightness", "power")
+
+
+def run_scheduled(action):
+    """Carry out a schedule's action; bulb writes are queued, not awaited"""
+    kind = action["type"]
+    if kind == "command":
+        attr = action["attr"]
+        value = journal_value(attr, action["value"])
+        if action["bulb"] == "all_bulbs":
+            targets = list(bulbs)
+        else:
+            targets = [action["bulb"]]
+        for bulb_name in targets:
+            apply_scene(bulb_name, {attr: value})
+    elif kind == "scene":
+        for bulb_name, values in action["bulbs"].items():
+            # A scene is a state, not a sequence: set the mode before the
+            # brightness within it, whatever order the JSON keys came in
+            intents = collections.OrderedDict(
+                (attr, journal_value(attr, values[attr]))
+                for attr in SCENE_ORDER
+                if attr in values
+            )
+            apply_scene(bulb_name, intents)
+    elif kind == "program":
+        if action["bulb"] == "all_bulbs":
+            remote = [bulb_name for bulb_name in bulbs if is_remote(bulb_name)]
+        else:
+            remote = [action["bulb"]] if is_remote(action["bulb"]) else []
+        # Bulbs owned elsewhere run the program on their owner
+        for bulb_name in remote:
+            payload = {"program": action["program"], "bulb": bulb_name}
+            for key in ("duration", "priority"):
+                if key in action:
+                    payload[key] = action[key]
+            if not forward_later(bulb_name, "/api/programs/run", payload):
+                log.warning("No instance owns %s, program not started", bulb_name)
+        if remote and action["bulb"] != "all_bulbs":
+            return
+        start_program(
+            action["program"],
+            action["bulb"],
+            action.get("duration", 60),
+            action.get("priority"),
+        )
+
+
+# Commands, scenes and programs at fixed times, sun times or intervals
+scheduler = Scheduler(run_scheduled, check_action)
+
+
+@app.route("/api/schedules", methods=["GET"])
+def get_schedules():
+    """Every schedule with its next run, and the scheduler's timing stats"""
+    return jsonify({"schedules": scheduler.schedules(), "stats": scheduler.stats()})
+
+
+@app.route("/api/schedules", methods=["POST"])
+def add_schedule():
+    """Create a schedule from {"name", "trigger", "action", "enabled"}"""
+    try:
+        schedule = scheduler.add(request_data() or {})
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(schedule), 201
+
+
+@app.route("/api/schedules/<schedule_id>", methods=["PATCH"])
+def update_schedule(schedule_id):
+    """Pause or resume a schedule with {"enabled": bool}"""
+    data = request_data() or {}
+    if "enabled" not in data:
+        return jsonify({"error": "Only enabled can be changed"}), 400
+    try:
+        return jsonify(scheduler.set_enabled(schedule_id, data["enabled"]))
+    except KeyError:
+        return jsonify({"error": f"Schedule {schedule_id} not found"}), 404
+
+
+@app.route("/api/schedules/<schedule_id>", methods=["DELETE"])
+def delete_schedule(schedule_id):
+    if not scheduler.remove(schedule_id):
+        return jsonify({"error": f"Schedule {schedule_id} not found"}), 404
+    return jsonify({"status": "success"})
+
+
+@app.route("/api/schedules/<schedule_id>/run", methods=["POST"])
+def run_schedule_now(schedule_id):
+    """Run a schedule's action now, outside its timing"""
+    try:
+        scheduler.get(schedule_id)
+    except KeyError:
+        return jsonify({"error": f"Schedule {schedule_id} not found"}), 404
+    try:
+        scheduler.run_now(schedule_id)
+    except LookupError as e:
+        return jsonify({"error": e.args[0]}), 404
+    return jsonify({"status": "success"})
+
+
+def shutdown():
+    """Stop programs and drain queued commands before exiting
+
+    New requests are refused with 503 while the command queues send what
+    is already queued, bounded by SHUTDOWN_TIMEOUT.
+    """
+    shutting_down.set()
+    # Stop all running programs
+    for key, event in list(stop_events.items()):
+        event.set()
+    for key, thread in list(program_threads.items()):
+        thread.join(timeout=1)
+    if program_pool is not None:
+        program_pool.close()
+    live_control.close()
+    supervisor.stop()
+    scheduler.stop()
+    command_queues.close(drain=True, timeout=SHUTDOWN_TIMEOUT)
+    if leases is not None:
+        # Sockets are closed; hand the bulbs to the other instances now
+        leases.stop()
+    bulb_events.stop()
+
+
+def run_server(host, port, production=False, workers=HTTP_WORKERS):
+    """Serve the app with the development or the production settings
+
+    Args:
+        production: Turn off debug mode and request logging
+        workers: Size of the eventlet or gevent connection pool; the
+            threading server starts a thread per connection instead
+    """
+    options = {"debug": not production, "use_reloader": False}
+    if production:
+        options["log_output"] = False
+    if ASYNC_MODE == "eventlet":
+        options["max_size"] = workers
+    elif ASYNC_MODE == "gevent":
+        options["spawn"] = workers
+    else:
+        options["allow_unsafe_werkzeug"] = True
+        if production:
+            log.warning(
+                "Serving with threading; set SMARTHOME_ASYNC_MODE=eventlet "
+                "or gevent for a production worker"
+            )
+    bulb_events.start()
+    scheduler.start()
+    socketio.run(app, host=host, port=port, **options)
+
+
 # Main entry point
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tuya Smart Bulb Server")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        default=os.environ.get("SMARTHOME_PRODUCTION") == "1",
+        help="debug off, quiet request log (or set SMARTHOME_PRODUCTION=1)",
+    )
+    parser.add_argument("--host", default=os.environ.get("SMARTHOME_HOST", "0.0.0.0"))
+    parser.add_argument(
+        "--port", type=int, default=int(os.environ.get("SMARTHOME_PORT", "3456"))
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=HTTP_WORKERS,
+        help="concurrent connections for eventlet or gevent",
+    )
+    args = parser.parse_args()
+
+    # Request logging stays at INFO in development and is quiet in production
+    configure_logging(modules={"werkzeug": "WARNING"} if args.production else None)
+
+    # Share the bulbs with other instances if a lease database is set
+    setup_leases(args.host, args.port)
+
     # Initialize devices
-    print("Initializing smart bulb devices...")
+    log.info("Initializing smart bulb devices...")
     initialize_devices()
-    print(f"Found {len(bulbs)} bulbs")
+    log.info("Found %d bulbs", len(bulbs))
 
     # Set up signal handler for clean exit
     def signal_handler(sig, frame):
-        print("Shutting down...")
-        # Stop all running programs
-        for key, event in stop_events.items():
-            event.set()
-        for key, thread in program_threads.items():
-            thread.join(timeout=1)
+        log.info("Shutting down...")
+        shutdown()
         # Exit
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     # Start the server
-    print("Starting server on http://0.0.0.0:3456")
-    socketio.run(app, host="0.0.0.0", port=3456, debug=True, use_reloader=False)
+    mode = "production" if args.production else "development"
+    log.info(
+        "Starting %s server (%s) on http://%s:%s", mode, ASYNC_MODE, args.host, args.port
+    )
+    run_server(args.host, args.port, args.production, args.workers)
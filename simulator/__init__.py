@@ -0,0 +1,3 @@
+"""
+Simulated Tuya devices for running the package without physical bulbs.
+"""
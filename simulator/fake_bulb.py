@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+"""
+Fake Tuya Bulb Simulator
+
+Serves the Tuya local protocol (versions 3.3, 3.4 and 3.5) on localhost and
+keeps the state of DPS 20-25 like a real colour bulb, so the server, the CLI
+and the programs can run end to end on a machine with no bulbs. Latency,
+jitter, dropped commands and rate limits are configurable per bulb.
+Simulated light strips also keep a segment data point (DPS 61) holding an
+hsv16 color per segment.
+
+Messages are framed with tinytuya's pack_message/unpack_message. The
+6699 framing of 3.5 (an 8-field TuyaMessage with its prefix) and the
+UDP_NEW broadcast command only exist in recent releases, so
+requirements.txt pins the tinytuya version this was tested with.
+
+Usage:
+    python -m simulator.fake_bulb [options]
+
+Examples:
+    python -m simulator.fake_bulb --count 3 --write-devices devices.json
+    python -m simulator.fake_bulb --count 2 --version 3.3 --latency 0.05 --drop-rate 0.02
+    python -m simulator.fake_bulb --count 2 --broadcast 127.0.0.1  # announce on UDP
+    python -m simulator.fake_bulb --count 1 --strips 1 --segments 30
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import hmac
+from hashlib import sha256
+
+import tinytuya
+
+# Tuya command numbers (see tinytuya's command_types)
+SESS_KEY_NEG_START = 3
+SESS_KEY_NEG_RESP = 4
+SESS_KEY_NEG_FINISH = 5
+CONTROL = 7
+STATUS = 8
+HEART_BEAT = 9
+DP_QUERY = 10
+CONTROL_NEW = 13
+DP_QUERY_NEW = 16
+UPDATEDPS = 18
+
+PREFIX_55AA = 0x000055AA
+PREFIX_6699 = 0x00006699
+HEADER_55AA_LEN = 16
+HEADER_6699_LEN = 18
+
+# Commands whose payload carries no "3.x" version header
+NO_VERSION_HEADER_CMDS = (
+    DP_QUERY,
+    DP_QUERY_NEW,
+    UPDATEDPS,
+    HEART_BEAT,
+    SESS_KEY_NEG_START,
+    SESS_KEY_NEG_RESP,
+    SESS_KEY_NEG_FINISH,
+)
+
+DEFAULT_PORT = 6668
+
+# What an overloaded bulb does with commands over its rate limit
+OVERLOAD_ACTIONS = ("drop", "reset")
+
+# Seconds between discovery broadcasts, about what real bulbs use
+BROADCAST_INTERVAL = 5.0
+
+# Data point of a strip's segment colors and the hex digits per segment
+SEGMENT_DP = "61"
+SEGMENT_HEX = 12
+
+
+def initial_dps():
+    """Power-on state of a colour bulb (DPS 20-25)"""
+    return {
+        "20": True,
+        "21": "white",
+        "22": 1000,
+        "23": 500,
+        "24": "000003e803e8",
+        "25": "000e0d0000000000000000c803e8",
+    }
+
+
+class TokenBucket:
+    """Simple token bucket; rate is in commands per second"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeBulb:
+    """One simulated bulb listening on its own TCP port"""
+
+    def __init__(
+        self,
+        name,
+        device_id,
+        local_key,
+        version="3.5",
+        host="127.0.0.1",
+        port=DEFAULT_PORT,
+        latency=0.02,
+        jitter=0.0,
+        drop_rate=0.0,
+        rate_limit=None,
+        overload="drop",
+        segments=None,
+    ):
+        """
+        Args:
+            name: Bulb name written to devices.json
+            device_id: Tuya device id
+            local_key: 16 character local key
+            version: Protocol version, "3.3", "3.4" or "3.5"
+            host, port: Address to listen on
+            latency: Seconds before each reply
+            jitter: Maximum random variation added to the latency
+            drop_rate: Fraction of commands silently ignored
+            rate_limit: Commands per second accepted, or None for no limit
+            overload: "drop" ignores commands over the limit, "reset"
+                closes the connection like many cheap bulbs do
+            segments: Number of segments to simulate a light strip, or
+                None for a bulb
+        """
+        if str(version) not in ("3.3", "3.4", "3.5"):
+            raise ValueError(f"Unsupported protocol version: {version}")
+        if overload not in OVERLOAD_ACTIONS:
+            raise ValueError(f"Unknown overload action: {overload}")
+
+        self.name = name
+        self.device_id = device_id
+        self.local_key = local_key.encode("latin1")
+        self.version = str(version)
+        self.version_header = self.version.encode() + 12 * b"\x00"
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.overload = overload
+
+        self.segments = segments
+        self.dps = initial_dps()
+        if segments:
+            self.dps[SEGMENT_DP] = "000003e803e8" * segments
+        self.state_lock = threading.Lock()
+        self.commands_received = 0
+        self.commands_dropped = 0
+        self._seqno = 0
+        self._server = None
+        self._running = False
+
+    def device_entry(self):
+        """The devices.json entry that points at this bulb"""
+        entry = {
+            "name": self.name,
+            "id": self.device_id,
+            "key": self.local_key.decode("latin1"),
+            "ip": self.host,
+            "port": self.port,
+            "version": self.version,
+            "category": "dj",
+            "product_name": "Simulated Bulb",
+        }
+        if self.segments:
+            entry.update(
+                category="dc", product_name="Simulated Strip", segments=self.segments
+            )
+        return entry
+
+    def discovery_packet(self):
+        """The UDP broadcast a real bulb of this version sends to announce itself"""
+        body = json.dumps(
+            {
+                "ip": self.host,
+                "gwId": self.device_id,
+                "active": 2,
+                "encrypt": True,
+                "productKey": "simulated",
+                "version": self.version,
+            }
+        ).encode()
+        if self.version == "3.5":
+            msg = tinytuya.TuyaMessage(
+                0, tinytuya.UDP_NEW, 0, body, 0, True, PREFIX_6699, None
+            )
+            return tinytuya.pack_message(msg, hmac_key=tinytuya.udpkey)
+        payload = tinytuya.AESCipher(tinytuya.udpkey).encrypt(body, False)
+        # Device messages carry a return code before the payload
+        msg = tinytuya.TuyaMessage(
+            0, tinytuya.UDP_NEW, 0, b"\x00" * 4 + payload, 0, True, PREFIX_55AA, None
+        )
+        return tinytuya.pack_message(msg)
+
+    # Server lifecycle
+
+    def start(self):
+        """Start listening in a background thread"""
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.host, self.port))
+        self._server.listen(8)
+        self.port = self._server.getsockname()[1]
+        self._running = True
+        threading.Thread(
+            target=self._accept_loop, name=f"fake-{self.name}", daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self._serve, args=(conn,), daemon=True
+            ).start()
+
+    # Connection handling
+
+    def _serve(self, conn):
+        session = {"key": self.local_key, "local_nonce": None, "remote_nonce": None}
+        try:
+            while self._running:
+                msg = self._read_message(conn, session)
+                if msg is None:
+                    return
+                if not self._handle(conn, session, msg):
+                    return
+        except (OSError, ValueError, tinytuya.DecodeError):
+            return
+        finally:
+            conn.close()
+
+    def _recv_exact(self, conn, length):
+        data = b""
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_message(self, conn, session):
+        head = self._recv_exact(conn, HEADER_55AA_LEN)
+        if head is None:
+            return None
+        if head[:4] == struct.pack(">I", PREFIX_6699):
+            rest = self._recv_exact(conn, HEADER_6699_LEN - HEADER_55AA_LEN)
+            if rest is None:
+                return None
+            head += rest
+        header = tinytuya.parse_header(head)
+        body = self._recv_exact(conn, header.total_length - len(head))
+        if body is None:
+            return None
+        hmac_key = session["key"] if self.version != "3.3" else None
+        return tinytuya.unpack_message(
+            head + body, hmac_key=hmac_key, header=header, no_retcode=True
+        )
+
+    def _decode(self, session, msg):
+        """Strip the version header and decrypt a client payload"""
+        payload = msg.payload
+        if self.version == "3.3":
+            if payload.startswith(self.version_header):
+                payload = payload[len(self.version_header) :]
+            if payload:
+                payload = tinytuya.AESCipher(self.local_key).decrypt(
+                    payload, False, decode_text=False
+                )
+        else:
+            if self.version == "3.4" and payload:
+                payload = tinytuya.AESCipher(session["key"]).decrypt(
+                    payload, False, decode_text=False
+                )
+            if payload.startswith(self.version_header):
+                payload = payload[len(self.version_header) :]
+        return payload
+
+    def _encode(self, session, cmd, payload, header=False):
+        """Frame, encrypt and sign a reply"""
+        self._seqno += 1
+        if header:
+            payload = self.version_header + payload if self.version != "3.3" else payload
+
+        if self.version == "3.5":
+            msg = tinytuya.TuyaMessage(
+                self._seqno, cmd, 0, payload, 0, True, PREFIX_6699, True
+            )
+            return tinytuya.pack_message(msg, hmac_key=session["key"])
+
+        if self.version == "3.4":
+            if payload:
+                payload = tinytuya.AESCipher(session["key"]).encrypt(payload, False)
+            hmac_key = session["key"]
+        else:
+            if payload:
+                payload = tinytuya.AESCipher(self.local_key).encrypt(payload, False)
+                if header:
+                    payload = self.version_header + payload
+            hmac_key = None
+
+        msg = tinytuya.TuyaMessage(
+            self._seqno, cmd, 0, struct.pack(">I", 0) + payload, 0, True, PREFIX_55AA
+        )
+        return tinytuya.pack_message(msg, hmac_key=hmac_key)
+
+    def _reply(self, conn, frames):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        conn.sendall(b"".join(frames))
+
+    def _handle(self, conn, session, msg):
+        """Process one client message; returns False to close the connection"""
+        cmd = msg.cmd
+
+        if cmd == SESS_KEY_NEG_START:
+            return self._negotiate_start(conn, session, msg)
+        if cmd == SESS_KEY_NEG_FINISH:
+            self._negotiate_finish(session)
+            return True
+
+        self.commands_received += 1
+        if self.bucket is not None and not self.bucket.take():
+            self.commands_dropped += 1
+            return self.overload != "reset"
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.commands_dropped += 1
+            return True
+
+        payload = self._decode(session, msg)
+        request = json.loads(payload) if payload.strip() else {}
+
+        if cmd == HEART_BEAT:
+            self._reply(conn, [self._encode(session, HEART_BEAT, b"")])
+        elif cmd in (DP_QUERY, DP_QUERY_NEW):
+            with self.state_lock:
+                body = {"devId": self.device_id, "dps": dict(self.dps)}
+            self._reply(conn, [self._encode(session, cmd, self._json(body))])
+        elif cmd in (CONTROL, CONTROL_NEW):
+            dps = request.get("dps") or request.get("data", {}).get("dps") or {}
+            changed = self.apply(dps)
+            frames = [self._encode(session, cmd, b"")]
+            if changed:
+                frames.append(
+                    self._encode(session, STATUS, self._status_json(changed), header=True)
+                )
+            self._reply(conn, frames)
+        elif cmd == UPDATEDPS:
+            with self.state_lock:
+                dps = dict(self.dps)
+            frames = [
+                self._encode(session, cmd, b""),
+                self._encode(session, STATUS, self._status_json(dps), header=True),
+            ]
+            self._reply(conn, frames)
+        else:
+            self._reply(conn, [self._encode(session, cmd, b"")])
+        return True
+
+    def _negotiate_start(self, conn, session, msg):
+        local_nonce = msg.payload
+        if self.version == "3.4":
+            local_nonce = tinytuya.AESCipher(self.local_key).decrypt(
+                local_nonce, False, decode_text=False
+            )
+        session["local_nonce"] = local_nonce[:16]
+        session["remote_nonce"] = os.urandom(16)
+        session["key"] = self.local_key
+
+        payload = session["remote_nonce"] + hmac.new(
+            self.local_key, session["local_nonce"], sha256
+        ).digest()
+        self._reply(conn, [self._encode(session, SESS_KEY_NEG_RESP, payload)])
+        return True
+
+    def _negotiate_finish(self, session):
+        xored = bytes(
+            a ^ b for a, b in zip(session["local_nonce"], session["remote_nonce"])
+        )
+        cipher = tinytuya.AESCipher(self.local_key)
+        if self.version == "3.4":
+            session["key"] = cipher.encrypt(xored, False, pad=False)
+        else:
+            iv = session["local_nonce"][:12]
+            session["key"] = cipher.encrypt(xored, use_base64=False, pad=False, iv=iv)[
+                12:28
+            ]
+
+    # Device state
+
+    def apply(self, dps):
+        """Apply a DPS update with the ranges a real bulb enforces
+
+        Returns:
+            The DPS values that were set
+        """
+        changed = {}
+        with self.state_lock:
+            for key, value in dps.items():
+                key = str(key)
+                if key == "20":
+                    value = bool(value)
+                elif key == "21" and value not in ("white", "colour", "scene", "music"):
+                    continue
+                elif key == "22":
+                    value = max(10, min(1000, int(value)))
+                elif key == "23":
+                    value = max(0, min(1000, int(value)))
+                elif key in ("24", "25"):
+                    value = str(value)
+                elif key == SEGMENT_DP and self.segments:
+                    # Frames must color every segment
+                    value = str(value)
+                    if len(value) != SEGMENT_HEX * self.segments:
+                        continue
+                elif key not in self.dps:
+                    continue
+                self.dps[key] = value
+                changed[key] = value
+        return changed
+
+    def _status_json(self, dps):
+        if self.version == "3.3":
+            body = {"devId": self.device_id, "dps": dps, "t": int(time.time())}
+        else:
+            body = {"protocol": 4, "t": int(time.time()), "data": {"dps": dps}}
+        return self._json(body)
+
+    @staticmethod
+    def _json(body):
+        return json.dumps(body, separators=(",", ":")).encode()
+
+
+def make_bulbs(
+    count,
+    version="3.5",
+    host="127.0.0.1",
+    base_port=DEFAULT_PORT,
+    prefix="sim",
+    **options,
+):
+    """Create a set of simulated bulbs on consecutive ports
+
+    Extra keyword arguments are passed to FakeBulb (latency, jitter,
+    drop_rate, rate_limit, overload, segments). A base_port of 0 picks free
+    ports.
+    """
+    bulbs = []
+    for i in range(count):
+        rng = random.Random(f"{prefix}{i}")
+        device_id = f"{prefix}{i:03d}" + "".join(
+            rng.choice("0123456789abcdef") for _ in range(20 - len(prefix) - 3)
+        )
+        local_key = "".join(rng.choice("0123456789abcdefghijk") for _ in range(16))
+        bulbs.append(
+            FakeBulb(
+                f"{prefix}{i + 1}",
+                device_id,
+                local_key,
+                version=version,
+                host=host,
+                port=base_port + i if base_port else 0,
+                **options,
+            )
+        )
+    return bulbs
+
+
+def broadcast(bulbs, address="255.255.255.255", interval=BROADCAST_INTERVAL, stop=None):
+    """Announce the bulbs on UDP port 6667 until stop is set
+
+    Args:
+        bulbs: FakeBulbs to announce
+        address: Broadcast address, or a unicast one such as 127.0.0.1
+        interval: Seconds between rounds of announcements
+        stop: Optional threading.Event that ends the loop
+    """
+    stop = stop or threading.Event()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        while not stop.is_set():
+            for bulb in bulbs:
+                try:
+                    sock.sendto(bulb.discovery_packet(), (address, tinytuya.UDPPORTS))
+                except OSError:
+                    pass
+            stop.wait(interval)
+
+
+def write_devices(bulbs, path):
+    """Write a devices.json that points at the simulated bulbs"""
+    with open(path, "w") as f:
+        json.dump([bulb.device_entry() for bulb in bulbs], f, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate Tuya bulbs on localhost")
+    parser.add_argument("--count", type=int, default=3, help="number of bulbs")
+    parser.add_argument(
+        "--strips", type=int, default=0, help="number of light strips (after bulbs)"
+    )
+    parser.add_argument(
+        "--segments", type=int, default=20, help="segments of each light strip"
+    )
+    parser.add_argument("--version", default="3.5", choices=("3.3", "3.4", "3.5"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--prefix", default="sim", help="bulb name prefix")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="0.0-1.0")
+    parser.add_argument(
+        "--rate-limit", type=float, default=None, help="commands per second"
+    )
+    parser.add_argument("--overload", default="drop", choices=OVERLOAD_ACTIONS)
+    parser.add_argument(
+        "--write-devices", metavar="PATH", help="write a devices.json for the bulbs"
+    )
+    parser.add_argument(
+        "--broadcast",
+        metavar="ADDRESS",
+        nargs="?",
+        const="255.255.255.255",
+        help="announce the bulbs on UDP like real bulbs (default: broadcast)",
+    )
+    args = parser.parse_args()
+
+    bulbs = make_bulbs(
+        args.count,
+        version=args.version,
+        host=args.host,
+        base_port=args.base_port,
+        prefix=args.prefix,
+        latency=args.latency,
+        jitter=args.jitter,
+        drop_rate=args.drop_rate,
+        rate_limit=args.rate_limit,
+        overload=args.overload,
+    )
+    if args.strips:
+        bulbs += make_bulbs(
+            args.strips,
+            version=args.version,
+            host=args.host,
+            base_port=args.base_port + args.count if args.base_port else 0,
+            prefix=f"{args.prefix}strip",
+            latency=args.latency,
+            jitter=args.jitter,
+            drop_rate=args.drop_rate,
+            rate_limit=args.rate_limit,
+            overload=args.overload,
+            segments=args.segments,
+        )
+    for bulb in bulbs:
+        bulb.start()
+        print(f"Simulating {bulb.name} (v{bulb.version}) on {bulb.host}:{bulb.port}")
+
+    if args.write_devices:
+        write_devices(bulbs, args.write_devices)
+        print(f"Wrote {len(bulbs)} devices to {args.write_devices}")
+
+    if args.broadcast:
+        threading.Thread(
+            target=broadcast, args=(bulbs, args.broadcast), daemon=True
+        ).start()
+        print(f"Announcing bulbs to {args.broadcast}:{tinytuya.UDPPORTS}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nStopping simulator...")
+        for bulb in bulbs:
+            bulb.stop()
+
+
+if __name__ == "__main__":
+    main()
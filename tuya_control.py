@@ -33,6 +33,7 @@ import sys
 import os
 from utils.device_manager import setup_devices, connect_device
 from commands.actions import perform_action
+from utils.log_config import configure_logging
 
 
 def print_usage():
@@ -54,6 +55,9 @@ Commands:
 
 
 def main():
+    # Command results are logged at DEBUG, which the CLI shows by default
+    configure_logging(modules={"commands": "DEBUG"})
+
     # Check if devices.json exists
     if not os.path.exists("devices.json"):
         print("Error: devices.json not found.")
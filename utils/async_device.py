@@ -0,0 +1,464 @@
+"""
+Asyncio client for the Tuya local protocol.
+
+AsyncTuyaDevice talks to one device over a non-blocking connection. It
+negotiates the session key (3.4 and 3.5), frames and encrypts requests and
+matches replies to the requests waiting for them, so hundreds of commands
+can be in flight on one event loop without a thread each. Payload
+generation and the ciphers are tinytuya's; only the transport is replaced.
+
+This reuses tinytuya internals (the _negotiate_session_key_generate_*
+steps, _encode_message and _decode_payload) that are not part of its
+public API and can change in any release, so requirements.txt pins the
+tinytuya minor version this client was tested with. Check these methods
+before raising the pin.
+
+LoopBulbDevice is a tinytuya.BulbDevice whose network calls run on a
+shared background event loop, so everything written against BulbDevice
+(bulb_commands, the programs, the command queues) uses the asyncio client
+without changes.
+"""
+
+import asyncio
+import collections
+import logging
+import socket
+import threading
+import time
+
+import tinytuya
+
+from utils import color_encoding
+
+# Requests whose reply may be a bare acknowledgement followed by the
+# status as a separate STATUS message
+QUERY_COMMANDS = (tinytuya.DP_QUERY, tinytuya.DP_QUERY_NEW, tinytuya.UPDATEDPS)
+
+# Status messages kept for receive() when nobody is waiting for them
+PUSH_BACKLOG = 32
+
+# Seconds between a failed attempt and the retry
+RETRY_DELAY = 0.1
+
+POWER_DP = 20
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTuyaDevice:
+    """One Tuya device on an asyncio connection
+
+    Results match tinytuya's: the decoded JSON reply, None for a bare
+    acknowledgement, or a tinytuya error dict with an "Error" key.
+    """
+
+    def __init__(
+        self,
+        dev_id,
+        address,
+        local_key,
+        version="3.5",
+        port=tinytuya.TCPPORT,
+        timeout=5,
+        retry_limit=2,
+        resolver=None,
+    ):
+        """
+        Args:
+            dev_id, address, local_key: As in devices.json
+            version: Protocol version, "3.3", "3.4" or "3.5"
+            port: TCP port of the device
+            timeout: Seconds to wait for a connection or a reply
+            retry_limit: Extra attempts after a failed request
+            resolver: Optional blocking callable(dev_id, failed_address)
+                returning the device's current address, asked when a
+                connection attempt fails
+        """
+        self.id = dev_id
+        self.address = address
+        self.port = port
+        self.version = float(version)
+        self.timeout = timeout
+        self.retry_limit = retry_limit
+        self.resolver = resolver
+        self.dps = {}  # Last known DPS from replies and status messages
+
+        # tinytuya builds the payloads and holds the keys and sequence number
+        self._codec = tinytuya.Device(
+            dev_id, address=address, local_key=local_key, version=self.version, port=port
+        )
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = None
+        self._pending = collections.OrderedDict()  # seqno -> (cmd, future)
+        self._status_waiters = collections.deque()
+        self._pushes = collections.deque(maxlen=PUSH_BACKLOG)
+        self._push_event = None
+        self._last_received = 0.0
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    # Connection
+
+    async def connect(self):
+        """Open the connection and negotiate a session key if needed"""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.connected:
+                return
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.address, self.port), self.timeout
+            )
+            sock = writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self._codec.local_key = self._codec.real_local_key
+            if self.version >= 3.4:
+                try:
+                    await asyncio.wait_for(
+                        self._negotiate(reader, writer), self.timeout
+                    )
+                except BaseException:
+                    writer.close()
+                    raise
+
+            self._reader = reader
+            self._writer = writer
+            self._read_task = asyncio.ensure_future(self._read_loop(reader, writer))
+
+    async def _negotiate(self, reader, writer):
+        codec = self._codec
+        writer.write(
+            codec._encode_message(codec._negotiate_session_key_generate_step_1())
+        )
+        await writer.drain()
+        step3 = codec._negotiate_session_key_generate_step_3(
+            await self._read_message(reader)
+        )
+        if not step3:
+            raise ConnectionError(f"Session key negotiation with {self.id} failed")
+        writer.write(codec._encode_message(step3))
+        await writer.drain()
+        codec._negotiate_session_key_generate_finalize()
+
+    async def close(self):
+        """Close the connection; the next request reconnects"""
+        self._drop_connection(ConnectionError(f"Connection to {self.id} closed"))
+
+    def _drop_connection(self, error, writer=None):
+        if writer is not None and writer is not self._writer:
+            return  # Already replaced by a newer connection
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_task is not None and self._read_task is not _current_task():
+            self._read_task.cancel()
+        self._reader = self._writer = self._read_task = None
+
+        waiting = [future for _, future in self._pending.values()]
+        waiting += self._status_waiters
+        self._pending.clear()
+        self._status_waiters.clear()
+        for future in waiting:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _reresolve(self):
+        """Pick up a new address for the device after a failed connect"""
+        if self.resolver is None:
+            return
+        loop = asyncio.get_running_loop()
+        address = await loop.run_in_executor(None, self.resolver, self.id, self.address)
+        if address and address != self.address:
+            log.info("%s moved from %s to %s", self.id, self.address, address)
+            self.address = self._codec.address = address
+
+    # Framing
+
+    async def _read_message(self, reader):
+        """Read one frame, resynchronising on the prefix if needed"""
+        data = await reader.readexactly(16)
+        while data[:4] not in (tinytuya.PREFIX_55AA_BIN, tinytuya.PREFIX_6699_BIN):
+            data = data[1:] + await reader.readexactly(1)
+        if data[:4] == tinytuya.PREFIX_6699_BIN:
+            data += await reader.readexactly(2)
+        header = tinytuya.parse_header(data)
+        data += await reader.readexactly(header.total_length - len(data))
+
+        hmac_key = self._codec.local_key if self.version >= 3.4 else None
+        msg = tinytuya.unpack_message(
+            data, header=header, hmac_key=hmac_key, no_retcode=False
+        )
+        if data[:4] == tinytuya.PREFIX_6699_BIN and not msg.crc_good:
+            raise tinytuya.DecodeError("GCM authentication failed")
+        return msg
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                msg = await self._read_message(reader)
+                self._last_received = time.monotonic()
+                self._dispatch(msg)
+        except (
+            asyncio.IncompleteReadError,
+            OSError,
+            ValueError,
+            tinytuya.DecodeError,
+        ) as e:
+            log.debug("Connection to %s lost: %r", self.id, e)
+            self._drop_connection(
+                ConnectionError(f"Connection to {self.id} lost: {e!r}"), writer
+            )
+
+    def _decode(self, msg):
+        if not msg.payload:
+            return None
+        try:
+            result = self._codec._decode_payload(msg.payload)
+        except Exception:
+            result = tinytuya.error_json(tinytuya.ERR_PAYLOAD)
+        if isinstance(result, dict) and isinstance(result.get("dps"), dict):
+            self.dps.update(result["dps"])
+        return result
+
+    def _dispatch(self, msg):
+        """Hand a received message to the request waiting for it"""
+        result = self._decode(msg)
+
+        if msg.cmd == tinytuya.STATUS:
+            while self._status_waiters:
+                future = self._status_waiters.popleft()
+                if not future.done():
+                    future.set_result(result)
+                    break
+            self._push(result)
+            return
+
+        entry = self._match(msg)
+        if entry is None:
+            self._push(result)
+            return
+        cmd, future = entry
+        if result is None and cmd in QUERY_COMMANDS:
+            # Bare acknowledgement; the status follows as a STATUS message
+            self._status_waiters.append(future)
+        elif not future.done():
+            future.set_result(result)
+
+    def _match(self, msg):
+        # Before 3.5 devices echo the request's sequence number; 3.5 devices
+        # use their own counter, so fall back to the oldest request of the
+        # same command
+        if self.version < 3.5:
+            entry = self._pending.get(msg.seqno)
+            if entry is not None and entry[0] == msg.cmd:
+                del self._pending[msg.seqno]
+                return entry
+        for seqno, entry in self._pending.items():
+            if entry[0] == msg.cmd:
+                del self._pending[seqno]
+                return entry
+        return None
+
+    def _push(self, result):
+        if result is None:
+            return
+        self._pushes.append(result)
+        if self._push_event is not None:
+            self._push_event.set()
+
+    # Requests
+
+    async def request(self, payload, getresponse=True):
+        """Send a tinytuya MessagePayload and wait for its reply
+
+        Failed attempts reconnect and retry up to retry_limit times.
+        """
+        error = tinytuya.ERR_CONNECT
+        for attempt in range(self.retry_limit + 1):
+            if attempt:
+                await asyncio.sleep(RETRY_DELAY)
+            try:
+                await self.connect()
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                error = tinytuya.ERR_CONNECT
+                if not attempt:
+                    await self._reresolve()
+                continue
+            except tinytuya.DecodeError:
+                error = tinytuya.ERR_KEY_OR_VER
+                continue
+
+            writer = self._writer
+            if writer is None:
+                continue
+            seqno = self._codec.seqno
+            data = self._codec._encode_message(payload)
+            future = None
+            if getresponse:
+                future = asyncio.get_running_loop().create_future()
+                self._pending[seqno] = (payload.cmd, future)
+            sent_at = time.monotonic()
+            try:
+                writer.write(data)
+                await writer.drain()
+                if future is None:
+                    return None
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                error = tinytuya.ERR_TIMEOUT
+                if self._last_received < sent_at:
+                    # Nothing came back at all: treat the connection as dead
+                    self._drop_connection(
+                        ConnectionError(f"{self.id} stopped responding"), writer
+                    )
+            except (OSError, ConnectionError):
+                error = tinytuya.ERR_CONNECT
+            finally:
+                self._pending.pop(seqno, None)
+        log.debug("Request to %s failed after %d attempts", self.id, attempt + 1)
+        return tinytuya.error_json(error)
+
+    async def status(self):
+        """Query every DPS of the device"""
+        return await self.request(self._codec.generate_payload(tinytuya.DP_QUERY))
+
+    async def set_value(self, index, value):
+        return await self.set_multiple_values({index: value})
+
+    async def set_multiple_values(self, data):
+        """Set several DPS in one message, e.g. {21: "colour", 24: "..."}"""
+        dps = {str(index): value for index, value in data.items()}
+        return await self.request(
+            self._codec.generate_payload(tinytuya.CONTROL, dps)
+        )
+
+    async def turn_on(self, switch=POWER_DP):
+        return await self.set_value(switch, True)
+
+    async def turn_off(self, switch=POWER_DP):
+        return await self.set_value(switch, False)
+
+    async def heartbeat(self):
+        return await self.request(self._codec.generate_payload(tinytuya.HEART_BEAT))
+
+    async def receive(self, timeout=None):
+        """Return the next status message the device pushed, or None"""
+        if self._push_event is None:
+            self._push_event = asyncio.Event()
+        if not self._pushes:
+            self._push_event.clear()
+            try:
+                await asyncio.wait_for(self._push_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._pushes.popleft() if self._pushes else None
+
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """The shared event loop that runs device I/O for synchronous callers"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="device-io", daemon=True
+            ).start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro, timeout=None):
+    """Run a coroutine on the shared loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+class LoopBulbDevice(tinytuya.BulbDevice):
+    """A tinytuya.BulbDevice whose network I/O runs on the shared loop
+
+    Payloads and bulb logic (colour formats, white mode, detection) are
+    BulbDevice's own; every send goes through an AsyncTuyaDevice instead
+    of a blocking socket. Colours are encoded from color_encoding's tables.
+    """
+
+    rgb_to_hexvalue = staticmethod(color_encoding.rgb_to_hexvalue)
+
+    def __init__(
+        self,
+        dev_id,
+        address,
+        local_key,
+        version="3.5",
+        port=tinytuya.TCPPORT,
+        timeout=5,
+        resolver=None,
+    ):
+        self.client = AsyncTuyaDevice(
+            dev_id,
+            address,
+            local_key,
+            version=version,
+            port=port,
+            timeout=timeout,
+            resolver=resolver,
+        )
+        super().__init__(
+            dev_id=dev_id,
+            address=address,
+            local_key=local_key,
+            version=version,
+            port=port,
+            connection_timeout=timeout,
+        )
+
+    def _send_receive(
+        self,
+        payload,
+        minresponse=28,
+        getresponse=True,
+        decode_response=True,
+        from_child=None,
+    ):
+        if payload is None:
+            return run_sync(self.client.receive(self.connection_timeout))
+        result = run_sync(self.client.request(payload, getresponse))
+        if not self.socketPersistent:
+            run_sync(self.client.close())
+        return result
+
+    def cached_status(self, historic=False, nowait=False):
+        # The client keeps every DPS it has seen on its open connection;
+        # BulbDevice reads this before most writes
+        if historic:
+            return self._historic_status
+        if self.socketPersistent and self.client.connected and self.client.dps:
+            return {"dps": dict(self.client.dps)}
+        if nowait:
+            return None
+        return self.status()
+
+    def set_socketPersistent(self, persist):
+        self.socketPersistent = persist
+        if not persist and self.client.connected:
+            run_sync(self.client.close())
+
+    def close(self):
+        # Called from __del__ as well, so never wait on the loop here
+        client = getattr(self, "client", None)
+        if client is not None and client.connected and _loop is not None:
+            asyncio.run_coroutine_threadsafe(client.close(), _loop)
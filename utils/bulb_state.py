@@ -0,0 +1,244 @@
+"""
+Typed bulb state decoded from Tuya DPS.
+
+BulbState holds one bulb's status in __slots__ fields and is the only place
+raw DPS are turned into power, mode, brightness, temperature and color.
+The color on DPS 24 is decoded to HSV once, when it changes. The dict and
+JSON forms served by the API are built on first use and cached until the
+state changes, so polling an unchanged bulb allocates nothing new.
+
+Usage:
+    state = BulbState()
+    state.apply_dps({"20": True, "22": 500, "24": "00f003e803e8"})
+    state.hsv          # (240, 1000, 1000)
+    state.to_json()    # Cached until the next change
+"""
+
+import functools
+import itertools
+import json
+import time
+
+from utils import color_encoding
+
+# Data points of a Tuya colour bulb
+POWER_DP = "20"
+MODE_DP = "21"
+BRIGHTNESS_DP = "22"
+TEMPERATURE_DP = "23"
+COLOR_DP = "24"
+
+# Versions are drawn from one counter, so a bulb whose state object is
+# replaced (e.g. on reconnect) never goes back to an older version. The
+# epoch tells this process's versions from those of an earlier run or of
+# another instance, whose counters started elsewhere.
+EPOCH = int(time.time() * 1000)
+_versions = itertools.count(1)
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_hsv(color_data):
+    """Decode DPS 24 color data to (h, s, v)
+
+    Args:
+        color_data: "hhhhssssvvvv" hex (h 0-360, s and v 0-1000), the older
+            14 character "rrggbbhhhhssvv" form, or JSON {"h", "s", "v"}
+
+    Returns:
+        Tuple of ints (h 0-360, s and v 0-1000), or None if it cannot be read
+    """
+    if not isinstance(color_data, str):
+        return None
+    try:
+        if color_data.startswith("{"):
+            data = json.loads(color_data)
+            return int(data["h"]), int(data["s"]), int(data["v"])
+        if len(color_data) == 12:
+            return (
+                int(color_data[0:4], 16),
+                int(color_data[4:8], 16),
+                int(color_data[8:12], 16),
+            )
+        if len(color_data) == 14:
+            # Saturation and value are 0-255 in this form
+            return (
+                int(color_data[6:10], 16),
+                round(int(color_data[10:12], 16) * 1000 / 255),
+                round(int(color_data[12:14], 16) * 1000 / 255),
+            )
+    except (ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def rgb_to_hsv(r, g, b):
+    """RGB 0-255 to the (h 0-360, s 0-1000, v 0-1000) used on DPS 24"""
+    return color_encoding.rgb_to_hsv(int(r), int(g), int(b))
+
+
+class BulbState:
+    """Status of one bulb with cached dict and JSON serializations
+
+    The version increases on every change, so clients can tell whether
+    anything changed since they last looked. Versions only compare within
+    one EPOCH.
+    """
+
+    __slots__ = (
+        "online",
+        "power",
+        "mode",
+        "brightness",
+        "temperature",
+        "color_data",
+        "hsv",
+        "error",
+        "stale",
+        "version",
+        "_dict",
+        "_json",
+    )
+
+    # Fields update() accepts
+    FIELDS = ("power", "mode", "brightness", "temperature")
+
+    def __init__(self):
+        self.online = False
+        self.power = False
+        self.mode = "unknown"
+        self.brightness = 0
+        self.temperature = 0
+        self.color_data = None
+        self.hsv = None
+        self.error = None
+        self.stale = False
+        self.version = next(_versions)
+        self._dict = None
+        self._json = None
+
+    @classmethod
+    def offline(cls, error):
+        state = cls()
+        state.mark_offline(error)
+        return state
+
+    def _changed(self):
+        self.version = next(_versions)
+        self._dict = None
+        self._json = None
+
+    def apply_dps(self, dps):
+        """Fold raw DPS from a status reply into the state
+
+        Only data points present in dps are updated, so partial replies
+        to set commands can be applied as well.
+
+        Returns:
+            True if anything changed
+        """
+        power = dps.get(POWER_DP, self.power)
+        mode = dps.get(MODE_DP, self.mode)
+        brightness = dps.get(BRIGHTNESS_DP, self.brightness)
+        temperature = dps.get(TEMPERATURE_DP, self.temperature)
+        color_data = dps.get(COLOR_DP, self.color_data)
+        if (
+            self.online
+            and not self.stale
+            and power == self.power
+            and mode == self.mode
+            and brightness == self.brightness
+            and temperature == self.temperature
+            and color_data == self.color_data
+        ):
+            return False
+
+        self.online = True
+        self.stale = False
+        self.error = None
+        self.power = bool(power)
+        self.mode = mode
+        self.brightness = brightness
+        self.temperature = temperature
+        if color_data != self.color_data:
+            self.color_data = color_data
+            self.hsv = decode_hsv(color_data)
+        self._changed()
+        return True
+
+    def update(self, **fields):
+        """Set fields after a successful command (see FIELDS)
+
+        Returns:
+            True if anything changed
+        """
+        changed = False
+        for name, value in fields.items():
+            if name not in self.FIELDS:
+                raise AttributeError(f"BulbState has no field {name}")
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed = True
+        if changed:
+            self._changed()
+        return changed
+
+    def set_rgb(self, r, g, b):
+        """Record a color set from RGB; the bulb switches to colour mode"""
+        r, g, b = (max(0, min(255, int(c))) for c in (r, g, b))
+        hsv = rgb_to_hsv(r, g, b)
+        if hsv == self.hsv and self.mode == "colour":
+            return False
+        self.hsv = hsv
+        self.mode = "colour"
+        self.color_data = color_encoding.encode_hex(r, g, b)
+        self._changed()
+        return True
+
+    def mark_offline(self, error):
+        if self.online or self.error != error:
+            self.online = False
+            self.error = error
+            self._changed()
+
+    def mark_stale(self):
+        """The last read timed out; the fields keep their last known values"""
+        if not self.stale:
+            self.stale = True
+            self._changed()
+
+    def as_dict(self):
+        """The API form of the state; shared, so callers must not modify it"""
+        if self._dict is None:
+            if self.online:
+                data = {
+                    "online": True,
+                    "power": self.power,
+                    "mode": self.mode,
+                    "brightness": self.brightness,
+                    "temperature": self.temperature,
+                    "color_data": self.color_data,
+                    "hsv": (
+                        None
+                        if self.hsv is None
+                        else {"h": self.hsv[0], "s": self.hsv[1], "v": self.hsv[2]}
+                    ),
+                    "version": self.version,
+                    "epoch": EPOCH,
+                }
+                if self.stale:
+                    data["stale"] = True
+            else:
+                data = {
+                    "online": False,
+                    "error": self.error,
+                    "version": self.version,
+                    "epoch": EPOCH,
+                }
+            self._dict = data
+        return self._dict
+
+    def to_json(self):
+        """as_dict() encoded as JSON, cached until the state changes"""
+        if self._json is None:
+            self._json = json.dumps(self.as_dict())
+        return self._json
@@ -0,0 +1,214 @@
+"""
+RGB to Tuya color payload encoding for the per-frame hot path.
+
+Every frame of an effect turns RGB into the color data point (DPS 24, or
+DPS 5 on older bulbs). tinytuya does this with colorsys floats and string
+formatting on every call. Here the HSV conversion is integer arithmetic,
+the hex digits come from precomputed tables, and finished payloads are
+memoized per color, so a frame that sends the same color to many bulbs
+encodes it once. Whole frames can be converted in one call, vectorized
+with numpy when it is installed, and a packed frame of pixels (a light
+strip's segments) can be encoded straight into one payload.
+
+Payload forms:
+    "hsv16"  hhhhssssvvvv   (h 0-360, s and v 0-1000), DPS 24
+    "rgb8"   rrggbbhhhhssvv (s and v 0-255), DPS 5 on older bulbs
+    JSON     {"h": 240, "s": 1000, "v": 1000}
+
+Usage:
+    from utils.color_encoding import encode_hex, encode_frame
+
+    encode_hex(0, 0, 255)                      # "00f003e803e8"
+    encode_frame([(255, 0, 0), (0, 0, 255)])   # One payload per color
+    encode_pixels(bytes([255, 0, 0, 0, 0, 255]))  # Both in one payload
+"""
+
+import functools
+
+try:
+    import numpy as np
+except ImportError:  # Optional; encode_frame falls back to the cached encoder
+    np = None
+
+HSV16 = "hsv16"
+RGB8 = "rgb8"
+
+# Distinct colors whose payloads are kept; a fade passes through far fewer
+CACHE_SIZE = 4096
+
+# Hex digits of every value a payload field can take
+HEX2 = tuple("%02x" % i for i in range(256))
+HEX4 = tuple("%04x" % i for i in range(1001))
+
+
+def rgb_to_hsv(r, g, b, scale=1000):
+    """Integer RGB 0-255 to (h 0-359, s 0-scale, v 0-scale)
+
+    The same as int(colorsys.rgb_to_hsv(...) * scale) without floats, except
+    where colorsys lands just below a whole number (34.99999 for 35) and
+    truncates one unit lower.
+    """
+    maxc = max(r, g, b)
+    delta = maxc - min(r, g, b)
+    if delta == 0:
+        return 0, 0, maxc * scale // 255
+    if r == maxc:
+        h = 60 * (g - b) // delta
+    elif g == maxc:
+        h = 120 + 60 * (b - r) // delta
+    else:
+        h = 240 + 60 * (r - g) // delta
+    return h % 360, delta * scale // maxc, maxc * scale // 255
+
+
+def _check(r, g, b):
+    if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+        raise ValueError(f"RGB values must be between 0 and 255, got {(r, g, b)}")
+    return int(r), int(g), int(b)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _hsv16(r, g, b):
+    h, s, v = rgb_to_hsv(r, g, b)
+    return HEX4[h] + HEX4[s] + HEX4[v]
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _rgb8(r, g, b):
+    h, s, v = rgb_to_hsv(r, g, b, 255)
+    return HEX2[r] + HEX2[g] + HEX2[b] + HEX4[h] + HEX2[s] + HEX2[v]
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _json(r, g, b):
+    return '{"h": %d, "s": %d, "v": %d}' % rgb_to_hsv(r, g, b)
+
+
+_ENCODERS = {HSV16: _hsv16, RGB8: _rgb8}
+
+
+def encode_hex(r, g, b, hexformat=HSV16):
+    """Hex color payload of an RGB color
+
+    Args:
+        r, g, b: Color components 0-255
+        hexformat: "hsv16" (DPS 24) or "rgb8" (DPS 5 on older bulbs)
+
+    Returns:
+        The payload string in the form tinytuya builds
+    """
+    try:
+        encoder = _ENCODERS[hexformat]
+    except KeyError:
+        raise ValueError('hexformat must be either "rgb8" or "hsv16"') from None
+    return encoder(*_check(r, g, b))
+
+
+def encode_json(r, g, b):
+    """JSON color payload {"h", "s", "v"} as sent by some DPS 24 firmware"""
+    return _json(*_check(r, g, b))
+
+
+def hsv_to_hex(h, s, v):
+    """hsv16 payload of h 0-360, s and v 0-1000"""
+    return HEX4[h] + HEX4[s] + HEX4[v]
+
+
+def rgb_to_hexvalue(r, g, b, hexformat):
+    """Drop-in for tinytuya.BulbDevice.rgb_to_hexvalue using the tables"""
+    return encode_hex(r, g, b, hexformat)
+
+
+def encode_frame(colors, hexformat=HSV16):
+    """Hex payloads of a whole frame of colors
+
+    Args:
+        colors: Sequence of (r, g, b), or an (n, 3) numpy array
+        hexformat: "hsv16" or "rgb8"
+
+    Returns:
+        List of payload strings, one per color
+    """
+    if np is not None and len(colors) > 64:
+        return _encode_array(np.asarray(colors), hexformat)
+    encoder = _ENCODERS.get(hexformat)
+    if encoder is None:
+        raise ValueError('hexformat must be either "rgb8" or "hsv16"')
+    return [encoder(*_check(r, g, b)) for r, g, b in colors]
+
+
+def encode_pixels(data, hexformat=HSV16):
+    """One payload holding every pixel of a packed frame, in order
+
+    With numpy and more than 64 pixels the whole buffer is converted with
+    array operations and hexlified in one call, so no Python object is
+    created per pixel.
+
+    Args:
+        data: Packed r, g, b bytes (bytes, bytearray, memoryview) or a
+            uint8 numpy array of them
+        hexformat: "hsv16" or "rgb8"
+
+    Returns:
+        The pixels' payloads concatenated, e.g. 12 hex digits per pixel
+    """
+    encoder = _ENCODERS.get(hexformat)
+    if encoder is None:
+        raise ValueError('hexformat must be either "rgb8" or "hsv16"')
+    if np is not None and isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1)
+    if len(data) % 3:
+        raise ValueError("Pixel data must be whole r, g, b triples")
+    if np is None or len(data) <= 3 * 64:
+        pixels = bytes(data)
+        return "".join(map(encoder, pixels[0::3], pixels[1::3], pixels[2::3]))
+
+    rgb = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+    h, s, v = _hsv_arrays(rgb.astype(np.int32), 1000 if hexformat == HSV16 else 255)
+    if hexformat == HSV16:
+        fields = np.empty((len(rgb), 3), dtype=">u2")
+        fields[:, 0], fields[:, 1], fields[:, 2] = h, s, v
+    else:
+        fields = np.empty((len(rgb), 7), dtype=np.uint8)
+        fields[:, :3] = rgb
+        fields[:, 3], fields[:, 4] = h >> 8, h & 0xFF
+        fields[:, 5], fields[:, 6] = s, v
+    return fields.tobytes().hex()
+
+
+def _hsv_arrays(rgb, scale):
+    """rgb_to_hsv over an (n, 3) int array: arrays of h, s and v"""
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc = rgb.max(axis=1)
+    delta = maxc - rgb.min(axis=1)
+    safe_delta = np.maximum(delta, 1)
+    h = np.where(
+        r == maxc,
+        60 * (g - b) // safe_delta,
+        np.where(
+            g == maxc,
+            120 + 60 * (b - r) // safe_delta,
+            240 + 60 * (r - g) // safe_delta,
+        ),
+    )
+    h = np.where(delta == 0, 0, h % 360)
+    s = delta * scale // np.maximum(maxc, 1)
+    v = maxc * scale // 255
+    return h, s, v
+
+
+def _encode_array(rgb, hexformat):
+    """encode_frame for many colors: HSV for the whole frame at once"""
+    if hexformat not in _ENCODERS:
+        raise ValueError('hexformat must be either "rgb8" or "hsv16"')
+    rgb = rgb.reshape(-1, 3).astype(np.int32)
+    if rgb.size and (rgb.min() < 0 or rgb.max() > 255):
+        raise ValueError("RGB values must be between 0 and 255")
+    scale = 1000 if hexformat == HSV16 else 255
+    h, s, v = (values.tolist() for values in _hsv_arrays(rgb, scale))
+    if hexformat == HSV16:
+        return [HEX4[hh] + HEX4[ss] + HEX4[vv] for hh, ss, vv in zip(h, s, v)]
+    return [
+        HEX2[rr] + HEX2[gg] + HEX2[bb] + HEX4[hh] + HEX2[ss] + HEX2[vv]
+        for (rr, gg, bb), hh, ss, vv in zip(rgb.tolist(), h, s, v)
+    ]
@@ -0,0 +1,167 @@
+"""
+Journal of desired bulb state for bulbs that cannot be reached.
+
+A command for an offline bulb is recorded here instead of failing. Each
+bulb keeps only the newest value of each attribute, in the order they were
+last set, so any number of commands collapse into one target state. When
+the bulb is reachable again the journal is turned into a single set of
+data points and written in one message, so the bulb converges with one
+write rather than a backlog. The journal is saved to a JSON file, so
+intents survive a server restart.
+
+Usage:
+    journal = CommandJournal()
+    journal.record("top", "brightness", 500)
+    journal.record("top", "power", True)
+    dps = journal_dps(journal.take("top"))   # {"20": True, "21": "white", "22": 500}
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+
+from utils.bulb_state import (
+    BRIGHTNESS_DP,
+    COLOR_DP,
+    MODE_DP,
+    POWER_DP,
+    TEMPERATURE_DP,
+    rgb_to_hsv,
+)
+from utils.color_encoding import hsv_to_hex
+
+# Where pending intents are kept between runs
+JOURNAL_PATH = os.environ.get("SMARTHOME_JOURNAL", "command_journal.json")
+
+# Attributes that can be journaled: power (bool), brightness (10-1000),
+# temperature (0-1000) and color ([r, g, b])
+ATTRIBUTES = ("power", "brightness", "temperature", "color")
+
+log = logging.getLogger(__name__)
+
+
+def journal_dps(intents, mode=None, hsv=None):
+    """The data points that bring a bulb to the journaled state
+
+    Intents are applied in order the way the commands would have been:
+    color switches to colour mode, temperature to white mode at full
+    brightness, and brightness in colour mode scales the color's value.
+
+    Args:
+        intents: Ordered {attr: value} from CommandJournal.take()
+        mode: The bulb's last known mode, used when no intent sets one
+        hsv: The bulb's last known (h, s, v) color
+
+    Returns:
+        {dp: value} to write with one set_multiple_values
+    """
+    dps = {}
+    for attr, value in intents.items():
+        if attr == "power":
+            dps[POWER_DP] = bool(value)
+        elif attr == "color":
+            hsv = rgb_to_hsv(*(max(0, min(255, int(c))) for c in value))
+            mode = "colour"
+            dps.update({POWER_DP: True, MODE_DP: mode, COLOR_DP: hsv_to_hex(*hsv)})
+        elif attr == "temperature":
+            mode = "white"
+            dps.update(
+                {
+                    POWER_DP: True,
+                    MODE_DP: mode,
+                    BRIGHTNESS_DP: 1000,
+                    TEMPERATURE_DP: max(0, min(1000, int(value))),
+                }
+            )
+        elif attr == "brightness":
+            value = max(10, min(1000, int(value)))
+            dps[POWER_DP] = True
+            if mode == "colour" and hsv is not None:
+                hsv = (hsv[0], hsv[1], int(value))
+                dps[COLOR_DP] = hsv_to_hex(*hsv)
+            else:
+                mode = "white"
+                dps.update({MODE_DP: mode, BRIGHTNESS_DP: int(value)})
+    return dps
+
+
+class CommandJournal:
+    """Newest desired value of each attribute of unreachable bulbs
+
+    Args:
+        path: JSON file the journal is saved to, or None to keep it in memory
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self._entries = {}  # bulb -> OrderedDict(attr -> value)
+        self._lock = threading.Lock()
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            for bulb, intents in saved.items():
+                self._entries[bulb] = collections.OrderedDict(intents)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            log.warning("Ignoring unreadable command journal %s: %s", path, e)
+
+    def __contains__(self, bulb):
+        return bool(self._entries.get(bulb))
+
+    def record(self, bulb, attr, value):
+        """Record the desired value of an attribute, replacing an older one"""
+        if attr not in ATTRIBUTES:
+            raise ValueError(f"Cannot journal {attr}")
+        with self._lock:
+            intents = self._entries.setdefault(bulb, collections.OrderedDict())
+            intents.pop(attr, None)
+            intents[attr] = value
+            self._save()
+
+    def pending(self, bulb):
+        """Copy of a bulb's journaled intents, oldest first"""
+        with self._lock:
+            return collections.OrderedDict(self._entries.get(bulb, ()))
+
+    def take(self, bulb):
+        """Remove and return a bulb's intents for replay"""
+        with self._lock:
+            intents = self._entries.pop(bulb, None)
+            if intents:
+                self._save()
+            return intents or collections.OrderedDict()
+
+    def restore(self, bulb, intents):
+        """Put back intents whose replay failed, under any recorded since"""
+        if not intents:
+            return
+        with self._lock:
+            newer = self._entries.get(bulb, {})
+            merged = collections.OrderedDict(
+                (attr, value) for attr, value in intents.items() if attr not in newer
+            )
+            merged.update(newer)
+            self._entries[bulb] = merged
+            self._save()
+
+    def bulbs(self):
+        """Names of the bulbs with pending intents"""
+        with self._lock:
+            return [bulb for bulb, intents in self._entries.items() if intents]
+
+    def _save(self):
+        if self.path is None:
+            return
+        temp = f"{self.path}.tmp"
+        saved = {bulb: list(intents.items()) for bulb, intents in self._entries.items()}
+        try:
+            with open(temp, "w") as f:
+                json.dump(saved, f, indent=4)
+            os.replace(temp, self.path)
+        except OSError as e:
+            log.warning("Could not save command journal %s: %s", self.path, e)
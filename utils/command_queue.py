@@ -0,0 +1,386 @@
+"""
+Per-device command queues with priority lanes.
+
+Every bulb gets one worker thread that owns its socket, so commands never
+race each other on the connection. Commands wait in one of three lanes,
+served strictly in order: interactive (dashboard and API), automation
+(scheduled and scripted changes) and effect frames from programs. Effect
+frames are coalesced per key so only the newest pending frame is kept, and
+frames that waited too long are dropped instead of being sent late.
+
+A queue can be given a rate limiter (see utils.rate_limit). Commands then
+wait for a token before they are sent, and effect frames that find no
+token are shed rather than held back.
+"""
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+import tinytuya
+
+from utils import metrics, tracing
+from utils.device_manager import connect_device
+from utils.frame_pacing import get_link_stats
+from utils.rate_limit import EFFECT_RESERVE, limiter_for
+
+# Lanes, highest priority first
+INTERACTIVE = 0
+AUTOMATION = 1
+EFFECT = 2
+LANE_NAMES = ("interactive", "automation", "effect")
+
+# Effect frames older than this (in seconds) are stale and dropped
+EFFECT_MAX_AGE = 1.0
+
+
+# Metric label of the bulb_commands functions: the device method each one
+# sends, so REST commands and program calls through QueuedDevice (labelled
+# by the method itself) share one series per operation
+COMMAND_OPS = {
+    "turn_on_bulb": "turn_on",
+    "turn_off_bulb": "turn_off",
+    "set_temperature": "set_white",
+    "set_color": "set_colour",
+    "set_color_value": "set_colour",
+    "set_dps": "set_multiple_values",
+    "read_status": "status",
+    "get_status": "status",
+}
+
+
+def command_op(func, args):
+    """The op label of a queued call: the device method it sends"""
+    name = getattr(func, "__name__", "call")
+    if name == "set_power":
+        return "turn_on" if args and args[-1] else "turn_off"
+    return COMMAND_OPS.get(name, name)
+
+
+def command_outcome(result):
+    """Classify a command result as ok, error or timeout"""
+    if isinstance(result, dict) and "Error" in result:
+        if str(result.get("Err")) == str(tinytuya.ERR_TIMEOUT):
+            return "timeout"
+        return "error"
+    return "error" if result is False else "ok"
+
+
+class Command:
+    """A queued call and the future that receives its result"""
+
+    __slots__ = ("func", "args", "kwargs", "lane", "enqueued_at", "future", "trace")
+
+    def __init__(self, func, args, kwargs, lane):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.future = Future()
+        self.trace = tracing.current()  # The request or frame it belongs to
+
+
+class DeviceCommandQueue:
+    """Serialises all commands for one device through priority lanes"""
+
+    def __init__(self, name, device, effect_max_age=EFFECT_MAX_AGE, limiter=None):
+        """
+        Args:
+            name: Bulb name, used in metrics and the worker's thread name
+            device: The connected device commands are run against
+            effect_max_age: Seconds after which a pending frame is stale
+            limiter: Optional TokenBucket every command takes a token from
+        """
+        self.name = name
+        self.device = device
+        self.effect_max_age = effect_max_age
+        self.limiter = limiter
+        self._lanes = (collections.deque(), collections.deque())
+        self._effects = collections.OrderedDict()  # coalesce key -> Command
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped_frames = 0
+        self.coalesced_frames = 0
+        self.shed_frames = 0
+        self._thread = threading.Thread(
+            target=self._worker, name=f"device-{name}", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, func, *args, lane=INTERACTIVE, key=None, **kwargs):
+        """Queue func(*args, **kwargs) and return a Future for its result
+
+        Args:
+            func: Callable to run on the device's worker thread
+            lane: INTERACTIVE, AUTOMATION or EFFECT
+            key: Coalescing key for effect frames; a newer frame with the
+                same key replaces a pending one
+        """
+        command = Command(func, args, kwargs, lane)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Command queue for {self.name} is closed")
+            if lane == EFFECT:
+                key = key if key is not None else func
+                replaced = self._effects.pop(key, None)
+                if replaced is not None:
+                    self.coalesced_frames += 1
+                    replaced.future.set_result(None)
+                self._effects[key] = command
+            else:
+                self._lanes[lane].append(command)
+            self._cond.notify()
+        return command.future
+
+    def run(self, func, *args, lane=INTERACTIVE, key=None, **kwargs):
+        """Queue a command and wait for its result"""
+        return self.submit(func, *args, lane=lane, key=key, **kwargs).result()
+
+    def depth(self):
+        """Number of pending commands in each lane"""
+        return {
+            LANE_NAMES[INTERACTIVE]: len(self._lanes[INTERACTIVE]),
+            LANE_NAMES[AUTOMATION]: len(self._lanes[AUTOMATION]),
+            LANE_NAMES[EFFECT]: len(self._effects),
+        }
+
+    def _take(self, reserve=0.0):
+        """0 if a token was taken, else seconds until the limiter has one"""
+        if self.limiter is None:
+            return 0
+        return self.limiter.take(reserve)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                lane = self._lanes[INTERACTIVE] or self._lanes[AUTOMATION]
+                if lane:
+                    delay = self._take()
+                    if not delay:
+                        return lane.popleft()
+                    # Over the bulb's rate: wait for a token (or a newer command)
+                    self._cond.wait(delay)
+                    continue
+
+                while self._effects:
+                    _, command = self._effects.popitem(last=False)
+                    age = time.monotonic() - command.enqueued_at
+                    if age > self.effect_max_age:
+                        # Stale frame: count it as a drop so effects slow down
+                        self.dropped_frames += 1
+                        get_link_stats(self.device).record(age, ok=False)
+                        command.future.set_result(None)
+                    elif self._take(EFFECT_RESERVE):
+                        # More frames than the bulb takes: shed, never queue,
+                        # and count it as a drop so FramePacer backs off
+                        self.shed_frames += 1
+                        get_link_stats(self.device).record(0, ok=False)
+                        command.future.set_result(None)
+                    else:
+                        return command
+
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            command = self._next()
+            if command is None:
+                return
+            if not command.future.set_running_or_notify_cancel():
+                continue
+
+            op = command_op(command.func, command.args)
+            start = time.monotonic()
+            try:
+                result = command.func(*command.args, **command.kwargs)
+            except Exception as e:
+                elapsed = time.monotonic() - start
+                get_link_stats(self.device).record(elapsed, ok=False)
+                self._record(command, op, start, elapsed, "error")
+                if self.limiter is not None:
+                    self.limiter.record(False)
+                command.future.set_exception(e)
+                continue
+
+            elapsed = time.monotonic() - start
+            outcome = command_outcome(result)
+            get_link_stats(self.device).record(elapsed, ok=outcome == "ok")
+            if self.limiter is not None:
+                self.limiter.record(outcome == "ok")
+            self._record(command, op, start, elapsed, outcome)
+            command.future.set_result(result)
+
+    def _record(self, command, op, start, elapsed, outcome):
+        metrics.COMMANDS.inc((self.name, op, outcome))
+        metrics.COMMAND_LATENCY.observe(elapsed, (self.name, op))
+        if command.trace is not None:
+            lane = LANE_NAMES[command.lane]
+            command.trace.add_span(
+                "queue_wait", command.enqueued_at, start, bulb=self.name, lane=lane
+            )
+            command.trace.add_span(
+                "device", start, start + elapsed, bulb=self.name, op=op, outcome=outcome
+            )
+
+    def close(self, drain=True, timeout=None):
+        """Stop the worker thread
+
+        Args:
+            drain: Run the commands already queued before stopping; when
+                False pending commands are cancelled
+            timeout: Seconds to wait for the worker to finish
+        """
+        with self._cond:
+            self._closed = True
+            if not drain:
+                pending = list(self._lanes[INTERACTIVE]) + list(self._lanes[AUTOMATION])
+                pending += list(self._effects.values())
+                for lane in self._lanes:
+                    lane.clear()
+                self._effects.clear()
+                for command in pending:
+                    command.future.cancel()
+            self._cond.notify_all()
+        self.join(timeout)
+
+    def join(self, timeout=None):
+        """Wait for the worker thread to finish after close()"""
+        self._thread.join(timeout)
+
+
+class QueuedDevice:
+    """Device proxy that sends every method call through a command queue
+
+    Calls block until the command has run (or was dropped as stale, in which
+    case they return None), so programs keep their own pacing while
+    higher-priority lanes jump ahead of their frames.
+    """
+
+    # Link statistics are recorded by the queue worker, not by FramePacer
+    records_link_stats = True
+
+    def __init__(self, queue, lane=EFFECT):
+        self._queue = queue
+        self._lane = lane
+
+    def __getattr__(self, name):
+        attr = getattr(self._queue.device, name)
+        if not callable(attr):
+            return attr
+
+        def queued(*args, **kwargs):
+            return self._queue.run(attr, *args, lane=self._lane, key=name, **kwargs)
+
+        return queued
+
+
+class CommandQueues:
+    """The command queues of every connected bulb, keyed by bulb name"""
+
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, device, limiter=None):
+        """Create (or replace) the queue for a bulb's device
+
+        Args:
+            name: Bulb name
+            device: The connected device
+            limiter: Optional TokenBucket matching the bulb's capacity
+        """
+        with self._lock:
+            old = self._queues.get(name)
+            self._queues[name] = DeviceCommandQueue(name, device, limiter=limiter)
+        if old is not None:
+            old.close(drain=False)
+        return self._queues[name]
+
+    def connect(self, name, config):
+        """Connect to a bulb and queue its commands at the rate it can take
+
+        Args:
+            name: Bulb name
+            config: Device configuration from setup_devices()
+
+        Returns:
+            The connected device
+        """
+        device = connect_device(config)
+        self.register(name, device, limiter_for(config))
+        return device
+
+    def remove(self, name, drain=True, timeout=None):
+        """Stop a bulb's queue and close its connection
+
+        Args:
+            drain: Send the commands already queued first
+            timeout: Seconds to wait for them
+
+        Returns:
+            False if the bulb had no queue
+        """
+        with self._lock:
+            queue = self._queues.pop(name, None)
+        if queue is None:
+            return False
+        queue.close(drain=drain, timeout=timeout)
+        close = getattr(queue.device, "close", None)
+        if close is not None:
+            close()
+        return True
+
+    def get(self, name):
+        return self._queues[name]
+
+    def __contains__(self, name):
+        return name in self._queues
+
+    def submit(self, name, func, *args, lane=INTERACTIVE, **kwargs):
+        """Queue func(device, *args) on a bulb's queue and return its Future"""
+        queue = self._queues[name]
+        return queue.submit(func, queue.device, *args, lane=lane, **kwargs)
+
+    def run(self, name, func, *args, lane=INTERACTIVE, **kwargs):
+        """Run func(device, *args) on a bulb's queue and wait for the result"""
+        return self.submit(name, func, *args, lane=lane, **kwargs).result()
+
+    def device(self, name, lane=EFFECT):
+        """A proxy for a bulb's device whose calls go through the given lane"""
+        return QueuedDevice(self._queues[name], lane)
+
+    def depths(self):
+        return {name: queue.depth() for name, queue in list(self._queues.items())}
+
+    def frame_counts(self):
+        """Coalesced, stale-dropped and rate-shed effect frames of every queue"""
+        return {
+            name: {
+                "coalesced": queue.coalesced_frames,
+                "dropped": queue.dropped_frames,
+                "shed": queue.shed_frames,
+            }
+            for name, queue in list(self._queues.items())
+        }
+
+    def close(self, drain=True, timeout=None):
+        """Stop every queue, optionally running queued commands first
+
+        The queues drain in parallel; timeout bounds the whole shutdown
+        rather than each queue.
+        """
+        with self._lock:
+            queues = list(self._queues.values())
+            self._queues = {}
+        for queue in queues:
+            queue.close(drain=drain, timeout=0)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for queue in queues:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            queue.join(remaining)
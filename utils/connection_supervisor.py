@@ -0,0 +1,137 @@
+"""
+Background reconnection of unreachable bulbs.
+
+Bulbs that failed to connect or stopped answering are handed to the
+supervisor, which probes each one on its own schedule with exponential
+backoff, so an unplugged bulb costs one probe every few minutes instead of
+every request retrying it. Once a probe succeeds the bulb's on_online
+callback runs, e.g. to replay the command journal.
+
+Usage:
+    supervisor = ConnectionSupervisor(probe, on_online)
+    supervisor.start()
+    supervisor.watch("top")
+"""
+
+import logging
+import os
+import threading
+import time
+
+# Seconds before the first probe of an unreachable bulb; doubled after
+# every failed probe up to MAX_RECONNECT_INTERVAL
+RECONNECT_INTERVAL = float(os.environ.get("SMARTHOME_RECONNECT_INTERVAL", "5"))
+MAX_RECONNECT_INTERVAL = 300
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionSupervisor:
+    """Probe unreachable bulbs until they answer again
+
+    Args:
+        probe: func(name) that tries to reach a bulb, returning True once
+            it answered; it runs on the supervisor thread
+        on_online: func(name) run after a successful probe
+        interval: Seconds before the first probe
+        max_interval: Longest wait between probes of one bulb
+    """
+
+    def __init__(
+        self,
+        probe,
+        on_online=None,
+        interval=RECONNECT_INTERVAL,
+        max_interval=MAX_RECONNECT_INTERVAL,
+    ):
+        self.probe = probe
+        self.on_online = on_online
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self._due = {}  # name -> (monotonic time of next probe, backoff)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def __contains__(self, name):
+        return name in self._due
+
+    def watch(self, name, delay=None):
+        """Start probing a bulb (no-op if it is already watched)
+
+        Args:
+            name: Bulb name
+            delay: Seconds before the first probe (default interval)
+        """
+        delay = self.interval if delay is None else delay
+        with self._cond:
+            if name not in self._due:
+                self._due[name] = (time.monotonic() + delay, self.interval)
+                self._cond.notify()
+
+    def forget(self, name):
+        with self._cond:
+            self._due.pop(name, None)
+
+    def offline(self):
+        """Names of the bulbs being probed"""
+        with self._cond:
+            return sorted(self._due)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name="connection-supervisor", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout=2):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _next_due(self):
+        """Wait until a bulb is due; returns its name, or None once stopped"""
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                name, due = None, None
+                for candidate, (when, _) in self._due.items():
+                    if due is None or when < due:
+                        name, due = candidate, when
+                if name is not None and due <= now:
+                    return name
+                self._cond.wait(None if due is None else due - now)
+            return None
+
+    def _run(self):
+        while True:
+            name = self._next_due()
+            if name is None:
+                return
+            try:
+                online = self.probe(name)
+            except Exception as e:
+                log.debug("Probe of %s failed: %s", name, e)
+                online = False
+
+            with self._cond:
+                entry = self._due.get(name)
+                if entry is None:  # Forgotten while probing
+                    continue
+                if not online:
+                    backoff = min(self.max_interval, entry[1] * 2)
+                    self._due[name] = (time.monotonic() + entry[1], backoff)
+                    continue
+                del self._due[name]
+
+            log.info("%s is reachable again", name)
+            if self.on_online is not None:
+                try:
+                    self.on_online(name)
+                except Exception:
+                    log.exception("Reconnect handler failed for %s", name)
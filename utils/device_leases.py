@@ -0,0 +1,375 @@
+"""
+Bulb ownership shared by several server instances.
+
+Most Tuya bulbs take one connection at a time, so two servers reading the
+same devices.json would fight over every bulb. With SMARTHOME_LEASE_DB
+pointing at a SQLite file every instance can reach, the instances agree on
+one owner per bulb:
+
+- Every instance writes a heartbeat; instances that stop writing one for
+  LEASE_TTL seconds are considered gone.
+- Bulbs are assigned to the live instances by a consistent-hash ring of
+  instance ids, so an instance joining or leaving only moves its share.
+- The owner holds a lease on each of its bulbs and renews it every
+  LEASE_TTL / 3 seconds. A bulb is only connected while its lease is held,
+  and an owner whose bulb moves to another instance closes the socket
+  before it gives the lease up.
+- Connecting and closing bulbs runs on its own thread, so a slow bulb never
+  holds up the heartbeat and renewals past LEASE_TTL.
+- When an owner stops renewing, its leases lapse and the ring's next
+  choice takes the bulbs over.
+
+The server forwards requests for bulbs it does not own to their owner.
+
+Usage:
+    leases = LeaseManager(LeaseStore("leases.db"), "den", "http://den:3456",
+                          on_acquire=connect_bulb, on_release=release_bulb)
+    leases.start({"top": "bf12..."})
+    leases.owns("top")
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+
+# Shared lease database; unset runs a single instance that owns every bulb
+LEASE_DB = os.environ.get("SMARTHOME_LEASE_DB")
+
+# Seconds a heartbeat or lease lasts without being renewed
+LEASE_TTL = float(os.environ.get("SMARTHOME_LEASE_TTL", "15"))
+
+# Points per instance on the hash ring; more spread bulbs more evenly
+RING_REPLICAS = 64
+
+log = logging.getLogger(__name__)
+
+
+def instance_identity(host, port):
+    """(id, url) of this instance, from SMARTHOME_INSTANCE_ID/_URL or the host
+
+    Args:
+        host: Address the server listens on
+        port: Port the server listens on
+    """
+    if host in ("", "0.0.0.0", "::"):
+        host = socket.gethostname()
+    instance_id = os.environ.get("SMARTHOME_INSTANCE_ID") or f"{host}:{port}"
+    url = os.environ.get("SMARTHOME_INSTANCE_URL") or f"http://{host}:{port}"
+    return instance_id, url.rstrip("/")
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring mapping keys to nodes
+
+    Args:
+        nodes: Node ids
+        replicas: Points each node gets on the ring
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        """The node a key belongs to, or None for an empty ring"""
+        if not self._nodes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._nodes)
+        return self._nodes[index]
+
+
+class LeaseStore:
+    """Instance heartbeats and bulb leases in a SQLite database
+
+    Each call opens its own connection, so the store can be used from any
+    thread and by any number of processes.
+    """
+
+    def __init__(self, path=LEASE_DB):
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS instances "
+                "(id TEXT PRIMARY KEY, url TEXT NOT NULL, heartbeat REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(bulb TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return _Transaction(db)
+
+    def heartbeat(self, instance_id, url, now):
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO instances (id, url, heartbeat) "
+                "VALUES (?, ?, ?)",
+                (instance_id, url, now),
+            )
+
+    def instances(self, since):
+        """{id: url} of the instances with a heartbeat after since"""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id, url FROM instances WHERE heartbeat > ?", (since,)
+            )
+            return dict(rows.fetchall())
+
+    def leases(self, now):
+        """{bulb: owner} of every unexpired lease"""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT bulb, owner FROM leases WHERE expires > ?", (now,)
+            )
+            return dict(rows.fetchall())
+
+    def acquire(self, bulb, owner, now, expires):
+        """Take a bulb's lease if it is free or expired
+
+        Returns:
+            True if owner now holds the lease
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT owner, expires FROM leases WHERE bulb = ?", (bulb,)
+            ).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO leases (bulb, owner, expires) "
+                "VALUES (?, ?, ?)",
+                (bulb, owner, expires),
+            )
+            return True
+
+    def renew(self, bulbs, owner, now, expires):
+        """Extend the unexpired leases owner holds on bulbs
+
+        Returns:
+            The bulbs whose lease was renewed
+        """
+        renewed = set()
+        with self._connect() as db:
+            for bulb in bulbs:
+                cursor = db.execute(
+                    "UPDATE leases SET expires = ? "
+                    "WHERE bulb = ? AND owner = ? AND expires > ?",
+                    (expires, bulb, owner, now),
+                )
+                if cursor.rowcount:
+                    renewed.add(bulb)
+        return renewed
+
+    def release(self, bulb, owner):
+        with self._connect() as db:
+            db.execute("DELETE FROM leases WHERE bulb = ? AND owner = ?", (bulb, owner))
+
+    def leave(self, owner):
+        """Drop an instance's heartbeat and leases so others take over at once"""
+        with self._connect() as db:
+            db.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+            db.execute("DELETE FROM instances WHERE id = ?", (owner,))
+
+
+class _Transaction:
+    """Context manager running a block in one immediate SQLite transaction"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        # Take the write lock up front so read-then-write cannot interleave
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.db.close()
+
+
+class LeaseManager:
+    """Hold the leases of the bulbs the hash ring gives this instance
+
+    Args:
+        store: LeaseStore shared by the instances
+        instance_id: This instance's id on the ring
+        url: Base URL other instances forward requests to
+        on_acquire: func(bulb) run after a lease is taken, to connect it
+        on_release: func(bulb) run before a lease is given up, to close it
+        ttl: Seconds a heartbeat or lease lasts without renewal
+    """
+
+    def __init__(self, store, instance_id, url, on_acquire, on_release, ttl=LEASE_TTL):
+        self.store = store
+        self.instance_id = instance_id
+        self.url = url
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.ttl = ttl
+        self.bulbs = {}  # Bulb name -> device id, the key on the ring
+        self._held = set()
+        self._releasing = set()  # Closing, still leased until that is done
+        self._owners = {}  # Bulb name -> owner id, as of the last tick
+        self._urls = {}  # Instance id -> url of the live instances
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # (callback, bulb, give_up) run in order by the callback thread
+        self._callbacks = queue.Queue()
+        self._callback_thread = None
+
+    def owns(self, bulb):
+        return bulb in self._held
+
+    def owner(self, bulb):
+        """(id, url) of the instance holding a bulb's lease, or None"""
+        owner = self._owners.get(bulb)
+        if owner is None or owner not in self._urls:
+            return None
+        return owner, self._urls[owner]
+
+    def instances(self):
+        """{id: url} of the live instances"""
+        return dict(self._urls)
+
+    def start(self, bulbs):
+        """Take this instance's share of the bulbs, then keep the leases
+
+        The first round runs before this returns, so owned bulbs are
+        connected once start() is done.
+
+        Args:
+            bulbs: {name: device id} of every bulb in devices.json
+        """
+        self.bulbs = dict(bulbs)
+        if self._callback_thread is None:
+            self._callback_thread = threading.Thread(
+                target=self._run_callbacks, name="device-lease-callbacks", daemon=True
+            )
+            self._callback_thread.start()
+        self.tick()
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="device-leases", daemon=True
+            )
+            self._thread.start()
+        # Renewals keep running while the first bulbs connect
+        self._callbacks.join()
+
+    def stop(self, leave=True):
+        """Stop renewing; leave hands every bulb to the others at once"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._callback_thread is not None:
+            self._callbacks.put(None)
+            self._callback_thread.join(timeout=2)
+            self._callback_thread = None
+        if leave:
+            try:
+                self.store.leave(self.instance_id)
+            except sqlite3.Error as e:
+                log.warning("Could not release leases: %s", e)
+            self._held = set()
+            self._releasing = set()
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.tick()
+            except sqlite3.Error as e:
+                # Leases lapse if this keeps failing, and the bulbs move on
+                log.warning("Lease renewal failed: %s", e)
+
+    def _run_callbacks(self):
+        while True:
+            job = self._callbacks.get()
+            try:
+                if job is None:
+                    return
+                callback, bulb, give_up = job
+                self._call(callback, bulb)
+                if give_up:
+                    self.store.release(bulb, self.instance_id)
+            except sqlite3.Error as e:
+                log.warning("Could not release the lease on %s: %s", job[1], e)
+            finally:
+                if job is not None and job[2]:
+                    with self._lock:
+                        self._releasing.discard(job[1])
+                self._callbacks.task_done()
+
+    def tick(self):
+        """One round: heartbeat, renew, hand off and take over leases
+
+        Only the lease store is touched here; connecting and closing bulbs
+        is queued for the callback thread.
+        """
+        with self._lock:
+            now = time.time()
+            self.store.heartbeat(self.instance_id, self.url, now)
+            live = self.store.instances(now - self.ttl)
+            live[self.instance_id] = self.url
+            ring = HashRing(live)
+
+            # Leases that lapsed (e.g. this process stalled) are lost
+            renewed = self.store.renew(
+                self._held | self._releasing, self.instance_id, now, now + self.ttl
+            )
+            for bulb in self._held - renewed:
+                log.warning("Lease on %s lapsed", bulb)
+                self._release(bulb, give_up=False)
+
+            owners = self.store.leases(now)
+            for bulb, device_id in self.bulbs.items():
+                preferred = ring.owner(device_id)
+                if bulb in self._held:
+                    if preferred != self.instance_id:
+                        log.info("Handing %s to %s", bulb, preferred)
+                        self._release(bulb)
+                        owners.pop(bulb, None)
+                elif preferred == self.instance_id and bulb not in owners:
+                    if self.store.acquire(
+                        bulb, self.instance_id, time.time(), time.time() + self.ttl
+                    ):
+                        self._held.add(bulb)
+                        owners[bulb] = self.instance_id
+                        log.info("Took the lease on %s", bulb)
+                        self._callbacks.put((self.on_acquire, bulb, False))
+
+            self._owners = owners
+            self._urls = live
+
+    def _release(self, bulb, give_up=True):
+        self._held.discard(bulb)
+        if give_up:
+            # Renewed until the socket is closed, so no other instance can
+            # take the bulb before then
+            self._releasing.add(bulb)
+        self._callbacks.put((self.on_release, bulb, give_up))
+
+    @staticmethod
+    def _call(callback, bulb):
+        try:
+            callback(bulb)
+        except Exception:
+            log.exception("Lease callback failed for %s", bulb)
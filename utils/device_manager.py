@@ -2,22 +2,48 @@
 Device management utilities for Tuya smart devices.
 """
 
+import asyncio
+import logging
 import tinytuya
 import os
 import sys
 import json
 
+from utils import color_encoding, discovery
+from utils.async_device import AsyncTuyaDevice, LoopBulbDevice
+from utils.light_strip import DEFAULT_SEGMENTS, SEGMENT_DP, STRIP_CATEGORY, StripMixin
+
+# "asyncio" runs device I/O on the shared event loop, "tinytuya" uses
+# tinytuya's blocking sockets
+DEVICE_CLIENT = os.environ.get("SMARTHOME_DEVICE_CLIENT", "asyncio")
+
+log = logging.getLogger(__name__)
+
+
+class BlockingBulbDevice(tinytuya.BulbDevice):
+    """tinytuya.BulbDevice with colours encoded from color_encoding's tables"""
+
+    rgb_to_hexvalue = staticmethod(color_encoding.rgb_to_hexvalue)
+
+
+class BlockingStripDevice(StripMixin, BlockingBulbDevice):
+    """Light strip on tinytuya's blocking sockets"""
+
+
+class LoopStripDevice(StripMixin, LoopBulbDevice):
+    """Light strip on the shared event loop"""
+
 
 def setup_devices():
-    """Load the Tuya devices from devices.json"""
+    """Load the Tuya bulbs and light strips from devices.json"""
     devices = {}
 
     try:
         # Try to load devices from devices.json file
         if not os.path.exists("devices.json"):
-            print("Error: devices.json file not found.")
-            print(
-                "Please run 'python -m tinytuya wizard' to generate the required configuration files."
+            log.error(
+                "devices.json file not found. Please run 'python -m tinytuya wizard' "
+                "to generate the required configuration files."
             )
             sys.exit(1)
 
@@ -26,8 +52,9 @@ def setup_devices():
 
         # Format the data from devices.json
         for device in devices_data:
-            # Skip non-bulb devices if any
-            if "category" in device and device["category"] != "dj":
+            # Skip devices that are neither bulbs nor light strips
+            category = device.get("category", "dj")
+            if category not in ("dj", STRIP_CATEGORY):
                 continue
 
             # Use name as the key (lowercase for consistency)
@@ -36,29 +63,67 @@ def setup_devices():
             # Create entry with necessary device info
             devices[name] = {
                 "device_id": device["id"],
-                "ip_address": device.get("ip"),  # Use IP if available
+                # Use the IP if known, else the last address it broadcast from
+                "ip_address": device.get("ip") or discovery.lookup(device["id"]),
                 "local_key": device["key"],
                 "version": device.get(
                     "version", "3.5"
                 ),  # Use version if available, default to 3.5
+                "category": category,
             }
+            if category == STRIP_CATEGORY:
+                # Segment frames go to one data point of the strip
+                devices[name]["segments"] = int(
+                    device.get("segments", DEFAULT_SEGMENTS)
+                )
+                devices[name]["segment_dp"] = str(device.get("segment_dp", SEGMENT_DP))
+            if "port" in device:
+                # Non-standard port, e.g. a simulated bulb on localhost
+                devices[name]["port"] = int(device["port"])
+            # Command rate limit: learned per model unless max_rate is set
+            devices[name]["model"] = (
+                device.get("product_id")
+                or device.get("model")
+                or device.get("product_name")
+            )
+            for key in ("max_rate", "burst"):
+                if key in device:
+                    devices[name][key] = float(device[key])
 
         if not devices:
-            print("Error: No bulb devices found in devices.json.")
-            print("Please run 'python -m tinytuya wizard' to discover your devices.")
+            log.error(
+                "No bulb devices found in devices.json. "
+                "Please run 'python -m tinytuya wizard' to discover your devices."
+            )
             sys.exit(1)
 
-        print(f"Loaded {len(devices)} devices from devices.json.")
+        log.info("Loaded %d devices from devices.json.", len(devices))
         return devices
 
     except Exception as e:
-        print(f"Error loading devices from devices.json: {e}")
-        print(
-            "Please run 'python -m tinytuya wizard' to generate the required configuration files."
+        log.error(
+            "Error loading devices from devices.json: %s. Please run "
+            "'python -m tinytuya wizard' to generate the required configuration files.",
+            e,
         )
         sys.exit(1)
 
 
+def device_address(config):
+    """The IP address to connect to, from the config or from discovery
+
+    Raises:
+        ConnectionError: The bulb has no known address and did not
+            announce itself on the network
+    """
+    address = config.get("ip_address") or discovery.resolve(config["device_id"])
+    if not address:
+        raise ConnectionError(
+            f"No IP address for {config['device_id']} and it was not discovered"
+        )
+    return address
+
+
 def connect_device(config):
     """Connect to a Tuya bulb device
 
@@ -66,18 +131,57 @@ def connect_device(config):
         config: Device configuration with device_id, ip_address, and local_key
 
     Returns:
-        Connected BulbDevice object
+        Connected BulbDevice object (with set_frame() for light strips),
+        running its I/O on the shared event loop unless
+        SMARTHOME_DEVICE_CLIENT is "tinytuya"; the asyncio client looks the
+        bulb up again when a connection attempt fails
     """
-    device = tinytuya.BulbDevice(
+    options = {}
+    strip = config.get("category") == STRIP_CATEGORY
+    if DEVICE_CLIENT == "tinytuya":
+        device_class = BlockingStripDevice if strip else BlockingBulbDevice
+    else:
+        device_class = LoopStripDevice if strip else LoopBulbDevice
+        options["resolver"] = discovery.resolve
+    device = device_class(
         dev_id=config["device_id"],
-        address=config["ip_address"],
+        address=device_address(config),
         local_key=config["local_key"],
         version=config.get(
             "version", "3.5"
         ),  # Use the device's version or default to 3.5
+        port=config.get("port", tinytuya.TCPPORT),
+        **options,
     )
 
+    if strip:
+        device.segments = config.get("segments", DEFAULT_SEGMENTS)
+        device.segment_dp = config.get("segment_dp", SEGMENT_DP)
+
     # Set the bulb to use persistent connections
     device.set_socketPersistent(True)
 
     return device
+
+
+async def connect_device_async(config):
+    """Connect to a Tuya bulb with the asyncio client
+
+    Args:
+        config: Device configuration with device_id, ip_address, and local_key
+
+    Returns:
+        Connected AsyncTuyaDevice; raises OSError if the bulb is unreachable
+    """
+    loop = asyncio.get_running_loop()
+    address = await loop.run_in_executor(None, device_address, config)
+    device = AsyncTuyaDevice(
+        config["device_id"],
+        address,
+        config["local_key"],
+        version=config.get("version", "3.5"),
+        port=config.get("port", tinytuya.TCPPORT),
+        resolver=discovery.resolve,
+    )
+    await device.connect()
+    return device
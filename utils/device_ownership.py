@@ -0,0 +1,108 @@
+"""
+Per-device ownership for lighting programs.
+
+Every bulb has at most one program writing to it at a time. Claims are
+tracked per device: an exclusive claim preempts whatever owns those bulbs,
+while prioritised claims are layered, and the highest priority claim (the
+newest one on a tie) owns each frame slot. Writes from programs that do not
+currently own a bulb are dropped instead of being sent.
+"""
+
+import itertools
+import threading
+
+from utils import metrics
+
+# Device methods that only read state and are never gated
+READ_METHODS = ("status", "cached_status", "receive")
+
+
+class OwnershipTable:
+    """Tracks which program owns each bulb"""
+
+    def __init__(self):
+        self._claims = {}  # bulb name -> {owner: (priority, seq)}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def claim(self, owner, bulb_names, priority=None):
+        """Claim bulbs for an owner
+
+        Args:
+            owner: Key identifying the program run
+            bulb_names: Bulbs the program will write to
+            priority: None for an exclusive claim, or an integer to layer
+                the claim with the others on these bulbs
+
+        Returns:
+            Owners that were preempted and should be stopped
+        """
+        preempted = set()
+        with self._lock:
+            seq = next(self._seq)
+            for name in bulb_names:
+                claims = self._claims.setdefault(name, {})
+                if priority is None:
+                    preempted.update(other for other in claims if other != owner)
+                claims[owner] = (priority or 0, seq)
+
+            # Preempted owners lose every bulb, not just the overlapping ones
+            for other in preempted:
+                self._remove(other)
+
+        return preempted
+
+    def _remove(self, owner):
+        for name in list(self._claims):
+            claims = self._claims[name]
+            claims.pop(owner, None)
+            if not claims:
+                del self._claims[name]
+
+    def release(self, owner):
+        """Drop every claim held by an owner"""
+        with self._lock:
+            self._remove(owner)
+
+    def owner_of(self, bulb_name):
+        """The owner of a bulb's frame slot, or None"""
+        # claim() and release() change the claims from other threads
+        with self._lock:
+            claims = self._claims.get(bulb_name)
+            if not claims:
+                return None
+            return max(claims.items(), key=lambda item: item[1])[0]
+
+    def owns(self, owner, bulb_name):
+        return self.owner_of(bulb_name) == owner
+
+    def snapshot(self):
+        """Current owner of every claimed bulb"""
+        return {name: self.owner_of(name) for name in list(self._claims)}
+
+
+class OwnedDevice:
+    """Device wrapper that only lets the bulb's current owner write
+
+    Reads always pass through. Writes from a program that has lost the
+    bulb's frame slot are dropped and return None.
+    """
+
+    def __init__(self, device, bulb_name, owner, table):
+        self._device = device
+        self._bulb_name = bulb_name
+        self._owner = owner
+        self._table = table
+
+    def __getattr__(self, name):
+        attr = getattr(self._device, name)
+        if not callable(attr) or name in READ_METHODS:
+            return attr
+
+        def gated(*args, **kwargs):
+            if not self._table.owns(self._owner, self._bulb_name):
+                metrics.SUPPRESSED_WRITES.inc((self._bulb_name,))
+                return None
+            return attr(*args, **kwargs)
+
+        return gated
@@ -0,0 +1,472 @@
+"""
+Bulb connections split across worker processes.
+
+With one process owning every bulb's socket, encryption and command queue,
+the GIL becomes the bottleneck as the fleet grows. With
+SMARTHOME_DEVICE_SHARDS set to N, bulbs are partitioned across N worker
+processes by a stable hash of their device id. Each worker connects the
+bulbs of its shard and runs their command queues and rate limiters. The
+server keeps a ShardedQueues, which has the interface of CommandQueues and
+sends every command over a pipe to the worker that owns the bulb.
+
+Commands reach a worker by reference, so they must be module-level
+functions of an importable module such as commands.bulb_commands. The
+queue wait and device spans a worker records come back with each result,
+so the server's traces, command metrics and link stats (and with them
+frame pacing) see a sharded bulb as if it were local. A worker that dies
+is restarted on its next command and reconnects its bulbs.
+
+Usage:
+    queues = ShardedQueues(4)
+    device = queues.connect("top", config)
+    queues.run("top", set_brightness, 500)
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from utils import metrics, tracing
+from utils.command_queue import EFFECT, INTERACTIVE, CommandQueues
+from utils.frame_pacing import get_link_stats
+from utils.log_config import configure_logging
+
+# Worker processes the bulbs are split across; 0 keeps them in the server
+SHARD_COUNT = int(os.environ.get("SMARTHOME_DEVICE_SHARDS", "0"))
+
+# Seconds to wait for a worker to connect a bulb (which may wait for its
+# discovery broadcast) and to report its queue depths
+CONNECT_TIMEOUT = 30
+STATS_TIMEOUT = 2
+
+log = logging.getLogger(__name__)
+
+_ids = itertools.count(1)
+
+
+def shard_of(device_id, shards):
+    """Index of the worker that owns a device, stable across restarts"""
+    return zlib.crc32(str(device_id).encode()) % shards
+
+
+def _worker_main(conn, root_dir):
+    """Entry point of a shard worker: serve its bulbs until told to exit"""
+    if root_dir not in sys.path:
+        sys.path.insert(0, root_dir)
+    # Spawned workers start with no handlers; SMARTHOME_LOG_* is inherited
+    configure_logging()
+
+    queues = CommandQueues()
+    send_lock = threading.Lock()
+
+    def reply(req_id, status, value, spans=(), link=None):
+        with send_lock:
+            try:
+                conn.send((req_id, status, value, spans, link))
+            except (OSError, EOFError):
+                pass  # The server is gone; recv() ends the loop
+            except Exception as e:  # A result or error that does not pickle
+                conn.send((req_id, "error", RuntimeError(str(e)), spans, link))
+
+    def connect(req_id, name, config):
+        try:
+            queues.connect(name, config)
+        except Exception as e:
+            reply(req_id, "error", e)
+            return
+        reply(req_id, "ok", None)
+
+    def done(req_id, name, trace, future):
+        try:
+            link = get_link_stats(queues.get(name).device).as_dict()
+        except KeyError:
+            link = None
+        if future.cancelled():
+            reply(req_id, "cancelled", None, trace.spans, link)
+        elif future.exception() is not None:
+            reply(req_id, "error", future.exception(), trace.spans, link)
+        else:
+            reply(req_id, "ok", future.result(), trace.spans, link)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        kind, req_id = message[0], message[1]
+        if kind == "exit":
+            break
+        try:
+            if kind == "call":
+                _, _, name, func, args, kwargs, lane, key = message
+                # The queue worker adds its spans to the current trace
+                trace = tracing.Trace(name, "shard", {})
+                with tracing.use(trace):
+                    if isinstance(func, str):
+                        # A device method, called like QueuedDevice does
+                        queue = queues.get(name)
+                        method = getattr(queue.device, func)
+                        future = queue.submit(
+                            method, *args, lane=lane, key=key, **kwargs
+                        )
+                    else:
+                        future = queues.submit(
+                            name, func, *args, lane=lane, key=key, **kwargs
+                        )
+                future.add_done_callback(
+                    lambda f, req_id=req_id, name=name, trace=trace: done(
+                        req_id, name, trace, f
+                    )
+                )
+            elif kind == "connect":
+                # Connecting may wait for a broadcast; keep serving commands
+                threading.Thread(
+                    target=connect, args=(req_id,) + message[2:], daemon=True
+                ).start()
+            elif kind == "remove":
+                _, _, name, drain, timeout = message
+                reply(req_id, "ok", queues.remove(name, drain, timeout))
+            elif kind == "stats":
+                stats = {"depths": queues.depths(), "frames": queues.frame_counts()}
+                reply(req_id, "ok", stats)
+            elif kind == "close":
+                _, _, drain, timeout = message
+                queues.close(drain=drain, timeout=timeout)
+                reply(req_id, "ok", None)
+        except Exception as e:
+            reply(req_id, "error", e)
+
+    queues.close(drain=False, timeout=1)
+
+
+class _Worker:
+    """One shard process and the futures of the requests it has not answered"""
+
+    def __init__(self, context, root_dir, index):
+        self.index = index
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, root_dir),
+            name=f"device-shard-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.alive = True
+        self._pending = {}  # request id -> (Future, on_result)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read, name=f"device-shard-{index}", daemon=True
+        )
+        self._reader.start()
+
+    def request(self, kind, *fields, on_result=None):
+        """Send a request and return a Future for the worker's answer
+
+        Args:
+            kind: "connect", "call", "remove", "stats" or "close"
+            fields: The request's arguments
+            on_result: Optional func(spans, link) run before the Future
+                resolves, with the spans and link stats sent back
+        """
+        future = Future()
+        req_id = next(_ids)
+        with self._lock:
+            if not self.alive:
+                raise ConnectionError(f"Device worker {self.index} exited")
+            self._pending[req_id] = (future, on_result)
+        try:
+            with self._send_lock:
+                self.conn.send((kind, req_id) + fields)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(req_id, None)
+            raise
+        return future
+
+    def _read(self):
+        while True:
+            try:
+                req_id, status, value, spans, link = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future, on_result = self._pending.pop(req_id, (None, None))
+            if future is None or future.done():
+                continue
+            if on_result is not None:
+                try:
+                    on_result(spans, link)
+                except Exception:
+                    log.exception("Recording a result of worker %d failed", self.index)
+            if status == "ok":
+                future.set_result(value)
+            elif status == "cancelled":
+                future.cancel()
+            else:
+                future.set_exception(value)
+
+        with self._lock:
+            self.alive = False
+            pending = list(self._pending.values())
+            self._pending = {}
+        for future, _ in pending:
+            if not future.done():
+                future.set_exception(
+                    ConnectionError(f"Device worker {self.index} exited")
+                )
+
+    def close(self, timeout=1):
+        try:
+            with self._send_lock:
+                self.conn.send(("exit", 0))
+        except (OSError, EOFError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ShardDevice:
+    """Device proxy whose method calls run on the bulb's queue in its worker
+
+    Calls block until the command has run, like QueuedDevice, and effect
+    frames are coalesced per method.
+    """
+
+    # Link statistics are recorded by the worker and copied back
+    records_link_stats = True
+
+    def __init__(self, queues, name, device_id, lane=EFFECT, segments=None):
+        self._queues = queues
+        self._name = name
+        self._lane = lane
+        self.id = device_id
+        # Light strips' segment count, so programs can tell them from bulbs
+        self.segments = segments
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self._queues.run(
+                self._name, method, *args, lane=self._lane, key=method, **kwargs
+            )
+
+        return call
+
+
+class ShardQueue:
+    """Server-side stand-in for a bulb's DeviceCommandQueue in its worker"""
+
+    def __init__(self, queues, name, config):
+        self.name = name
+        self.device = ShardDevice(
+            queues, name, config["device_id"], INTERACTIVE, config.get("segments")
+        )
+
+
+class ShardedQueues:
+    """CommandQueues whose bulbs are connected and served by worker processes
+
+    Workers are started on first use.
+
+    Args:
+        shards: Number of worker processes
+        root_dir: Repository root the workers import commands from
+    """
+
+    def __init__(self, shards=SHARD_COUNT, root_dir=None):
+        self.shards = max(1, shards)
+        self.root_dir = root_dir or os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))
+        )
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [None] * self.shards
+        self._configs = {}  # Bulb name -> config, for reconnecting
+        self._queues = {}  # Bulb name -> ShardQueue
+        self._lock = threading.Lock()
+
+    def _worker(self, index):
+        """The shard's worker, (re)started with its bulbs if it is not running"""
+        with self._lock:
+            worker = self._workers[index]
+            if worker is not None and worker.alive:
+                return worker
+            if worker is not None:
+                log.warning("Device worker %d exited, restarting it", index)
+                worker.close(timeout=0)
+            worker = self._workers[index] = _Worker(
+                self._context, self.root_dir, index
+            )
+            reconnect = [
+                (name, config)
+                for name, config in self._configs.items()
+                if shard_of(config["device_id"], self.shards) == index
+            ]
+        for name, config in reconnect:
+            try:
+                worker.request("connect", name, config).result(CONNECT_TIMEOUT)
+            except Exception as e:
+                log.warning("Could not reconnect %s in worker %d: %s", name, index, e)
+        return worker
+
+    def shard(self, name):
+        """Index of the worker that owns a connected bulb"""
+        return shard_of(self._configs[name]["device_id"], self.shards)
+
+    def connect(self, name, config):
+        """Connect a bulb in the worker that owns it
+
+        Args:
+            name: Bulb name
+            config: Device configuration from setup_devices()
+
+        Returns:
+            A device proxy whose calls go through the interactive lane
+        """
+        index = shard_of(config["device_id"], self.shards)
+        self._worker(index).request("connect", name, config).result(CONNECT_TIMEOUT)
+        with self._lock:
+            self._configs[name] = config
+            queue = self._queues[name] = ShardQueue(self, name, config)
+        return queue.device
+
+    def remove(self, name, drain=True, timeout=None):
+        """Stop a bulb's queue in its worker and close its connection
+
+        Returns:
+            False if the bulb had no queue
+        """
+        with self._lock:
+            config = self._configs.pop(name, None)
+            self._queues.pop(name, None)
+        if config is None:
+            return False
+        index = shard_of(config["device_id"], self.shards)
+        future = self._worker(index).request("remove", name, drain, timeout)
+        return future.result(None if timeout is None else timeout + STATS_TIMEOUT)
+
+    def get(self, name):
+        return self._queues[name]
+
+    def __contains__(self, name):
+        return name in self._queues
+
+    def submit(self, name, func, *args, lane=INTERACTIVE, key=None, **kwargs):
+        """Queue func(device, *args) on a bulb's queue and return its Future
+
+        Args:
+            func: Module-level function, or the name of a device method
+                to call with args
+        """
+        index = self.shard(name)
+        device = self._queues[name].device
+        trace = tracing.current()
+        sent = time.monotonic()
+
+        def on_result(spans, link):
+            self._record(name, index, device, trace, sent, spans, link)
+
+        return self._worker(index).request(
+            "call", name, func, args, kwargs, lane, key, on_result=on_result
+        )
+
+    def run(self, name, func, *args, lane=INTERACTIVE, **kwargs):
+        """Run func(device, *args) on a bulb's queue and wait for the result"""
+        return self.submit(name, func, *args, lane=lane, **kwargs).result()
+
+    def device(self, name, lane=EFFECT):
+        """A proxy for a bulb's device whose calls go through the given lane"""
+        config = self._configs[name]
+        return ShardDevice(
+            self, name, config["device_id"], lane, config.get("segments")
+        )
+
+    @staticmethod
+    def _record(name, index, device, trace, sent, spans, link):
+        """Fold what the worker recorded for a command into this process"""
+        for span_name, start, end, attrs in spans:
+            if span_name == "device":
+                metrics.COMMANDS.inc((name, attrs["op"], attrs["outcome"]))
+                metrics.COMMAND_LATENCY.observe(end - start, (name, attrs["op"]))
+        if trace is not None:
+            if spans:
+                trace.add_span("shard_ipc", sent, spans[0][1], bulb=name, shard=index)
+            for span_name, start, end, attrs in spans:
+                trace.add_span(span_name, start, end, **attrs)
+        if link:
+            stats = get_link_stats(device)
+            stats.rtt = link["rtt"]
+            stats.drop_rate = link["drop_rate"]
+            stats.samples = link["samples"]
+
+    def _stats(self):
+        """Queue depths and frame counts of every running worker"""
+        with self._lock:
+            workers = [w for w in self._workers if w is not None and w.alive]
+        futures = []
+        for worker in workers:
+            try:
+                futures.append(worker.request("stats"))
+            except (OSError, ConnectionError):
+                continue
+        depths, frames = {}, {}
+        for future in futures:
+            try:
+                stats = future.result(STATS_TIMEOUT)
+            except Exception:
+                continue
+            depths.update(stats["depths"])
+            frames.update(stats["frames"])
+        return depths, frames
+
+    def depths(self):
+        return self._stats()[0]
+
+    def frame_counts(self):
+        """Coalesced, stale-dropped and rate-shed effect frames of every queue"""
+        return self._stats()[1]
+
+    def close(self, drain=True, timeout=None):
+        """Stop every worker, optionally running queued commands first
+
+        The workers drain in parallel; timeout bounds the whole shutdown.
+        """
+        with self._lock:
+            workers = [w for w in self._workers if w is not None]
+            self._workers = [None] * self.shards
+            self._queues = {}
+            self._configs = {}
+        closing = []
+        for worker in workers:
+            try:
+                closing.append(worker.request("close", drain, timeout))
+            except (OSError, ConnectionError):
+                pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for future in closing:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            try:
+                future.result(remaining)
+            except Exception:
+                pass
+        for worker in workers:
+            worker.close()
+
+
+def create_queues(shards=SHARD_COUNT):
+    """The server's command queues: sharded across workers when shards > 0"""
+    return ShardedQueues(shards) if shards > 0 else CommandQueues()
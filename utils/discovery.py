@@ -0,0 +1,272 @@
+"""
+Tuya device discovery and a persistent device id to IP address cache.
+
+Tuya devices announce themselves every few seconds with a UDP broadcast
+on port 6666 (plain, protocol 3.1), 6667 (encrypted, 3.3 and later) or
+7000 (app discovery, 3.5). A background listener decodes these with
+tinytuya.decrypt_udp and keeps the newest address of every device id in
+a JSON file, so a bulb whose devices.json entry has no IP (or whose IP
+changed after a DHCP renewal) is found without tinytuya's network scan.
+
+Usage:
+    from utils import discovery
+
+    discovery.start()
+    ip = discovery.lookup(device_id) or discovery.resolve(device_id)
+"""
+
+import json
+import logging
+import os
+import selectors
+import socket
+import threading
+import time
+
+import tinytuya
+
+# Older tinytuya releases have no app discovery port constant (7000)
+DISCOVERY_PORTS = (
+    tinytuya.UDPPORT,
+    tinytuya.UDPPORTS,
+    getattr(tinytuya, "UDPPORTAPP", 7000),
+)
+
+# Set SMARTHOME_DISCOVERY=0 to never listen for broadcasts
+ENABLED = os.environ.get("SMARTHOME_DISCOVERY", "1") != "0"
+
+# Where the id -> IP cache is kept between runs
+CACHE_PATH = os.environ.get("SMARTHOME_IP_CACHE", "ip_cache.json")
+
+# Seconds to wait for one device's broadcast; devices send one about
+# every 5 seconds, so this covers at least one of them
+RESOLVE_TIMEOUT = float(os.environ.get("SMARTHOME_RESOLVE_TIMEOUT", "8"))
+
+# Seconds after a resolve for a device before another one waits again
+RESOLVE_COOLDOWN = 30
+
+log = logging.getLogger(__name__)
+
+
+def parse_broadcast(data, sender=None):
+    """Decode a discovery broadcast
+
+    Args:
+        data: Raw UDP payload
+        sender: IP address the packet came from, used when it names none
+
+    Returns:
+        Dict with id, ip and version, or None if it is not a Tuya broadcast
+    """
+    try:
+        info = json.loads(tinytuya.decrypt_udp(data))
+    except Exception:
+        return None
+    if not isinstance(info, dict):
+        return None
+    dev_id = info.get("gwId") or info.get("id")
+    ip = info.get("ip") or sender
+    if not dev_id or not ip:
+        return None
+    return {"id": dev_id, "ip": ip, "version": info.get("version")}
+
+
+class IPCache:
+    """Device id -> last seen address, saved to a JSON file on change"""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable IP cache %s: %s", path, e)
+
+    def get(self, dev_id):
+        entry = self._entries.get(dev_id)
+        return entry["ip"] if entry else None
+
+    def entry(self, dev_id):
+        """{"ip", "version", "seen"} of a device, or None"""
+        entry = self._entries.get(dev_id)
+        return dict(entry) if entry else None
+
+    def update(self, dev_id, ip, version=None):
+        """Record a sighting; the file is only rewritten when an address changes
+
+        Returns:
+            True if the device is new or its address changed
+        """
+        with self._lock:
+            entry = self._entries.get(dev_id)
+            changed = entry is None or entry["ip"] != ip
+            self._entries[dev_id] = {
+                "ip": ip,
+                "version": version or (entry or {}).get("version"),
+                "seen": time.time(),
+            }
+            if changed:
+                self._save()
+        return changed
+
+    def _save(self):
+        temp = f"{self.path}.tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(self._entries, f, indent=4, sort_keys=True)
+            os.replace(temp, self.path)
+        except OSError as e:
+            log.warning("Could not save IP cache %s: %s", self.path, e)
+
+
+class DiscoveryService:
+    """Background listener that keeps an IPCache current
+
+    Args:
+        cache: IPCache to record sightings in
+        ports: UDP ports to listen on; ports that cannot be bound are skipped
+    """
+
+    def __init__(self, cache, ports=DISCOVERY_PORTS):
+        self.cache = cache
+        self.ports = ports
+        self._selector = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._seen = threading.Condition()
+        self._sightings = {}  # dev_id -> (monotonic time, ip)
+        self._last_resolve = {}  # dev_id -> monotonic time of last wait
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Bind the discovery ports and start listening (idempotent)"""
+        if self.running:
+            return True
+        if not ENABLED:
+            return False
+        if not hasattr(tinytuya, "decrypt_udp"):
+            log.warning("tinytuya %s cannot decode broadcasts", tinytuya.__version__)
+            return False
+        selector = selectors.DefaultSelector()
+        for port in self.ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            try:
+                sock.bind(("", port))
+            except OSError as e:
+                log.warning("Discovery cannot listen on UDP %d: %s", port, e)
+                sock.close()
+                continue
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+        if not selector.get_map():
+            selector.close()
+            return False
+        self._selector = selector
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="discovery", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _run(self):
+        selector = self._selector
+        try:
+            while not self._stop.is_set():
+                for key, _ in selector.select(timeout=0.5):
+                    try:
+                        data, (sender, _) = key.fileobj.recvfrom(4096)
+                    except OSError:
+                        continue
+                    self.record(parse_broadcast(data, sender))
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+
+    def record(self, info):
+        """Store a parsed broadcast and wake anyone resolving that device"""
+        if info is None:
+            return
+        if self.cache.update(info["id"], info["ip"], info["version"]):
+            log.info("Discovered %s at %s", info["id"], info["ip"])
+        with self._seen:
+            self._sightings[info["id"]] = (time.monotonic(), info["ip"])
+            self._seen.notify_all()
+
+    def resolve(self, dev_id, stale_ip=None, timeout=RESOLVE_TIMEOUT):
+        """Find a device's current address
+
+        The cached address is returned at once unless it is missing or is
+        the one that just failed (stale_ip). Otherwise this waits for the
+        device's next broadcast, which is targeted and far quicker than a
+        scan of the network. Waits for one device are limited to one per
+        RESOLVE_COOLDOWN so an unplugged bulb does not stall every command.
+
+        Returns:
+            The address, or the cached one (possibly None) if the device
+            did not announce itself in time
+        """
+        cached = self.cache.get(dev_id)
+        if cached and cached != stale_ip:
+            return cached
+        now = time.monotonic()
+        last = self._last_resolve.get(dev_id)
+        if last is not None and now - last < RESOLVE_COOLDOWN:
+            return cached
+        self._last_resolve[dev_id] = now
+        if not self.start():
+            return cached
+
+        deadline = now + timeout
+        with self._seen:
+            while True:
+                seen = self._sightings.get(dev_id)
+                if seen is not None and seen[0] >= now:
+                    return seen[1]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning("%s not seen within %ss", dev_id, timeout)
+                    return cached
+                self._seen.wait(remaining)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """The process-wide DiscoveryService, created on first use"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = DiscoveryService(IPCache())
+        return _service
+
+
+def start():
+    """Start listening for broadcasts in the background"""
+    return get_service().start()
+
+
+def lookup(dev_id):
+    """Cached address of a device, without waiting"""
+    return get_service().cache.get(dev_id)
+
+
+def resolve(dev_id, stale_ip=None, timeout=RESOLVE_TIMEOUT):
+    """Current address of a device; see DiscoveryService.resolve"""
+    return get_service().resolve(dev_id, stale_ip, timeout)
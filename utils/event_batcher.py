@@ -0,0 +1,190 @@
+"""
+Coalesced, batched Socket.IO bulb updates.
+
+Instead of one event per command (or per program frame) for every client,
+changes are merged per bulb and sent as one "bulb_updates" event per tick
+holding only the fields that changed since the last one:
+
+    {"bulbs": {"top": {"brightness": 500}, "desk": {"power": false}}}
+
+Clients subscribe to the bulbs they watch and may ask for a lower event
+rate. Clients with the same subscription and rate share a Socket.IO room,
+so each tick costs one emit per distinct subscription, not per client.
+
+Usage:
+    updates = EventBatcher(socketio)
+    updates.start()
+    updates.subscribe(sid, ["top"], max_rate=5)
+    updates.update("top", {"brightness": 500})
+"""
+
+import threading
+import time
+
+from utils import metrics
+
+EVENT = "bulb_updates"
+
+# Seconds between ticks; updates within a tick are merged
+DEFAULT_INTERVAL = 0.1
+
+# Events per second a client gets unless it asks for fewer
+DEFAULT_CLIENT_RATE = 10
+
+UPDATES = metrics.REGISTRY.counter(
+    "smarthome_bulb_updates_total",
+    "Bulb state changes queued for Socket.IO clients",
+)
+EVENTS = metrics.REGISTRY.counter(
+    "smarthome_bulb_update_events_total",
+    "Batched bulb_updates events emitted, one per subscription room",
+)
+
+
+class _Group:
+    """Clients sharing a subscription and rate, i.e. one Socket.IO room"""
+
+    __slots__ = ("room", "bulbs", "interval", "members", "pending", "next_due")
+
+    def __init__(self, room, bulbs, interval):
+        self.room = room
+        self.bulbs = bulbs  # frozenset of bulb names, None for every bulb
+        self.interval = interval
+        self.members = set()
+        self.pending = {}
+        self.next_due = 0.0
+
+    def watches(self, bulb):
+        return self.bulbs is None or bulb in self.bulbs
+
+
+class EventBatcher:
+    """Merge bulb updates and emit them to subscribed clients in batches
+
+    Args:
+        socketio: The Flask-SocketIO instance to emit on
+        interval: Seconds between ticks
+        client_rate: Default and maximum events per second per client
+        namespace: Socket.IO namespace of the clients
+    """
+
+    def __init__(
+        self,
+        socketio,
+        interval=DEFAULT_INTERVAL,
+        client_rate=DEFAULT_CLIENT_RATE,
+        namespace="/",
+    ):
+        self.socketio = socketio
+        self.interval = interval
+        self.client_rate = client_rate
+        self.namespace = namespace
+        self._groups = {}  # room -> _Group
+        self._clients = {}  # sid -> room
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+
+    def _client_interval(self, max_rate):
+        rate = self.client_rate
+        if max_rate:
+            rate = min(rate, float(max_rate))
+        return max(self.interval, 1.0 / rate)
+
+    def subscribe(self, sid, bulbs=None, max_rate=None):
+        """Send a client updates for the given bulbs (every bulb when None)
+
+        Args:
+            sid: Socket.IO session id
+            bulbs: Bulb names to watch, or None for all of them
+            max_rate: Highest events per second the client wants
+
+        Returns:
+            The room the client was put in
+        """
+        bulbs = frozenset(bulbs) if bulbs is not None else None
+        interval = self._client_interval(max_rate)
+        watched = ",".join(sorted(bulbs)) if bulbs is not None else "*"
+        room = f"bulbs:{watched}@{interval:g}"
+
+        with self._lock:
+            previous = self._clients.get(sid)
+            if previous == room:
+                return room
+            self._leave(sid)
+            group = self._groups.get(room)
+            if group is None:
+                group = self._groups[room] = _Group(room, bulbs, interval)
+            group.members.add(sid)
+            self._clients[sid] = room
+        if previous is not None:
+            self.socketio.server.leave_room(sid, previous, namespace=self.namespace)
+        self.socketio.server.enter_room(sid, room, namespace=self.namespace)
+        return room
+
+    def unsubscribe(self, sid):
+        """Forget a client (on disconnect)"""
+        with self._lock:
+            self._leave(sid)
+
+    def _leave(self, sid):
+        room = self._clients.pop(sid, None)
+        group = self._groups.get(room)
+        if group is not None:
+            group.members.discard(sid)
+            if not group.members:
+                del self._groups[room]
+
+    def update(self, bulb, fields):
+        """Queue changed fields of a bulb; later values replace earlier ones"""
+        UPDATES.inc()
+        with self._lock:
+            for group in self._groups.values():
+                if group.watches(bulb):
+                    group.pending.setdefault(bulb, {}).update(fields)
+
+    def flush(self, force=False):
+        """Emit the pending updates of every room that is due
+
+        Args:
+            force: Emit to every room with pending updates regardless of rate
+
+        Returns:
+            Number of events emitted
+        """
+        now = time.monotonic()
+        batches = []
+        with self._lock:
+            for group in self._groups.values():
+                if group.pending and (force or now >= group.next_due):
+                    batches.append((group.room, group.pending))
+                    group.pending = {}
+                    group.next_due = now + group.interval
+        for room, pending in batches:
+            self.socketio.emit(
+                EVENT, {"bulbs": pending}, to=room, namespace=self.namespace
+            )
+            EVENTS.inc()
+        return len(batches)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.socketio.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        """Start the background task that emits once per tick"""
+        if self._task is None:
+            self._stop.clear()
+            self._task = self.socketio.start_background_task(self._run)
+
+    def stop(self):
+        """Stop ticking and send whatever is still pending"""
+        self._stop.set()
+        self._task = None
+        self.flush(force=True)
+
+    def rooms(self):
+        """{room: number of clients} for debugging"""
+        with self._lock:
+            return {room: len(group.members) for room, group in self._groups.items()}
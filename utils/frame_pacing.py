@@ -0,0 +1,235 @@
+"""
+Adaptive frame pacing for light effect programs.
+
+Each device keeps a moving estimate of its command round-trip time (RTT)
+and drop rate. Programs use a FramePacer to turn those estimates into the
+shortest frame interval the devices can sustain without building a backlog.
+"""
+
+import threading
+import time
+import weakref
+
+from utils import metrics, tracing
+
+# Weight given to the newest sample in the moving averages
+SMOOTHING = 0.2
+
+# Extra time allowed on top of the measured frame time
+HEADROOM = 1.25
+
+# Default pacing limits in seconds, overridden per program
+DEFAULT_MIN_INTERVAL = 0.05
+DEFAULT_MAX_INTERVAL = 2.0
+
+
+class LinkStats:
+    """Moving estimate of RTT and drop rate for one device"""
+
+    def __init__(self, smoothing=SMOOTHING):
+        self.smoothing = smoothing
+        self.rtt = None
+        self.drop_rate = 0.0
+        self.samples = 0
+
+    def record(self, rtt, ok=True):
+        """Fold a new command result into the estimates
+
+        Args:
+            rtt: Round-trip time of the command in seconds
+            ok: Whether the device accepted the command
+        """
+        a = self.smoothing
+        if ok:
+            self.rtt = rtt if self.rtt is None else (1 - a) * self.rtt + a * rtt
+        self.drop_rate = (1 - a) * self.drop_rate + a * (0.0 if ok else 1.0)
+        self.samples += 1
+
+    def frame_cost(self, fallback):
+        """Expected time one frame costs on this device, penalised for drops"""
+        rtt = self.rtt if self.rtt is not None else fallback
+        return rtt * (1 + 4 * self.drop_rate)
+
+    def as_dict(self):
+        return {
+            "rtt": self.rtt,
+            "drop_rate": round(self.drop_rate, 4),
+            "samples": self.samples,
+        }
+
+
+_link_stats = {}
+_link_stats_lock = threading.Lock()
+
+
+def device_key(device):
+    """Stable key for a device object (its Tuya id when it has one)"""
+    return getattr(device, "id", None) or id(device)
+
+
+def get_link_stats(device):
+    """Return the shared LinkStats for a device, creating it if needed"""
+    key = device_key(device)
+    stats = _link_stats.get(key)
+    if stats is None:
+        with _link_stats_lock:
+            stats = _link_stats.setdefault(key, LinkStats())
+    return stats
+
+
+def link_stats_snapshot():
+    """Return the current estimates for every known device"""
+    return {str(key): stats.as_dict() for key, stats in list(_link_stats.items())}
+
+
+class FramePacer:
+    """Paces the frames of an effect to what its devices can deliver
+
+    Frames are sent to each device in turn, so the frame time is the sum of
+    the per-device costs. The interval is that sum plus headroom, clamped to
+    the program's limits. Passing a fixed interval disables adaptation.
+    """
+
+    def __init__(
+        self,
+        devices,
+        min_interval=DEFAULT_MIN_INTERVAL,
+        max_interval=DEFAULT_MAX_INTERVAL,
+        fixed_interval=None,
+        name="program",
+    ):
+        """
+        Args:
+            devices: Devices each frame is sent to
+            min_interval, max_interval: Limits of the adaptive interval
+            fixed_interval: Interval to use instead of adapting
+            name: Program name the achieved frame rate is reported under
+        """
+        self.devices = devices
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.fixed_interval = fixed_interval
+        self.name = name
+        self.frame_started = time.monotonic()
+        self.frame_period = None  # Moving average of the achieved frame time
+        self.trace = tracing.start(f"frame {name}", kind="frame")
+        _active_pacers.add(self)
+
+    def send(self, func, device, *args):
+        """Call func(device, *args), recording its RTT and outcome"""
+        if getattr(device, "records_link_stats", False):
+            # Queued devices measure the device RTT themselves
+            return func(device, *args)
+
+        start = time.monotonic()
+        try:
+            result = func(device, *args)
+        except Exception:
+            get_link_stats(device).record(time.monotonic() - start, ok=False)
+            raise
+        end = time.monotonic()
+        get_link_stats(device).record(end - start, ok=result is not False)
+        if self.trace is not None:
+            self.trace.add_span("device", start, end, device=str(device_key(device)))
+        return result
+
+    def interval(self):
+        """Current frame interval in seconds"""
+        if self.fixed_interval is not None:
+            return self.fixed_interval
+
+        frame_time = sum(
+            get_link_stats(device).frame_cost(self.min_interval)
+            for device in self.devices
+        )
+        return max(self.min_interval, min(self.max_interval, frame_time * HEADROOM))
+
+    def wait(self, stop_event=None):
+        """Sleep until the next frame is due
+
+        Returns:
+            True if the stop event was set while waiting
+        """
+        interval = self.interval()
+        # Each frame is its own trace: the sends before this wait
+        if self.trace is not None:
+            tracing.finish(self.trace, interval_ms=round(interval * 1000, 3))
+            self.trace = None
+
+        remaining = interval - (time.monotonic() - self.frame_started)
+        if remaining > 0:
+            if stop_event is not None:
+                if stop_event.wait(remaining):
+                    return True
+            else:
+                time.sleep(remaining)
+        now = time.monotonic()
+        self._count_frame(now - self.frame_started)
+        self.frame_started = now
+        self.trace = tracing.start(f"frame {self.name}", kind="frame")
+        return stop_event is not None and stop_event.is_set()
+
+    def close(self):
+        """Finish the last frame's trace and stop reporting the frame rate"""
+        if self.trace is not None:
+            # A frame that sent nothing (the program stopped first) is dropped
+            if self.trace.spans:
+                tracing.finish(self.trace)
+            else:
+                tracing.discard(self.trace)
+            self.trace = None
+        _active_pacers.discard(self)
+
+    def _count_frame(self, period):
+        metrics.PROGRAM_FRAMES.inc((self.name,))
+        if self.frame_period is None:
+            self.frame_period = period
+        else:
+            self.frame_period += SMOOTHING * (period - self.frame_period)
+
+    def fps(self):
+        """Achieved frames per second, or None before the first frame"""
+        if not self.frame_period:
+            return None
+        return 1.0 / self.frame_period
+
+
+# Pacers of the programs currently running, for the frame rate gauge
+_active_pacers = weakref.WeakSet()
+
+
+def _program_fps():
+    fps = {}
+    for pacer in list(_active_pacers):
+        value = pacer.fps()
+        if value is not None:
+            fps[(pacer.name,)] = fps.get((pacer.name,), 0) + value
+    return fps
+
+
+def _link_values(field):
+    return {
+        (str(key),): getattr(stats, field)
+        for key, stats in list(_link_stats.items())
+        if getattr(stats, field) is not None
+    }
+
+
+metrics.REGISTRY.gauge(
+    "smarthome_program_fps",
+    "Frame rate achieved by running programs",
+    ("program",),
+    _program_fps,
+)
+metrics.REGISTRY.gauge(
+    "smarthome_device_rtt_seconds",
+    "Moving average of each device's command round-trip time",
+    ("device",),
+    lambda: _link_values("rtt"),
+)
+metrics.REGISTRY.gauge(
+    "smarthome_device_drop_rate",
+    "Moving average of the fraction of failed commands per device",
+    ("device",),
+    lambda: _link_values("drop_rate"),
+)
@@ -0,0 +1,137 @@
+"""
+Addressable light strips and their frame buffers.
+
+Light strips and multi-segment lamps (category "dc" in devices.json) take
+the color of every segment in one data point: each segment's hsv16 color
+("hhhhssssvvvv") concatenated in strip order, written to the strip's
+segment DP (SEGMENT_DP unless devices.json sets "segment_dp"). A strip
+also answers the colour bulb data points, so programs that set one color
+work on strips unchanged.
+
+Effects draw into a FrameBuffer, one bytearray of packed r, g, b bytes,
+and send the whole frame with set_frame(). With numpy installed the buffer
+also has an (n, 3) uint8 array view, so effects can fill it with array
+operations, and it is encoded without a Python object per pixel.
+
+Usage:
+    frame = strip_frame(device)            # None for a plain bulb
+    frame.fill(255, 0, 0)
+    frame[3] = (0, 0, 255)
+    set_frame(device, frame)
+"""
+
+try:
+    import numpy as np
+except ImportError:  # Optional; frames are then plain bytearrays
+    np = None
+
+from utils.color_encoding import HSV16, encode_pixels
+
+STRIP_CATEGORY = "dc"
+
+# Data point holding the colors of every segment, and the number of
+# segments of a strip when devices.json does not say
+SEGMENT_DP = "61"
+DEFAULT_SEGMENTS = 20
+
+
+class FrameBuffer:
+    """The colors of one frame of a strip, packed as r, g, b bytes
+
+    Args:
+        size: Number of pixels (segments)
+        data: Optional initial bytes, 3 * size of them
+    """
+
+    __slots__ = ("size", "data", "array")
+
+    def __init__(self, size, data=None):
+        self.size = size
+        self.data = bytearray(data) if data is not None else bytearray(3 * size)
+        if len(self.data) != 3 * size:
+            raise ValueError(f"A frame of {size} pixels needs {3 * size} bytes")
+        # (n, 3) view of the same memory, for effects written with numpy
+        self.array = None
+        if np is not None:
+            self.array = np.frombuffer(self.data, dtype=np.uint8).reshape(size, 3)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        index = self._index(index)
+        return tuple(self.data[3 * index : 3 * index + 3])
+
+    def __setitem__(self, index, color):
+        index = self._index(index)
+        self.data[3 * index : 3 * index + 3] = bytes(color)
+
+    def __reduce__(self):
+        # The numpy view is rebuilt over the copied bytes
+        return FrameBuffer, (self.size, bytes(self.data))
+
+    def _index(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("pixel index out of range")
+        return index
+
+    def fill(self, r, g, b, start=0, stop=None):
+        """Set pixels start to stop (default all) to one color"""
+        stop = self.size if stop is None else min(stop, self.size)
+        if stop > start:
+            self.data[3 * start : 3 * stop] = bytes((r, g, b)) * (stop - start)
+
+    def encode(self, hexformat=HSV16):
+        """The segment payload of this frame"""
+        return encode_pixels(self.data, hexformat)
+
+
+def frame_payload(frame, segments=None):
+    """The segment DP value for a FrameBuffer, packed bytes or a payload
+
+    Args:
+        frame: FrameBuffer, packed r, g, b bytes or an encoded payload str
+        segments: The strip's segment count, checked when given
+    """
+    if isinstance(frame, str):
+        return frame
+    pixels = len(frame) if isinstance(frame, FrameBuffer) else len(frame) // 3
+    if segments is not None and pixels != segments:
+        raise ValueError(f"Frame has {pixels} pixels, the strip has {segments}")
+    if isinstance(frame, FrameBuffer):
+        return frame.encode()
+    return encode_pixels(frame)
+
+
+def strip_segments(device):
+    """Number of segments of a strip device (or proxy), or None for a bulb"""
+    segments = getattr(device, "segments", None)
+    return segments if isinstance(segments, int) else None
+
+
+def strip_frame(device):
+    """A blank FrameBuffer sized for a strip, or None if device is a bulb"""
+    segments = strip_segments(device)
+    return FrameBuffer(segments) if segments else None
+
+
+class StripMixin:
+    """Segment frames for a BulbDevice class that drives a light strip
+
+    Instances get segments and segment_dp from devices.json when they are
+    connected.
+    """
+
+    segments = DEFAULT_SEGMENTS
+    segment_dp = SEGMENT_DP
+
+    def set_frame(self, frame, nowait=False):
+        """Write the color of every segment in one message
+
+        Args:
+            frame: FrameBuffer, packed r, g, b bytes or an encoded payload
+        """
+        payload = frame_payload(frame, self.segments)
+        return self.set_value(self.segment_dp, payload, nowait=nowait)
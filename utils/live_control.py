@@ -0,0 +1,163 @@
+"""
+Live control values streamed from the dashboard.
+
+While a slider or color picker is dragged the dashboard sends every value
+over Socket.IO. Sending each one to the bulb would queue far more commands
+than it can take, so values are kept per (bulb, attribute) and only the
+newest is sent. Each bulb has at most one live command in flight, and sends
+are spaced by the bulb's measured frame cost (RTT and drop rate from its
+link stats). The last value of a drag is always sent.
+
+Usage:
+    live = LiveControl(command_queues, {"brightness": set_brightness}, on_done)
+    live.update("top", "brightness", 420)
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from utils import metrics
+from utils.command_queue import INTERACTIVE
+from utils.frame_pacing import HEADROOM, get_link_stats
+
+# Limits in seconds of the spacing between live commands to one bulb
+DEFAULT_MIN_INTERVAL = 0.05
+DEFAULT_MAX_INTERVAL = 1.0
+
+VALUES = metrics.REGISTRY.counter(
+    "smarthome_live_control_values_total",
+    "Live control values received, by whether they were sent or replaced",
+    ("bulb", "attr", "result"),
+)
+
+log = logging.getLogger(__name__)
+
+
+class _BulbGate:
+    """Newest pending value per attribute of one bulb, and its send state"""
+
+    __slots__ = ("pending", "in_flight", "last_sent")
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()  # attr -> (value, sid)
+        self.in_flight = False
+        self.last_sent = 0.0
+
+
+class LiveControl:
+    """Coalesce streamed values into a command rate each bulb can sustain
+
+    Args:
+        queues: CommandQueues the commands are submitted to
+        commands: {attr: func(device, value)} for each controllable attribute
+        on_done: Optional callback(bulb, attr, value, sid, result, error)
+            run once a command finished
+        min_interval, max_interval: Limits of the spacing between sends
+    """
+
+    def __init__(
+        self,
+        queues,
+        commands,
+        on_done=None,
+        min_interval=DEFAULT_MIN_INTERVAL,
+        max_interval=DEFAULT_MAX_INTERVAL,
+    ):
+        self.queues = queues
+        self.commands = commands
+        self.on_done = on_done
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._gates = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="live-control", daemon=True
+        )
+        self._thread.start()
+
+    def interval(self, bulb):
+        """Seconds between live commands to a bulb, from its link stats"""
+        try:
+            device = self.queues.get(bulb).device
+        except KeyError:
+            return self.max_interval
+        cost = get_link_stats(device).frame_cost(self.min_interval) * HEADROOM
+        return max(self.min_interval, min(self.max_interval, cost))
+
+    def update(self, bulb, attr, value, sid=None):
+        """Take the newest value of an attribute; older pending ones are replaced
+
+        Args:
+            bulb: Bulb name
+            attr: Key of the commands dict
+            value: Value passed to the attribute's command
+            sid: Socket.IO session that sent it, passed on to on_done
+        """
+        if attr not in self.commands:
+            raise KeyError(attr)
+        with self._cond:
+            if self._closed:
+                return
+            gate = self._gates.get(bulb)
+            if gate is None:
+                gate = self._gates[bulb] = _BulbGate()
+            if attr in gate.pending:
+                VALUES.inc((bulb, attr, "replaced"))
+            gate.pending[attr] = (value, sid)
+            self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                wait = None
+                for bulb, gate in self._gates.items():
+                    if gate.in_flight or not gate.pending:
+                        continue
+                    due = gate.last_sent + self.interval(bulb)
+                    if due <= now:
+                        self._send(bulb, gate, now)
+                    elif wait is None or due - now < wait:
+                        wait = due - now
+                self._cond.wait(wait)
+
+    def _send(self, bulb, gate, now):
+        attr, (value, sid) = gate.pending.popitem(last=False)
+        gate.in_flight = True
+        gate.last_sent = now
+        VALUES.inc((bulb, attr, "sent"))
+        try:
+            future = self.queues.submit(
+                bulb, self.commands[attr], value, lane=INTERACTIVE
+            )
+        except Exception as e:  # Bulb gone or queue closed
+            gate.in_flight = False
+            log.warning("Live %s for %s not sent: %s", attr, bulb, e)
+            return
+        future.add_done_callback(lambda f: self._done(bulb, attr, value, sid, f))
+
+    def _done(self, bulb, attr, value, sid, future):
+        with self._cond:
+            gate = self._gates.get(bulb)
+            if gate is not None:
+                gate.in_flight = False
+            self._cond.notify()
+        if self.on_done is None or future.cancelled():
+            return
+        error = future.exception()
+        result = None if error is not None else future.result()
+        try:
+            self.on_done(bulb, attr, value, sid, result, error)
+        except Exception:
+            log.exception("Live control callback failed for %s", bulb)
+
+    def close(self):
+        """Stop sending; values not yet sent are discarded"""
+        with self._cond:
+            self._closed = True
+            self._gates.clear()
+            self._cond.notify_all()
+        self._thread.join(timeout=1)
@@ -0,0 +1,176 @@
+"""
+Leveled, queue-based logging for the server, commands and programs.
+
+Logging calls only put a record on an in-memory queue; one listener thread
+formats the records and writes them to stderr, so a program's frame loop
+never blocks on the terminal or the journal. Per-frame and per-command
+success messages are logged at DEBUG and are off by default.
+
+Environment:
+    SMARTHOME_LOG_LEVEL    Default level (INFO)
+    SMARTHOME_LOG_MODULES  Per-module levels, e.g. "programs=DEBUG,werkzeug=WARNING"
+    SMARTHOME_LOG_FORMAT   "text" (default) or "json", one object per line
+
+Usage:
+    import logging
+    from utils.log_config import configure_logging
+
+    log = logging.getLogger(__name__)
+    configure_logging()
+    log.info("Program started", extra={"bulb": "top", "program": "disco_mode"})
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+# Records kept while the listener catches up; beyond this they are dropped
+QUEUE_SIZE = 10000
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+_lock = threading.Lock()
+_listener = None
+_handler = None
+
+
+def _extra(record):
+    return {
+        key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS
+    }
+
+
+class TextFormatter(logging.Formatter):
+    """The message followed by any extra fields as key=value pairs"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with extra fields as top-level keys"""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        entry.update(_extra(record))
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_levels(spec):
+    """Parse "module=LEVEL,..." into {module: level}
+
+    Args:
+        spec: Comma-separated logger names and level names
+
+    Returns:
+        Dict of logger name to numeric level; malformed entries are skipped
+    """
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.partition("=")
+        value = logging.getLevelName(level.strip().upper())
+        if name.strip() and isinstance(value, int):
+            levels[name.strip()] = value
+    return levels
+
+
+def configure_logging(level=None, modules=None, fmt=None, stream=None):
+    """Send all logging through a background queue listener
+
+    Safe to call more than once; only the first call installs handlers.
+    Environment settings override the arguments, which are the defaults
+    of the calling program.
+
+    Args:
+        level: Default level name (SMARTHOME_LOG_LEVEL, else INFO)
+        modules: Dict of logger name to level name for per-module verbosity
+        fmt: "text" or "json" (SMARTHOME_LOG_FORMAT, else text)
+        stream: Where the listener writes (default sys.stderr)
+
+    Returns:
+        The QueueHandler installed on the root logger
+    """
+    global _listener, _handler
+    with _lock:
+        if _handler is not None:
+            return _handler
+
+        level = os.environ.get("SMARTHOME_LOG_LEVEL", level or "INFO").upper()
+        fmt = os.environ.get("SMARTHOME_LOG_FORMAT", fmt or "text")
+
+        output = logging.StreamHandler(stream or sys.stderr)
+        if fmt == "json":
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(TextFormatter(TEXT_FORMAT))
+
+        _handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+        root = logging.getLogger()
+        root.addHandler(_handler)
+        root.setLevel(logging.getLevelName(level))
+
+        levels = {
+            name: logging.getLevelName(value.upper())
+            for name, value in (modules or {}).items()
+        }
+        levels.update(parse_levels(os.environ.get("SMARTHOME_LOG_MODULES")))
+        for name, value in levels.items():
+            logging.getLogger(name).setLevel(value)
+
+        _listener = logging.handlers.QueueListener(
+            _handler.queue, output, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(stop_logging)
+        return _handler
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def dropped_records():
+    """Number of records dropped because the queue was full"""
+    return _handler.dropped if _handler is not None else 0
@@ -0,0 +1,275 @@
+"""
+In-process metrics with a Prometheus text exporter.
+
+Counters and histograms are sharded per thread: each thread only ever
+updates its own dict, so recording takes no lock and never contends with
+other threads. Reading sums the shards, which is cheap because it only
+happens when /metrics is scraped. Gauges are read from callbacks at
+collection time.
+
+Usage:
+    from utils import metrics
+
+    metrics.COMMANDS.inc(("top", "set_color", "ok"))
+    metrics.COMMAND_LATENCY.observe(0.021, ("top", "set_color"))
+    print(metrics.render())
+"""
+
+import bisect
+import logging
+import threading
+
+# Latency buckets in seconds, sized for LAN bulbs (a few ms to timeouts)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+log = logging.getLogger(__name__)
+
+
+class _Sharded:
+    """Base for metrics whose values live in one dict per thread"""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # Merged shards of finished threads
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:  # Once per thread, not per update
+                self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_dead(self):
+        # Short-lived threads (one per HTTP request) would otherwise leave
+        # a shard behind each
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = live
+
+    def _copies(self):
+        with self._shards_lock:
+            self._retire_dead()
+            copies = [shard.copy() for _, shard in self._shards]
+            copies.append(self._retired.copy())
+        return copies
+
+
+class Counter(_Sharded):
+    """Monotonic counter, optionally labelled"""
+
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    @staticmethod
+    def _merge(into, shard):
+        for labels, value in shard.items():
+            into[labels] = into.get(labels, 0) + value
+
+    def values(self):
+        """Totals keyed by label tuple"""
+        totals = {}
+        for shard in self._copies():
+            self._merge(totals, shard)
+        return totals
+
+    def samples(self):
+        for labels, value in sorted(self.values().items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Histogram(_Sharded):
+    """Cumulative histogram with fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # Bucket counts (plus +Inf), then sum
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @staticmethod
+    def _merge(into, shard):
+        for labels, state in shard.items():
+            total = into.get(labels)
+            if total is None:
+                into[labels] = list(state)
+            else:
+                into[labels] = [a + b for a, b in zip(total, state)]
+
+    def values(self):
+        """{labels: {"buckets": [(le, cumulative count)], "count", "sum"}}"""
+        merged = {}
+        for shard in self._copies():
+            self._merge(merged, shard)
+
+        result = {}
+        for labels, state in merged.items():
+            cumulative = 0
+            buckets = []
+            for le, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                buckets.append((le, cumulative))
+            result[labels] = {"buckets": buckets, "count": cumulative, "sum": state[-1]}
+        return result
+
+    def samples(self):
+        for labels, data in sorted(self.values().items()):
+            for le, count in data["buckets"]:
+                yield (
+                    self.name + "_bucket",
+                    self.labelnames + ("le",),
+                    labels + (_format_value(le),),
+                    count,
+                )
+            yield self.name + "_count", self.labelnames, labels, data["count"]
+            yield self.name + "_sum", self.labelnames, labels, data["sum"]
+
+
+class Gauge:
+    """Values read from a callback when metrics are collected
+
+    Args:
+        collect: Callable returning {label tuple: value}
+        kind: "gauge", or "counter" for totals kept elsewhere
+    """
+
+    def __init__(self, name, help, labelnames, collect, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.kind = kind
+
+    def values(self):
+        try:
+            return dict(self.collect())
+        except Exception as e:
+            log.warning("Error collecting metric %s: %s", self.name, e)
+            return {}
+
+    def samples(self):
+        for labels, value in sorted(self.values().items()):
+            yield self.name, self.labelnames, labels, value
+
+
+class Registry:
+    """The set of metrics exported together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, replacing any earlier one with the same name"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, labelnames, collect, kind="gauge"):
+        return self.register(Gauge(name, help, labelnames, collect, kind))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, labels, value in metric.samples():
+                lines.append(
+                    f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """All metrics as a dict: {name: {"label=value,...": value}}"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {}
+        for metric in metrics:
+            result[metric.name] = {
+                ",".join(f"{k}={v}" for k, v in zip(metric.labelnames, labels)): value
+                for labels, value in metric.values().items()
+            }
+        return result
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+REGISTRY = Registry()
+render = REGISTRY.render
+snapshot = REGISTRY.snapshot
+
+# Metrics recorded by the device layer
+COMMANDS = REGISTRY.counter(
+    "smarthome_device_commands_total",
+    "Commands run on a bulb's queue by outcome (ok, error, timeout)",
+    ("bulb", "op", "outcome"),
+)
+COMMAND_LATENCY = REGISTRY.histogram(
+    "smarthome_device_command_seconds",
+    "Device round-trip time of each command",
+    ("bulb", "op"),
+)
+SUPPRESSED_WRITES = REGISTRY.counter(
+    "smarthome_suppressed_writes_total",
+    "Program writes dropped because the program does not own the bulb",
+    ("bulb",),
+)
+PROGRAM_FRAMES = REGISTRY.counter(
+    "smarthome_program_frames_total",
+    "Frames sent by light effect programs",
+    ("program",),
+)
@@ -0,0 +1,97 @@
+"""
+Sampling profiler for a running process.
+
+Samples the stack of every thread at a fixed interval using
+sys._current_frames(), so it covers request threads, queue workers and
+program threads at once, adds little overhead and can be switched on in
+production for a few seconds without restarting anything.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+# Longest profile a caller may ask for, in seconds
+MAX_SECONDS = 60
+
+DEFAULT_INTERVAL = 0.005
+
+_running = threading.Lock()
+
+
+def _function_key(code):
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+def profile(seconds, interval=DEFAULT_INTERVAL, limit=40):
+    """Sample every thread's stack for a number of seconds
+
+    Only one profile runs at a time.
+
+    Args:
+        seconds: How long to sample (capped at MAX_SECONDS)
+        interval: Seconds between samples
+        limit: Number of functions to return
+
+    Returns:
+        Dict with the sample count and the functions with the most
+        samples, as own time (top of stack) and cumulative time (anywhere
+        on the stack); None if another profile is already running
+    """
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        seconds = max(0.0, min(float(seconds), MAX_SECONDS))
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        threads = collections.Counter()
+        samples = 0
+        me = threading.get_ident()
+        names = {}
+
+        started = time.monotonic()
+        deadline = started + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                samples += 1
+                threads[ident] += 1
+                own[_function_key(frame.f_code)] += 1
+                seen = set()
+                while frame is not None:
+                    key = _function_key(frame.f_code)
+                    if key not in seen:
+                        seen.add(key)
+                        cumulative[key] += 1
+                    frame = frame.f_back
+            time.sleep(interval)
+        elapsed = time.monotonic() - started
+
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+
+        def rows(counter):
+            return [
+                {
+                    "function": key,
+                    "samples": count,
+                    "fraction": round(count / samples, 4) if samples else 0,
+                }
+                for key, count in counter.most_common(limit)
+            ]
+
+        return {
+            "seconds": round(elapsed, 3),
+            "interval": interval,
+            "samples": samples,
+            "threads": {
+                names.get(ident, str(ident)): count
+                for ident, count in threads.most_common()
+            },
+            "own": rows(own),
+            "cumulative": rows(cumulative),
+        }
+    finally:
+        _running.release()
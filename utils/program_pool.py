@@ -0,0 +1,282 @@
+"""
+Worker process pool for legacy lighting programs.
+
+Programs that only provide a main() entry point read sys.argv and open their
+own device connections. Running them here gives each one a private process,
+so their arguments are set per process instead of on the server's global
+sys.argv, and every device operation they make is sent back over a pipe to
+the server, which runs it on its own connections.
+"""
+
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+
+from utils.log_config import configure_logging
+
+# Seconds a stopped program gets to unwind before its worker is killed
+STOP_GRACE = 2
+
+log = logging.getLogger(__name__)
+
+
+class ProgramStopped(BaseException):
+    """Raised inside a worker to unwind a program that was asked to stop
+
+    Derives from BaseException so the broad `except Exception` blocks in
+    program loops do not swallow it.
+    """
+
+
+class RemoteTraceback(Exception):
+    """The traceback of a program that failed in a worker process
+
+    Set as the cause of the RuntimeError that run() raises, so the server
+    logs the failure once with the program's own traceback.
+    """
+
+    def __init__(self, tb):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+class RemoteDevice:
+    """Device stand-in used inside a worker process
+
+    Any method call is forwarded to the server, which runs it on the real
+    device for this bulb and sends back the result.
+    """
+
+    def __init__(self, conn, bulb_name):
+        self._conn = conn
+        self._bulb_name = bulb_name
+        self.id = bulb_name
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            self._conn.send(("call", self._bulb_name, method, args, kwargs))
+            kind, value = self._conn.recv()
+            if kind == "stopped":
+                raise ProgramStopped()
+            if kind == "error":
+                raise RuntimeError(value)
+            return value
+
+        return call
+
+
+def _worker_main(conn, root_dir):
+    """Entry point of a pool worker: run programs until told to exit"""
+    if root_dir not in sys.path:
+        sys.path.insert(0, root_dir)
+    os.chdir(root_dir)
+    # Spawned workers start with no handlers; SMARTHOME_LOG_* is inherited
+    configure_logging()
+
+    import utils.device_manager as device_manager
+
+    loaded_mtimes = {}
+    while True:
+        message = conn.recv()
+        if message[0] == "exit":
+            return
+
+        _, program_name, argv, device_configs = message
+        names_by_id = {
+            config["device_id"]: name for name, config in device_configs.items()
+        }
+
+        def setup_devices():
+            return dict(device_configs)
+
+        def connect_device(config):
+            return RemoteDevice(conn, names_by_id[config["device_id"]])
+
+        try:
+            module = importlib.import_module(f"programs.{program_name}")
+            # Pick up edits made since this worker last ran the program
+            mtime = os.stat(module.__file__).st_mtime_ns
+            if loaded_mtimes.setdefault(program_name, mtime) != mtime:
+                module = importlib.reload(module)
+                loaded_mtimes[program_name] = mtime
+            # Route the program's own device setup through the server
+            for target in (module, device_manager):
+                target.setup_devices = setup_devices
+                target.connect_device = connect_device
+
+            # The argv belongs to this process only and is set for this run
+            sys.argv = list(argv)
+            module.main()
+            conn.send(("done", None))
+        except ProgramStopped:
+            conn.send(("done", None))
+        except Exception as e:
+            # Logged by the server, which gets the traceback with the error
+            conn.send(("failed", str(e), traceback.format_exc()))
+
+
+class _Worker:
+    def __init__(self, context, root_dir):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, root_dir), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(("exit",))
+        except (OSError, EOFError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ProgramPool:
+    """Reusable pool of worker processes for main()-only programs"""
+
+    def __init__(self, size, device_lookup, root_dir=None):
+        """
+        Args:
+            size: Maximum number of worker processes
+            device_lookup: Callable returning the server's device for a bulb name
+            root_dir: Repository root the workers import programs from
+        """
+        self.size = size
+        self.device_lookup = device_lookup
+        self.root_dir = root_dir or os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))
+        )
+        self._context = multiprocessing.get_context("spawn")
+        # Idle workers and the started count, guarded by one condition
+        # that is notified whenever a worker is returned or discarded
+        self._idle = []
+        self._cond = threading.Condition()
+        self._started = 0
+        self._workers = []
+
+    def _acquire(self, stop_event=None):
+        """An idle or new worker, waiting while the pool is full
+
+        Returns:
+            None if stop_event was set before a worker became free
+        """
+        with self._cond:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                if self._idle:
+                    return self._idle.pop()
+                if self._started < self.size:
+                    self._started += 1
+                    worker = _Worker(self._context, self.root_dir)
+                    self._workers.append(worker)
+                    return worker
+                # Woken by a returned or discarded worker; the timeout
+                # notices a stop, which does not notify the condition
+                self._cond.wait(0.5)
+
+    def _release(self, worker):
+        with self._cond:
+            self._idle.append(worker)
+            self._cond.notify()
+
+    def _discard(self, worker):
+        worker.close()
+        with self._cond:
+            self._started -= 1
+            if worker in self._workers:
+                self._workers.remove(worker)
+            self._cond.notify()
+
+    def run(
+        self, program_name, argv, device_configs, stop_event=None, device_lookup=None
+    ):
+        """Run a program's main() in a worker and serve its device calls
+
+        Blocks until the program finishes or is stopped. A program stopped
+        while it waits for a free worker is never started.
+
+        Args:
+            program_name: Module name inside the programs package
+            argv: Argument list handed to the program as its sys.argv
+            device_configs: Bulb name to config mapping the program may use
+            stop_event: Optional threading.Event that stops the program
+            device_lookup: Optional override of the pool's device lookup
+
+        Raises:
+            RuntimeError: If the program fails or its worker dies
+        """
+        device_lookup = device_lookup or self.device_lookup
+        worker = self._acquire(stop_event)
+        if worker is None:
+            return
+        failure = None
+        try:
+            worker.conn.send(("run", program_name, list(argv), device_configs))
+            stop_requested_at = None
+            while True:
+                if not worker.conn.poll(0.5):
+                    # A program that makes no device calls never sees the
+                    # stop reply, so give it a grace period then kill it
+                    if stop_event is not None and stop_event.is_set():
+                        stop_requested_at = stop_requested_at or time.monotonic()
+                        if time.monotonic() - stop_requested_at > STOP_GRACE:
+                            self._discard(worker)
+                            return
+                    continue
+
+                message = worker.conn.recv()
+                kind = message[0]
+
+                if kind == "done":
+                    break
+                if kind == "failed":
+                    failure = message[1:]
+                    break
+
+                _, bulb_name, method, args, kwargs = message
+                if stop_event is not None and stop_event.is_set():
+                    worker.conn.send(("stopped", None))
+                    continue
+                try:
+                    device = device_lookup(bulb_name)
+                    result = getattr(device, method)(*args, **kwargs)
+                    worker.conn.send(("result", result))
+                except Exception as e:
+                    worker.conn.send(("error", str(e)))
+        except (EOFError, OSError) as e:
+            self._discard(worker)
+            raise RuntimeError(f"Worker for {program_name} exited: {e}")
+        except BaseException:
+            self._discard(worker)
+            raise
+
+        self._release(worker)
+        if failure is not None:
+            message, tb = failure
+            raise RuntimeError(message) from RemoteTraceback(tb)
+
+    def close(self):
+        """Stop every worker process"""
+        with self._cond:
+            workers = list(self._workers)
+            self._workers = []
+            self._idle = []
+            self._started = 0
+            self._cond.notify_all()
+        for worker in workers:
+            worker.close()
@@ -0,0 +1,151 @@
+"""
+Registry of lighting programs.
+
+Programs are discovered from the programs directory once and their modules
+and metadata are cached. A module is only re-imported when its file
+changes, so starting a program is just a dictionary lookup.
+"""
+
+import importlib
+import inspect
+import os
+import sys
+import threading
+
+# run_program arguments supplied by the server rather than the user
+SERVER_ARGUMENTS = ("device", "stop_event")
+
+
+class ProgramInfo:
+    """Cached module and metadata for one program"""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.module = None
+        self.mtime = None
+        self.description = ""
+        self.supports_run_program = False
+        self.parameters = {}
+        self.error = None
+
+    def load(self, package):
+        """Import the module, or reload it if it was imported before"""
+        mtime = os.stat(self.path).st_mtime_ns
+        module_path = f"{package}.{self.name}"
+        try:
+            if self.module is None:
+                self.module = importlib.import_module(module_path)
+            else:
+                self.module = importlib.reload(self.module)
+            self.error = None
+        except Exception as e:
+            self.error = str(e)
+            raise
+        finally:
+            self.mtime = mtime
+
+        self._read_metadata()
+
+    def _read_metadata(self):
+        doc = inspect.getdoc(self.module) or ""
+        lines = [line for line in doc.splitlines() if line.strip()]
+        # The first docstring line is the title, the second the summary
+        self.description = lines[1] if len(lines) > 1 else (lines[0] if lines else "")
+
+        run_program = getattr(self.module, "run_program", None)
+        self.supports_run_program = callable(run_program)
+        self.parameters = {}
+        if self.supports_run_program:
+            for param in inspect.signature(run_program).parameters.values():
+                if param.name in SERVER_ARGUMENTS:
+                    continue
+                if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                    continue
+                default = None if param.default is param.empty else param.default
+                self.parameters[param.name] = default
+
+    def is_stale(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except OSError:
+            return True
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "description": self.description,
+            "supports_run_program": self.supports_run_program,
+            "parameters": self.parameters,
+            "error": self.error,
+        }
+
+
+class ProgramRegistry:
+    """Discovers programs and hands out cached, up-to-date modules"""
+
+    def __init__(self, programs_dir, package="programs"):
+        self.programs_dir = os.path.abspath(programs_dir)
+        self.package = package
+        self._programs = {}
+        self._dir_mtime = None
+        self._lock = threading.RLock()
+
+        # The package is imported relative to the directory that holds it
+        root_dir = os.path.dirname(self.programs_dir)
+        if root_dir not in sys.path:
+            sys.path.insert(0, root_dir)
+
+    def _refresh(self):
+        """Rescan the directory, but only if its contents changed"""
+        try:
+            dir_mtime = os.stat(self.programs_dir).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if dir_mtime == self._dir_mtime:
+            return
+
+        with self._lock:
+            found = {}
+            if dir_mtime is not None:
+                for filename in os.listdir(self.programs_dir):
+                    if filename.endswith(".py") and not filename.startswith("__"):
+                        name = filename[: -len(".py")]
+                        found[name] = self._programs.get(name) or ProgramInfo(
+                            name, os.path.join(self.programs_dir, filename)
+                        )
+            self._programs = found
+            self._dir_mtime = dir_mtime
+
+    def names(self):
+        """Sorted names of all available programs"""
+        self._refresh()
+        return sorted(self._programs)
+
+    def __contains__(self, name):
+        self._refresh()
+        return name in self._programs
+
+    def get(self, name):
+        """Return the ProgramInfo for a program, importing it if needed
+
+        Raises:
+            KeyError: If no such program exists
+        """
+        self._refresh()
+        info = self._programs[name]
+        if info.module is None or info.is_stale():
+            with self._lock:
+                if info.module is None or info.is_stale():
+                    info.load(self.package)
+        return info
+
+    def metadata(self):
+        """Metadata for every program, importing any that are not loaded yet"""
+        result = {}
+        for name in self.names():
+            try:
+                result[name] = self.get(name).as_dict()
+            except Exception:
+                result[name] = self._programs[name].as_dict()
+        return result
@@ -0,0 +1,170 @@
+"""
+Per-device command rate limits matched to what each bulb can take.
+
+Cheap Tuya bulbs drop or reset their connection when commands arrive
+faster than they can process them. Every command queue takes a token from
+its bulb's TokenBucket before sending. Interactive and automation commands
+wait for a token; effect frames that find the bucket empty are shed
+instead of waiting, and always leave one token for the dashboard.
+
+The rate comes from the bulb's devices.json entry ("max_rate" commands
+per second and "burst") when it is set. Otherwise it is learned per model
+and protocol version: it backs off when commands to a bulb of that model
+fail or time out and creeps back up after a run of successes, so every
+bulb of a model shares what was learned.
+
+Usage:
+    limiter = limiter_for(config)
+    delay = limiter.take(reserve=EFFECT_RESERVE)
+"""
+
+import threading
+import time
+
+from utils import metrics
+
+# Commands per second a bulb starts with when devices.json sets none;
+# older protocol versions negotiate slower and are given less
+DEFAULT_RATES = {"3.1": 3.0, "3.2": 3.0, "3.3": 4.0, "3.4": 6.0, "3.5": 6.0}
+DEFAULT_RATE = 4.0
+DEFAULT_BURST = 4
+
+# Lowest learned rate, and the highest as a multiple of the starting rate
+MIN_RATE = 1.0
+MAX_RATE_FACTOR = 2.0
+
+# Learned rates are multiplied by this on a failure ...
+BACKOFF = 0.75
+# ... and raised by RAISE_STEP after this many successes in a row
+SUCCESS_STREAK = 20
+RAISE_STEP = 0.5
+
+# Tokens effect frames leave for interactive and automation commands
+EFFECT_RESERVE = 1.0
+
+
+class Capacity:
+    """Sustainable command rate of one bulb model and protocol version
+
+    Args:
+        rate: Commands per second
+        burst: Commands that may be sent back to back
+        learn: Adjust the rate from command outcomes; False for rates
+            configured in devices.json
+    """
+
+    def __init__(self, rate, burst=DEFAULT_BURST, learn=True):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.learn = learn
+        self.min_rate = min(MIN_RATE, self.rate)
+        self.max_rate = self.rate * MAX_RATE_FACTOR
+        self._streak = 0
+        self._lock = threading.Lock()
+
+    def record(self, ok):
+        """Fold one command outcome into the learned rate"""
+        if not self.learn:
+            return
+        with self._lock:
+            if not ok:
+                self._streak = 0
+                self.rate = max(self.min_rate, self.rate * BACKOFF)
+                return
+            self._streak += 1
+            if self._streak >= SUCCESS_STREAK:
+                self._streak = 0
+                self.rate = min(self.max_rate, self.rate + RAISE_STEP)
+
+    def as_dict(self):
+        return {"rate": round(self.rate, 3), "burst": self.burst, "learned": self.learn}
+
+
+class TokenBucket:
+    """Token bucket over a (possibly shared) Capacity
+
+    Not thread-safe; each bucket is used by its bulb's queue worker only.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = capacity.burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        capacity = self.capacity
+        self.tokens = min(
+            capacity.burst, self.tokens + (now - self._updated) * capacity.rate
+        )
+        self._updated = now
+
+    def take(self, reserve=0.0, now=None):
+        """Take a token if one is free above the reserve
+
+        Args:
+            reserve: Tokens that must remain after this one
+            now: Current monotonic time (default time.monotonic())
+
+        Returns:
+            0 if a token was taken, else the seconds until one is free
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        needed = 1.0 + min(reserve, self.capacity.burst - 1.0)
+        if self.tokens >= needed:
+            self.tokens -= 1.0
+            return 0
+        return (needed - self.tokens) / self.capacity.rate
+
+    def record(self, ok):
+        self.capacity.record(ok)
+
+
+_capacities = {}
+_capacities_lock = threading.Lock()
+
+
+def model_key(config):
+    """(model, version) a bulb's capacity is learned under"""
+    return (config.get("model") or "unknown", str(config.get("version", "3.5")))
+
+
+def capacity_for(config):
+    """The Capacity of a bulb: configured in devices.json, else learned per model
+
+    Args:
+        config: Device configuration from setup_devices()
+    """
+    if config.get("max_rate"):
+        return Capacity(
+            config["max_rate"], config.get("burst", DEFAULT_BURST), learn=False
+        )
+    key = model_key(config)
+    with _capacities_lock:
+        capacity = _capacities.get(key)
+        if capacity is None:
+            rate = DEFAULT_RATES.get(key[1], DEFAULT_RATE)
+            burst = config.get("burst", DEFAULT_BURST)
+            capacity = _capacities[key] = Capacity(rate, burst)
+        return capacity
+
+
+def limiter_for(config):
+    """A new TokenBucket for one bulb"""
+    return TokenBucket(capacity_for(config))
+
+
+def learned_capacities():
+    """{"model/version": capacity} of every model seen so far"""
+    with _capacities_lock:
+        return {
+            "/".join(key): capacity.as_dict() for key, capacity in _capacities.items()
+        }
+
+
+metrics.REGISTRY.gauge(
+    "smarthome_model_command_rate",
+    "Learned commands per second of each bulb model and protocol version",
+    ("model", "version"),
+    lambda: {key: capacity.rate for key, capacity in list(_capacities.items())},
+)
@@ -0,0 +1,452 @@
+"""
+Time-based automation inside the server.
+
+Schedules fire commands, scenes and programs over the server's open bulb
+connections, instead of cron starting tuya_control.py (and a new handshake
+with every bulb) for each wake-up or bedtime scene. One thread sleeps
+until the earliest entry of a heap of fire times, hands the schedule's
+action to the server and puts the schedule back at its next time.
+Schedules are saved to a JSON file, and how late each one fired is
+recorded so timing accuracy can be checked.
+
+Triggers:
+    {"at": "2026-10-20T07:00:00"}                One shot, local time unless
+                                                 the time has an offset
+    {"time": "07:00", "days": [0, 1, 2, 3, 4]}   Daily; days 0=Monday, optional
+    {"sun": "sunset", "offset": -15}             Daily at sunrise or sunset,
+                                                 offset in minutes
+    {"every": 600}                               Every N seconds
+
+Environment:
+    SMARTHOME_SCHEDULES   Where schedules are saved (schedules.json)
+    SMARTHOME_LATITUDE    Location for sunrise and sunset triggers
+    SMARTHOME_LONGITUDE
+
+Usage:
+    scheduler = Scheduler(run_action)
+    scheduler.start()
+    scheduler.add({"name": "Wake up", "trigger": {"time": "07:00"},
+                   "action": {"type": "command", "bulb": "top",
+                              "attr": "power", "value": True}})
+"""
+
+import datetime
+import heapq
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+
+from utils import metrics
+
+SCHEDULES_PATH = os.environ.get("SMARTHOME_SCHEDULES", "schedules.json")
+
+# Longest single sleep; wall clock changes are noticed within this time
+MAX_SLEEP = 60.0
+
+# Sun below the horizon, in degrees from the zenith, at sunrise and sunset
+SUN_ZENITH = 90.833
+
+LATENESS = metrics.REGISTRY.histogram(
+    "smarthome_schedule_lateness_seconds",
+    "How long after its fire time each schedule ran",
+    ("schedule",),
+    buckets=(0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+DISPATCH = metrics.REGISTRY.histogram(
+    "smarthome_schedule_dispatch_seconds",
+    "Time the scheduler thread spent handing off each action",
+    ("schedule",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+)
+
+log = logging.getLogger(__name__)
+
+
+def location_from_env():
+    """(latitude, longitude) from the environment, or None"""
+    try:
+        return (
+            float(os.environ["SMARTHOME_LATITUDE"]),
+            float(os.environ["SMARTHOME_LONGITUDE"]),
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+def sun_time(day, latitude, longitude, event="sunrise"):
+    """Time of sunrise or sunset on a day (the sunrise equation of the
+    Almanac for Computers, accurate to about a minute)
+
+    Args:
+        day: datetime.date, the local date at the location
+        latitude, longitude: Degrees, north and east positive
+        event: "sunrise" or "sunset"
+
+    Returns:
+        An aware UTC datetime, or None if the sun does not rise or set
+    """
+    rad = math.radians
+    deg = math.degrees
+    lng_hour = longitude / 15
+    t = day.timetuple().tm_yday + ((6 if event == "sunrise" else 18) - lng_hour) / 24
+    mean_anomaly = 0.9856 * t - 3.289
+    true_long = (
+        mean_anomaly
+        + 1.916 * math.sin(rad(mean_anomaly))
+        + 0.020 * math.sin(rad(2 * mean_anomaly))
+        + 282.634
+    ) % 360
+    ra = deg(math.atan(0.91764 * math.tan(rad(true_long)))) % 360
+    # Right ascension in the same quadrant as the true longitude, in hours
+    ra = (ra + (true_long // 90) * 90 - (ra // 90) * 90) / 15
+    sin_dec = 0.39782 * math.sin(rad(true_long))
+    cos_dec = math.cos(math.asin(sin_dec))
+    cos_h = (math.cos(rad(SUN_ZENITH)) - sin_dec * math.sin(rad(latitude))) / (
+        cos_dec * math.cos(rad(latitude))
+    )
+    if not -1 <= cos_h <= 1:
+        return None  # Polar day or night
+    hour_angle = deg(math.acos(cos_h))
+    if event == "sunrise":
+        hour_angle = 360 - hour_angle
+    local_mean = (hour_angle / 15 + ra - 0.06571 * t - 6.622) % 24
+    # Wrapping the local time rather than the UTC one keeps the event on the
+    # local date: west of UTC an evening event falls on the next UTC date
+    utc_hours = local_mean - lng_hour
+    midnight = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+    return midnight + datetime.timedelta(hours=utc_hours)
+
+
+def _parse_clock(value):
+    parts = [int(part) for part in str(value).split(":")]
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f"Time must be HH:MM or HH:MM:SS, got {value!r}")
+    return datetime.time(*parts)
+
+
+def _parse_at(value):
+    moment = datetime.datetime.fromisoformat(str(value))
+    if moment.tzinfo is None:
+        moment = moment.astimezone()  # Naive times are local
+    return moment.timestamp()
+
+
+def _finite(value, name):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be a finite number, got {value!r}")
+    return number
+
+
+def check_trigger(trigger, location=None):
+    """Raise ValueError unless a trigger is valid and can still fire"""
+    if not isinstance(trigger, dict):
+        raise ValueError("Trigger must be an object")
+    if "at" in trigger:
+        if _parse_at(trigger["at"]) <= time.time():
+            raise ValueError(f"Time {trigger['at']!r} is in the past")
+    elif "time" in trigger:
+        _parse_clock(trigger["time"])
+        if not all(0 <= int(day) <= 6 for day in trigger.get("days", ())):
+            raise ValueError("Days must be 0 (Monday) to 6 (Sunday)")
+    elif "sun" in trigger:
+        if trigger["sun"] not in ("sunrise", "sunset"):
+            raise ValueError('Sun trigger must be "sunrise" or "sunset"')
+        _finite(trigger.get("offset", 0), "Offset")
+        if location is None:
+            raise ValueError(
+                "Set SMARTHOME_LATITUDE and SMARTHOME_LONGITUDE for sun triggers"
+            )
+    elif "every" in trigger:
+        if _finite(trigger["every"], "Interval") <= 0:
+            raise ValueError("Interval must be positive")
+    else:
+        raise ValueError("Trigger needs one of at, time, sun or every")
+
+
+def next_fire(trigger, after, location=None, anchor=None):
+    """The first fire time of a trigger later than a given time
+
+    Args:
+        trigger: Trigger dict (see the module docstring)
+        after: Epoch seconds; the result is strictly later
+        location: (latitude, longitude) for sun triggers
+        anchor: Epoch seconds interval triggers count from
+
+    Returns:
+        Epoch seconds, or None if the trigger never fires again
+    """
+    if "at" in trigger:
+        at = _parse_at(trigger["at"])
+        return at if at > after else None
+
+    if "every" in trigger:
+        every = float(trigger["every"])
+        anchor = after if anchor is None else anchor
+        if anchor > after:
+            return anchor
+        return anchor + (math.floor((after - anchor) / every) + 1) * every
+
+    start = datetime.datetime.fromtimestamp(after).astimezone()
+    if "time" in trigger:
+        clock = _parse_clock(trigger["time"])
+        days = set(int(day) for day in trigger.get("days", range(7)))
+        for i in range(8):
+            day = start.date() + datetime.timedelta(days=i)
+            if day.weekday() not in days:
+                continue
+            moment = datetime.datetime.combine(day, clock).astimezone()
+            if moment.timestamp() > after:
+                return moment.timestamp()
+        return None
+
+    if "sun" in trigger and location is not None:
+        offset = float(trigger.get("offset", 0)) * 60
+        # An offset can move the previous day's event past after, so start
+        # a day early; polar regions may go months without one
+        for i in range(-1, 367):
+            day = start.date() + datetime.timedelta(days=i)
+            moment = sun_time(day, location[0], location[1], trigger["sun"])
+            if moment is not None and moment.timestamp() + offset > after:
+                return moment.timestamp() + offset
+    return None
+
+
+class Scheduler:
+    """Heap-ordered timer thread over persisted schedules
+
+    Args:
+        handler: func(action) run on the scheduler thread when a schedule
+            fires; it should hand work off rather than wait for bulbs
+        check_action: Optional func(action) raising ValueError for an
+            action the server cannot carry out
+        path: JSON file schedules are saved to, or None for memory only
+        location: (latitude, longitude) for sun triggers
+    """
+
+    # Schedule fields that are saved; the rest is runtime state
+    SAVED = ("id", "name", "trigger", "action", "enabled", "created")
+
+    def __init__(
+        self, handler, check_action=None, path=SCHEDULES_PATH, location=None
+    ):
+        self.handler = handler
+        self.check_action = check_action
+        self.path = path
+        self.location = location if location is not None else location_from_env()
+        self._schedules = {}  # id -> schedule dict
+        self._heap = []  # (fire time, sequence, id)
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.fired = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self._load()
+
+    def _load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable schedules %s: %s", self.path, e)
+            return
+        now = time.time()
+        with self._cond:
+            for spec in saved:
+                schedule = {key: spec.get(key) for key in self.SAVED}
+                schedule.update(
+                    runs=0, last_run=None, last_lateness=None, last_error=None
+                )
+                self._schedules[schedule["id"]] = schedule
+                self._plan(schedule, now)
+
+    def _save(self):
+        if self.path is None:
+            return
+        saved = [
+            {key: schedule[key] for key in self.SAVED}
+            for schedule in self._schedules.values()
+        ]
+        temp = f"{self.path}.tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(saved, f, indent=4)
+            os.replace(temp, self.path)
+        except OSError as e:
+            log.warning("Could not save schedules %s: %s", self.path, e)
+
+    def _plan(self, schedule, after):
+        """Set a schedule's next_run and push it on the heap"""
+        next_run = None
+        if schedule["enabled"]:
+            try:
+                next_run = next_fire(
+                    schedule["trigger"], after, self.location, schedule["created"]
+                )
+            except (ValueError, TypeError) as e:
+                log.warning("Schedule %s has a bad trigger: %s", schedule["id"], e)
+        schedule["next_run"] = next_run
+        if next_run is not None:
+            self._sequence += 1
+            heapq.heappush(self._heap, (next_run, self._sequence, schedule["id"]))
+            self._cond.notify()
+
+    def add(self, spec):
+        """Validate and store a new schedule
+
+        Args:
+            spec: {"name", "trigger", "action", "enabled" (default true)}
+
+        Returns:
+            The stored schedule
+
+        Raises:
+            ValueError: The trigger or action is not valid
+        """
+        check_trigger(spec.get("trigger"), self.location)
+        if not isinstance(spec.get("action"), dict):
+            raise ValueError("Action must be an object")
+        if self.check_action is not None:
+            self.check_action(spec["action"])
+        now = time.time()
+        schedule = {
+            "id": uuid.uuid4().hex[:8],
+            "name": str(spec.get("name") or "schedule"),
+            "trigger": spec["trigger"],
+            "action": spec["action"],
+            "enabled": bool(spec.get("enabled", True)),
+            "created": now,
+            "runs": 0,
+            "last_run": None,
+            "last_lateness": None,
+            "last_error": None,
+        }
+        with self._cond:
+            self._schedules[schedule["id"]] = schedule
+            self._plan(schedule, now)
+            self._save()
+        return dict(schedule)
+
+    def remove(self, schedule_id):
+        """Delete a schedule; returns False if there is no such schedule"""
+        with self._cond:
+            if self._schedules.pop(schedule_id, None) is None:
+                return False
+            self._save()
+            return True
+
+    def set_enabled(self, schedule_id, enabled):
+        """Pause or resume a schedule
+
+        Raises:
+            KeyError: No such schedule
+        """
+        with self._cond:
+            schedule = self._schedules[schedule_id]
+            schedule["enabled"] = bool(enabled)
+            self._plan(schedule, time.time())
+            self._save()
+            return dict(schedule)
+
+    def get(self, schedule_id):
+        with self._cond:
+            return dict(self._schedules[schedule_id])
+
+    def schedules(self):
+        """Every schedule, soonest first"""
+        with self._cond:
+            schedules = [dict(schedule) for schedule in self._schedules.values()]
+        return sorted(schedules, key=lambda s: (s["next_run"] is None, s["next_run"]))
+
+    def run_now(self, schedule_id):
+        """Run a schedule's action immediately, outside its timing"""
+        with self._cond:
+            action = self._schedules[schedule_id]["action"]
+        self.handler(action)
+
+    def stats(self):
+        """Fire count and lateness of everything fired since start"""
+        return {
+            "fired": self.fired,
+            "mean_lateness": self.total_lateness / self.fired if self.fired else None,
+            "max_lateness": self.max_lateness,
+            "pending": sum(1 for s in self._schedules.values() if s["next_run"]),
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name="scheduler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout=2):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _next_due(self):
+        """Wait for the earliest schedule; returns (schedule, fire time)"""
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait(MAX_SLEEP)
+                    continue
+                fire_at, _, schedule_id = self._heap[0]
+                schedule = self._schedules.get(schedule_id)
+                if schedule is None or schedule["next_run"] != fire_at:
+                    heapq.heappop(self._heap)  # Removed or rescheduled
+                    continue
+                remaining = fire_at - time.time()
+                if remaining > 0:
+                    self._cond.wait(min(remaining, MAX_SLEEP))
+                    continue
+                heapq.heappop(self._heap)
+                self._plan(schedule, max(fire_at, time.time()))
+                return schedule, fire_at
+            return None, None
+
+    def _run(self):
+        while True:
+            schedule, fire_at = self._next_due()
+            if schedule is None:
+                return
+            started = time.time()
+            lateness = started - fire_at
+            label = (schedule["name"],)
+            LATENESS.observe(lateness, label)
+            error = None
+            try:
+                self.handler(schedule["action"])
+            except Exception as e:
+                error = str(e)
+                log.exception("Schedule %s failed", schedule["name"])
+            DISPATCH.observe(time.time() - started, label)
+
+            with self._cond:
+                schedule["runs"] += 1
+                schedule["last_run"] = started
+                schedule["last_lateness"] = lateness
+                schedule["last_error"] = error
+                self.fired += 1
+                self.total_lateness += lateness
+                self.max_lateness = max(self.max_lateness, lateness)
+            log.info(
+                "Schedule %s fired",
+                schedule["name"],
+                extra={"lateness_ms": round(lateness * 1000, 3)},
+            )
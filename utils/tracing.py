@@ -0,0 +1,144 @@
+"""
+Lightweight request and frame tracing.
+
+A trace covers one API request or one program frame and collects timed
+spans for its steps: parsing, waiting in a bulb's command queue, the
+device round trip and Socket.IO emits. The current trace is kept per
+thread; commands queued for a bulb carry it to the queue worker, which
+adds the queue wait and device spans. Finished traces go into a ring
+buffer per kind that /debug/traces reads.
+
+Usage:
+    trace = tracing.start("POST /api/bulbs/top/color")
+    with tracing.span("parse"):
+        data = request.json
+    tracing.finish(trace, status=200)
+"""
+
+import collections
+import contextlib
+import itertools
+import os
+import threading
+import time
+
+# Set SMARTHOME_TRACING=0 to turn tracing off
+ENABLED = os.environ.get("SMARTHOME_TRACING", "1") != "0"
+
+# Finished traces kept per kind
+BUFFER_SIZE = 256
+
+_buffers = collections.defaultdict(lambda: collections.deque(maxlen=BUFFER_SIZE))
+_ids = itertools.count(1)
+_local = threading.local()
+
+
+class Trace:
+    """One request or frame and the spans recorded for it"""
+
+    __slots__ = ("id", "name", "kind", "attrs", "spans", "started", "ended", "wall")
+
+    def __init__(self, name, kind, attrs):
+        self.id = next(_ids)
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.spans = []
+        self.started = time.monotonic()
+        self.ended = None
+        self.wall = time.time()
+
+    def add_span(self, name, start, end, **attrs):
+        """Record a step that ran from start to end (time.monotonic())"""
+        self.spans.append((name, start, end, attrs))
+
+    def as_dict(self):
+        ended = self.ended if self.ended is not None else time.monotonic()
+        return {
+            "id": self.id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.wall,
+            "duration_ms": round((ended - self.started) * 1000, 3),
+            "attrs": self.attrs,
+            "spans": [
+                dict(
+                    name=name,
+                    offset_ms=round((start - self.started) * 1000, 3),
+                    duration_ms=round((end - start) * 1000, 3),
+                    **attrs,
+                )
+                for name, start, end, attrs in list(self.spans)
+            ],
+        }
+
+
+def start(name, kind="request", **attrs):
+    """Start a trace and make it the current one for this thread"""
+    if not ENABLED:
+        return None
+    trace = Trace(name, kind, attrs)
+    _local.trace = trace
+    return trace
+
+
+def current():
+    """The current thread's trace, or None"""
+    return getattr(_local, "trace", None)
+
+
+@contextlib.contextmanager
+def use(trace):
+    """Make a trace the current one for the duration of a block"""
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def finish(trace=None, **attrs):
+    """End a trace (the current one by default) and keep it in the buffer"""
+    trace = trace or current()
+    if trace is None:
+        return None
+    trace.ended = time.monotonic()
+    trace.attrs.update(attrs)
+    _buffers[trace.kind].append(trace)
+    if current() is trace:
+        _local.trace = None
+    return trace
+
+
+def discard(trace):
+    """Drop an unfinished trace without keeping it"""
+    if trace is not None and current() is trace:
+        _local.trace = None
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Time a block as a span of the current trace (no-op without one)"""
+    trace = current()
+    if trace is None:
+        yield
+        return
+    begin = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add_span(name, begin, time.monotonic(), **attrs)
+
+
+def recent(kind=None, limit=50):
+    """The newest finished traces, newest first
+
+    Args:
+        kind: "request", "frame" or None for every kind
+        limit: Maximum number of traces returned
+    """
+    kinds = [kind] if kind else list(_buffers)
+    traces = [trace for k in kinds for trace in list(_buffers.get(k, ()))]
+    traces.sort(key=lambda trace: trace.started, reverse=True)
+    return [trace.as_dict() for trace in traces[:limit]]